@@ -1,5 +1,8 @@
 import re
-from typing import Iterable
+from typing import Iterable, Sequence
+
+_REGEX_META = frozenset(".^$*+?{}[]\\|()")
+_QUANTIFIERS = frozenset("*+?{")
 
 
 def rule_name_re(name: str, *, legacy: bool = False) -> str:
@@ -14,6 +17,62 @@ def rule_name_re(name: str, *, legacy: bool = False) -> str:
     return f"^{name.rstrip('/')}($|/.*$)"
 
 
+def literal_prefixes(pattern: str) -> list[str]:
+    """
+    Return the literal text that a ``fullmatch`` of ``pattern`` must start
+    with, once for each top-level alternative.
+
+    This is conservative: an empty string means the alternative could match
+    anything, and escapes or groups end the literal portion early.
+    """
+    alternatives = []
+    depth = 0
+    in_class = False
+    start = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i += 2
+            continue
+        if in_class:
+            if c == "]":
+                in_class = False
+        elif c == "[":
+            in_class = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            alternatives.append(pattern[start:i])
+            start = i + 1
+        i += 1
+    alternatives.append(pattern[start:])
+    return [_literal_prefix(alt) for alt in alternatives]
+
+
+def _literal_prefix(alternative: str) -> str:
+    if alternative.startswith("^"):
+        alternative = alternative[1:]
+    prefix: list[str] = []
+    for c in alternative:
+        if c in _REGEX_META:
+            if c in _QUANTIFIERS and prefix:
+                # The previous character is optional or repeated
+                prefix.pop()
+            break
+        prefix.append(c)
+    return "".join(prefix)
+
+
+def may_start_with(prefixes: Sequence[str], start: str) -> bool:
+    """
+    Whether a name beginning with ``start`` could begin with one of ``prefixes``.
+    """
+    return any(p[: len(start)] == start[: len(p)] for p in prefixes)
+
+
 def zfilename_re(opts: Iterable[str]) -> re.Pattern[str]:
     o = "|".join(map(re.escape, opts))
     # This regex could be made compatible with `re2` with a minor change of the
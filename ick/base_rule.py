@@ -2,22 +2,33 @@ from __future__ import annotations
 
 import json
 import os
+import signal
 import subprocess
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from contextlib import contextmanager
 from fnmatch import fnmatch
 from logging import getLogger
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Any, Callable, Iterable, Mapping, Sequence
+from typing import Any, Callable, Hashable, Iterable, Iterator, Mapping, Sequence
 
 import moreorless
 from feedforward import Notification, Run, State, Step
 from feedforward.erasure import ERASURE, Erasure
-from keke import ktrace
+from feedforward.util import get_default_parallelism
+from keke import kev, ktrace
+from vmodule import VLOG_1
 
-from ick_protocol import Finished, ListResponse, Modified, RuleStatus, Scope
+from ick_protocol import Finished, ListResponse, Modified, RuleStatus, Scope, Urgency
 
 from .config import RuleConfig
-from .sh import run_cmd
+from .config.rule_repo import RULE_CONFIG_NAMES
+from .schedule import PROBE_SIZES, BatchCost, SlotPool, auto_batch_size, fit_batch_cost, max_argv_files
+from .sh import Usage, limit_resources, run_batch
+from .supervisor import ProcessResult, Supervisor
 from .util import diffstat, merge_dicts
 
 LOG = getLogger(__name__)
@@ -28,6 +39,20 @@ def materialize(path: str, filename: str, contents: bytes) -> None:
     Path(path, filename).write_bytes(contents)
 
 
+#: Above this many projects, a file-scoped rule gets one `CoalescedFileStep`
+#: rather than a step for each
+COALESCE_PROJECTS = 20
+
+#: How close (as a fraction) a batch's peak RSS must come to its memory_limit
+#: for a failure to be put down to the limit; address space also counts
+#: mappings that aren't resident, so it can't get all the way there
+MEMORY_LIMIT_NEAR = 0.8
+
+
+def pl_files(filenames: Sequence[str]) -> str:
+    return f"{len(filenames)} file" if len(filenames) == 1 else f"{len(filenames)} files"
+
+
 class GenericPreparedStep(Step[str, bytes | Erasure]):
     """
     Subclass of step that ensures some setup is complete before processing items.
@@ -51,9 +76,20 @@ class GenericPreparedStep(Step[str, bytes | Erasure]):
         append_filenames: bool,
         rule_prepare: Callable[[], bool] | None = None,
         excluded_project_dirs: Sequence[str] = (),
+        order: int = 50,
+        urgency: Urgency = Urgency.LATER,
+        concurrency: str = "",
+        outputs: Sequence[str] | None = None,
+        timeout: float | None = None,
+        cpu_limit: float | None = None,
+        memory_limit: int | None = None,
         *args: Any,
         **kwargs: Any,
     ) -> None:
+        # "auto" is resized before each batch, see `_next_batch_size`
+        self.auto_batch_size = kwargs.get("batch_size") == "auto"
+        if self.auto_batch_size:
+            kwargs["batch_size"] = PROBE_SIZES[0]
         super().__init__(*args, **kwargs)
         self.prefixed_name = prefixed_name
         # TODO figure out how extra_inputs factors in
@@ -74,27 +110,115 @@ class GenericPreparedStep(Step[str, bytes | Erasure]):
         # is at the end.
         self.batch_messages: dict[tuple[tuple[str, int], ...], tuple[str, int, dict[str, Any] | None]] = {}
         self.rule_status = RuleStatus.SUCCESS
+        # For scheduling (see `ick.schedule`)
+        self.order = order
+        self.urgency = urgency
+        self.elapsed = 0.0
+        self.files = 0
+        self.batches = 0
+        self._batch_starts: dict[int, float] = {}
+        #: (files, seconds) of each finished batch
+        self.batch_samples: list[tuple[int, float]] = []
+        #: From previous runs, if known; replaced by `batch_samples` once they're enough
+        self.batch_cost: BatchCost | None = None
+        #: How many batches can run at once; set by `IckRun`
+        self.slots = get_default_parallelism()
+        self.concurrency = concurrency
+        #: If declared, the only files (as patterns, like `patterns`) this step may change
+        self.outputs = outputs
+        #: A slot from each of these is needed to run a batch, e.g. for the
+        #: concurrency class or make's jobserver; set by `IckRun`
+        self.slot_pools: list[SlotPool] = []
+        #: Fds that batches' processes inherit, e.g. make's jobserver's
+        self.pass_fds: tuple[int, ...] = ()
+        # Per-batch limits
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.limits = limit_resources(cpu_limit, memory_limit)
+        #: `extra_env` on top of ours, worked out at the first batch
+        self._env: dict[str, str] | None = None
+        #: If set (by `IckRun`), batches' processes are run by this, and the
+        #: thread that started one goes on to other work meanwhile
+        self.supervisor: Supervisor | None = None
+        self._pending: list[_PendingBatch] = []
+        self._pending_lock = threading.Lock()
+        #: project path -> what its batches took, for working out which rule
+        #: made a run slow
+        self.usage: dict[str, Usage] = {}
+
+    @property
+    def project_paths(self) -> Sequence[str]:
+        """The projects (as `Project.subdir`) whose files this step processes."""
+        return (self.match_prefix,)
+
+    @property
+    def common_prefix(self) -> str:
+        """A prefix shared by the paths of all of `project_paths`."""
+        return self.match_prefix
 
     def _key_is_excluded(self, key: str) -> bool:
-        for excluded_dir in self.excluded_project_dirs:
-            excluded_dir = excluded_dir.rstrip("/")
-            if key == excluded_dir or key.startswith(f"{excluded_dir}/"):
-                return True
-        return False
+        return _in_dirs(key, self.excluded_project_dirs)
 
-    def _output_key(self, relative_filename: str) -> str:
-        return f"{self.match_prefix}{relative_filename}" if self.match_prefix else relative_filename
+    def _owner(self, key: str) -> str | None:
+        """Which of `project_paths` `key` belongs to, if any."""
+        if not key.startswith(self.match_prefix) or self._key_is_excluded(key):
+            return None
+        return self.match_prefix
 
-    def _ensure_allowed_key(self, key: str) -> bool:
-        if self._key_is_excluded(key):
-            self.cancel(f"Produced output for excluded project path: {key!r}")
+    def _ensure_allowed_key(self, key: str, project_path: str) -> bool:
+        if self._owner(key) != project_path:
+            self._fail_project(project_path, f"Produced output for excluded project path: {key!r}")
+            return False
+        if not self.may_produce(key):
+            self._fail_project(project_path, f"Produced output not in its declared outputs: {key!r}")
             return False
         return True
 
+    def _fail_project(self, project_path: str, reason: str) -> None:
+        """
+        Gives up on `project_path`, undoing what was done to its files.  This
+        step only has the one project, so that's cancelling it.
+        """
+        self.cancel(reason)
+
+    def _project_failed(self, project_path: str) -> bool:
+        return self.cancelled
+
+    def may_produce(self, key: str) -> bool:
+        """Whether this step is allowed to change (or create, or remove) `key`."""
+        if self.outputs is None:
+            return True
+        owner = self._owner(key)
+        return owner is not None and match_prefix_patterns(key, owner, self.outputs) is not None
+
+    def would_match(self, key: str) -> bool:
+        """Like `match`, without affecting `matches_at_least_once`."""
+        owner = self._owner(key)
+        return owner is not None and match_prefix_patterns(key, owner, self.patterns) is not None
+
+    def may_affect(self, other: GenericPreparedStep) -> bool:
+        """
+        Whether anything this step changes might be an input to `other`.
+
+        Without declared `outputs` that's always assumed; with them, it's a
+        conservative guess from the patterns.
+        """
+        if self.outputs is None:
+            return True
+        return patterns_may_overlap(self.common_prefix, self.outputs, other.common_prefix, other.patterns)
+
+    def count_matches(self, keys: Iterable[str]) -> int:
+        """How many of `keys` this step would process, without affecting `matches_at_least_once`."""
+        return sum(1 for key in keys if self.would_match(key))
+
+    def running_for(self) -> float:
+        """Total seconds that batches still running have been running."""
+        now = time.monotonic()
+        return sum(now - start for start in list(self._batch_starts.values()))
+
     def match(self, key: str) -> bool:
-        if self._key_is_excluded(key):
-            return False
-        m = bool(match_prefix_patterns(key, self.match_prefix, self.patterns))
+        m = self.would_match(key)
         self.matches_at_least_once |= m
         return m
 
@@ -102,6 +226,9 @@ class GenericPreparedStep(Step[str, bytes | Erasure]):
         """
         Runs a batch only after there are matches and we're prepared.
 
+        With a `supervisor`, this first finishes any batches whose processes
+        are done, and otherwise starts one without waiting for it.
+
         Some files matching the input patterns for a rule must exist in order
         for the Step to do any work.  Because `prepare` and `rule_prepare` are ick
         concepts, we override the parent implementation with one that only does that
@@ -111,6 +238,9 @@ class GenericPreparedStep(Step[str, bytes | Erasure]):
         `rule_prepare` -- in particular, we'll call that quite often and it should just
         cache and return True once ready.
         """
+        if self.supervisor is not None and self._collect_finished():
+            return True
+
         if self.matches_at_least_once and self.rule_prepare:
             try:
                 if not self.rule_prepare():
@@ -129,7 +259,173 @@ class GenericPreparedStep(Step[str, bytes | Erasure]):
                 self.cancel(msg)
                 return False
 
-        return super().run_next_batch()
+        if self.auto_batch_size:
+            self.batch_size = self._next_batch_size()
+        if self.supervisor is not None:
+            return self._start_batch(self.supervisor)
+        if not self.slot_pools:
+            return super().run_next_batch()
+        if self.cancelled or not self.unprocessed_notifications or (not self.eager and not self.inputs_final):
+            # Don't take slots (and make's tokens) just to find there's nothing to do
+            return False
+        acquired: list[SlotPool] = []
+        try:
+            for pool in self.slot_pools:
+                if not pool.acquire(blocking=False):
+                    # All taken, find some other work
+                    return False
+                acquired.append(pool)
+            return super().run_next_batch()
+        finally:
+            for pool in reversed(acquired):
+                pool.release()
+
+    def _start_batch(self, supervisor: Supervisor) -> bool:
+        if self.cancelled or not self.unprocessed_notifications or (not self.eager and not self.inputs_final):
+            return False
+        if not supervisor.reserve():
+            return False
+        acquired: list[SlotPool] = []
+        for pool in self.slot_pools:
+            if not pool.acquire(blocking=False):
+                break
+            acquired.append(pool)
+        else:
+            taken = self._take_batch()
+            if taken is not None:
+                self._launch(supervisor, *taken, slots=acquired)
+                return True
+        for pool in reversed(acquired):
+            pool.release()
+        supervisor.release()
+        return False
+
+    def _take_batch(self) -> tuple[int, list[Notification[str, bytes | Erasure]]] | None:
+        """
+        Takes the next batch's notifications, as `Step.run_next_batch` does
+        (within `concurrency_limit`), and counts it as outstanding.
+
+        This copies feedforward internals, which is why setup.cfg pins it to
+        0.8.*.
+        """
+        q: dict[str, Notification[str, bytes | Erasure]] = {}
+        with self.state_lock:
+            if self.concurrency_limit is not None and self.outstanding >= self.concurrency_limit:
+                return None
+            while len(q) < self.batch_size or self.batch_size < 0:
+                try:
+                    item = self.unprocessed_notifications.pop(-1)
+                except IndexError:
+                    break
+                if self.match(item.key) and (item.key not in self.accepted_state or item.state.gens > self.accepted_state[item.key].gens):
+                    self.accepted_state[item.key] = item.state
+                    self.output_state[item.key] = item.state
+                    q[item.key] = item
+                    self.stat_input_notifications += 1
+            if not q:
+                return None
+            gen = next(self.gen_counter)
+            self.outstanding += 1
+        return gen, list(q.values())
+
+    def _launch(
+        self,
+        supervisor: Supervisor,
+        gen: int,
+        notifications: list[Notification[str, bytes | Erasure]],
+        slots: list[SlotPool],
+    ) -> None:
+        self._batch_starts[gen] = time.monotonic()
+        pending = _PendingBatch(gen, notifications, slots)
+        try:
+            for project_path, group in self._by_project(notifications):
+                batch = self._start_project(project_path, group)
+                pending.batches.append(batch)
+                future = supervisor.submit(
+                    batch.cmd,
+                    cwd=batch.workdir,
+                    env=batch.env,
+                    timeout=self.timeout,
+                    limits=self.limits,
+                    pass_fds=self.pass_fds,
+                )
+                pending.futures.append(future)
+        except Exception:
+            pending.error = traceback.format_exc()
+        with self._pending_lock:
+            self._pending.append(pending)
+
+    def _collect_finished(self) -> bool:
+        """Finishes the batches whose processes are all done, returning whether there were any."""
+        with self._pending_lock:
+            done = [p for p in self._pending if all(f.done() for f in p.futures)]
+            for p in done:
+                self._pending.remove(p)
+        for p in done:
+            self._finish_batch(p)
+        return bool(done)
+
+    @ktrace("self.prefixed_name", "self.match_prefix", "pending.gen")
+    def _finish_batch(self, pending: _PendingBatch) -> None:
+        assert self.supervisor is not None
+        try:
+            if pending.error:
+                self.cancel(pending.error)
+            for batch, future in zip(pending.batches, pending.futures):
+                if self.cancelled:
+                    break
+                if self._project_failed(batch.project_path):
+                    continue
+                try:
+                    result = future.result()
+                except FileNotFoundError as e:
+                    self.cancel(str(e))
+                    break
+                if result.usage:
+                    batch.usage.add(result.usage)
+                if result.timed_out:
+                    self._cancel_timed_out(batch)
+                    self._record_usage(batch)
+                    continue
+                with self._analyzing(batch):
+                    batch_value = self._outcome(batch, result.returncode, result.stdout, result.stderr)
+                    if batch_value is None:
+                        continue
+                    for n in self._finish_project(pending.gen, batch, batch_value):
+                        self._emit(n, batch.project_path)
+        except Exception:
+            self.cancel(traceback.format_exc())
+        finally:
+            for batch in pending.batches:
+                batch.cleanup()
+            for pool in reversed(pending.slots):
+                pool.release()
+            self.supervisor.release()
+            self._batch_finished(pending.gen, len(pending.notifications))
+            self.outstanding -= 1
+
+    def _emit(self, result: Notification[str, bytes | Erasure], project_path: str) -> None:
+        """Passes on one of a batch's results for `project_path`, as `Step.run_next_batch` does."""
+        assert self.index is not None
+        assert sum(result.state.gens[self.index + 1 :]) == 0
+        with self.state_lock:
+            if self._project_failed(project_path):
+                # Its changes were undone, and mustn't come back
+                return
+            if result.key not in self.output_state or result.state.gens > self.output_state[result.key].gens:
+                self.output_state[result.key] = result.state
+                self.output_notifications.append(result)
+                self.stat_output_notifications += 1
+
+    def _next_batch_size(self) -> int:
+        cost = fit_batch_cost(self.batch_samples) or self.batch_cost
+        if cost is None:
+            # Alternate sizes until there's enough to tell overhead from per-file cost
+            return PROBE_SIZES[(len(self.batch_samples) + len(self._batch_starts)) % len(PROBE_SIZES)]
+        pending = self.unprocessed_notifications[-100:]
+        max_files = max_argv_files(self.cmdline, {**os.environ, **self.extra_env}, (n.key[len(self.match_prefix) :] for n in pending))
+        files = self.stat_input_notifications + len(self.unprocessed_notifications)
+        return auto_batch_size(cost, files, self.slots, max_files)
 
     _g_files: dict[str, bytes] = {}
 
@@ -143,110 +439,228 @@ class GenericPreparedStep(Step[str, bytes | Erasure]):
         notifications: Iterable[Notification[str, bytes | Erasure]],
     ) -> Iterable[Notification[str, bytes | Erasure]]:
         notifications = list(notifications)
-        # TODO name better, pick a good one...
-        with TemporaryDirectory() as d, TemporaryDirectory() as output_dir:
-            # with self.state_lock:
-            #     # First the common files
-            #     g = self._gravitational_constant()
-            #     for k, v in self._g_files.items():
-            #         materialize(d, k, v)
-
-            # Then the ones we're being asked to do
-            filenames = []
-            batch_key = {}
-            batch_value = None
-            for n in notifications:
-                if n.state.value is ERASURE:
-                    continue
-                relative_filename = n.key[len(self.match_prefix) :]
-                materialize(d, relative_filename, n.state.value)
-                filenames.append(relative_filename)
-                assert self.index is not None
-                batch_key[n.key] = n.state.gens[self.index]
-
-            # nice_cmd = " ".join(map(str, self.cmdline))
-            if self.append_filenames:
-                cmd = list(self.cmdline) + filenames
-            else:
-                cmd = list(self.cmdline)
-
-            env = os.environ.copy()
-            env.update(self.extra_env)
-            env["ICK_OUTPUT_DIR"] = output_dir
+        self._batch_starts[next_gen] = time.monotonic()
+        try:
+            yield from self._process(next_gen, notifications)
+        finally:
+            self._batch_finished(next_gen, len(notifications))
+
+    def _batch_finished(self, gen: int, files: int) -> None:
+        with self.state_lock:
+            seconds = time.monotonic() - self._batch_starts.pop(gen)
+            self.elapsed += seconds
+            self.files += files
+            self.batches += 1
+            self.batch_samples.append((files, seconds))
+
+    def _by_project(
+        self, notifications: list[Notification[str, bytes | Erasure]]
+    ) -> Iterable[tuple[str, list[Notification[str, bytes | Erasure]]]]:
+        """Splits a batch into (project path, its notifications), to run separately."""
+        yield self.match_prefix, notifications
+
+    def _process(
+        self,
+        next_gen: int,
+        notifications: list[Notification[str, bytes | Erasure]],
+    ) -> Iterable[Notification[str, bytes | Erasure]]:
+        for project_path, group in self._by_project(notifications):
+            if self._project_failed(project_path):
+                continue
+            yield from self._process_project(next_gen, project_path, group)
+            if self.cancelled:
+                return
 
+    def _process_project(
+        self,
+        next_gen: int,
+        project_path: str,
+        notifications: list[Notification[str, bytes | Erasure]],
+    ) -> Iterable[Notification[str, bytes | Erasure]]:
+        batch = self._start_project(project_path, notifications)
+        try:
             try:
-                stdout = run_cmd(
-                    cmd,
-                    env=env,
-                    cwd=d,
+                returncode, stdout, stderr, usage = run_batch(
+                    batch.cmd,
+                    env=batch.env,
+                    cwd=batch.workdir,
+                    timeout=self.timeout,
+                    limits=self.limits,
+                    pass_fds=self.pass_fds,
                 )
             except FileNotFoundError as e:
                 self.cancel(str(e))
                 return
-            except subprocess.CalledProcessError as e:
-                msg = ""
-                if e.stdout:
-                    msg += e.stdout
-                if e.stderr:
-                    msg += e.stderr
-
-                batch_value = (msg, e.returncode)
-            else:
-                batch_value = (stdout, 0)
-
-            expected = {n.key[len(self.match_prefix) :]: n.state.value for n in notifications if n.state.value is not ERASURE}
-            changed, new, remv = analyze_dir(d, expected)
-            # print(changed, new, remv)
-
-            outputs: list[Notification[str, bytes | Erasure]] = []
-            for n in notifications:
-                relative_filename = n.key[len(self.match_prefix) :]
-                if relative_filename in changed:
-                    key = n.key
-                    if not self._ensure_allowed_key(key):
-                        return
-                    outputs.append(self.update_notification(n, next_gen, new_value=Path(d, relative_filename).read_bytes()))
-                    batch_key[n.key] = next_gen
-                elif relative_filename in remv:
-                    key = n.key
-                    if not self._ensure_allowed_key(key):
-                        return
-                    outputs.append(self.update_notification(n, next_gen, new_value=ERASURE))
-                    batch_key[n.key] = next_gen
-
-            brand_new_gens = self.update_generations((0,) * len(notifications[0].state.gens), next_gen)
-            for name in new:
-                full_key = self._output_key(name)
-                if not self._ensure_allowed_key(full_key):
+            except subprocess.TimeoutExpired:
+                self._cancel_timed_out(batch)
+                return
+            batch.usage.add(usage)
+            with self._analyzing(batch):
+                batch_value = self._outcome(batch, returncode, stdout, stderr)
+                if batch_value is None:
                     return
-                batch_key[full_key] = next_gen
-                outputs.append(
-                    Notification(
-                        key=full_key,
-                        state=State(
-                            gens=brand_new_gens,
-                            value=Path(d, name).read_bytes(),
-                        ),
-                    )
+                # Listed, so that the time is only ours
+                outputs = list(self._finish_project(next_gen, batch, batch_value))
+            yield from outputs
+        finally:
+            batch.cleanup()
+
+    def _start_project(self, project_path: str, notifications: list[Notification[str, bytes | Erasure]]) -> _ProjectBatch:
+        """Materializes `notifications` in a new directory, ready to run the command there."""
+        start = time.monotonic()
+        # TODO name better, pick a good one...
+        batch = _ProjectBatch(project_path, notifications)
+        # with self.state_lock:
+        #     # First the common files
+        #     g = self._gravitational_constant()
+        #     for k, v in self._g_files.items():
+        #         materialize(d, k, v)
+
+        # Then the ones we're being asked to do
+        for n in notifications:
+            if n.state.value is ERASURE:
+                continue
+            relative_filename = n.key[len(project_path) :]
+            materialize(batch.workdir, relative_filename, n.state.value)
+            batch.filenames.append(relative_filename)
+            assert self.index is not None
+            batch.batch_key[n.key] = n.state.gens[self.index]
+
+        # nice_cmd = " ".join(map(str, self.cmdline))
+        if self.append_filenames:
+            batch.cmd = [*self.cmdline, *batch.filenames]
+        else:
+            batch.cmd = list(self.cmdline)
+
+        if self._env is None:
+            self._env = {**os.environ, **self.extra_env}
+        batch.env = {**self._env, "ICK_OUTPUT_DIR": batch.output_dir}
+        batch.usage.materialize = time.monotonic() - start
+        return batch
+
+    @contextmanager
+    def _analyzing(self, batch: _ProjectBatch) -> Iterator[None]:
+        """Times looking at what a batch's command did, then records its usage."""
+        start = time.monotonic()
+        # The usage is only turned into a string as the event ends, so it's all there
+        with kev("batch", rule=self.prefixed_name, project=batch.project_path, files=len(batch.filenames), usage=batch.usage):
+            try:
+                yield
+            finally:
+                batch.usage.analyze += time.monotonic() - start
+                self._record_usage(batch)
+
+    def _record_usage(self, batch: _ProjectBatch) -> None:
+        with self.state_lock:
+            self.usage.setdefault(batch.project_path, Usage()).add(batch.usage)
+
+    def _cancel_timed_out(self, batch: _ProjectBatch) -> None:
+        self._fail_project(batch.project_path, f"Batch of {pl_files(batch.filenames)} took longer than the timeout of {self.timeout}s")
+
+    def _outcome(self, batch: _ProjectBatch, returncode: int, stdout: bytes, stderr: bytes) -> tuple[str, int] | None:
+        """The message and code from a finished command, or None if it failed the project."""
+        if not returncode:
+            return (_decode(stdout), 0)
+        output = _decode(stdout) + _decode(stderr)
+        if reason := self._limit_exceeded(returncode, batch.usage):
+            self._fail_project(batch.project_path, f"Batch of {pl_files(batch.filenames)} {reason}")
+            return None
+        return (output, returncode)
+
+    def _finish_project(
+        self,
+        next_gen: int,
+        batch: _ProjectBatch,
+        batch_value: tuple[str, int],
+    ) -> Iterable[Notification[str, bytes | Erasure]]:
+        """Yields the changes the command made, once it's finished."""
+        project_path, notifications, d, batch_key = batch.project_path, batch.notifications, batch.workdir, batch.batch_key
+        expected = {n.key[len(project_path) :]: n.state.value for n in notifications if n.state.value is not ERASURE}
+        changed, new, remv = analyze_dir(d, expected)
+        # print(changed, new, remv)
+
+        outputs: list[Notification[str, bytes | Erasure]] = []
+        for n in notifications:
+            relative_filename = n.key[len(project_path) :]
+            if relative_filename in changed:
+                key = n.key
+                if not self._ensure_allowed_key(key, project_path):
+                    return
+                outputs.append(self.update_notification(n, next_gen, new_value=Path(d, relative_filename).read_bytes()))
+                batch_key[n.key] = next_gen
+            elif relative_filename in remv:
+                key = n.key
+                if not self._ensure_allowed_key(key, project_path):
+                    return
+                outputs.append(self.update_notification(n, next_gen, new_value=ERASURE))
+                batch_key[n.key] = next_gen
+
+        brand_new_gens = self.update_generations((0,) * len(notifications[0].state.gens), next_gen)
+        for name in new:
+            full_key = f"{project_path}{name}"
+            if not self._ensure_allowed_key(full_key, project_path):
+                return
+            batch_key[full_key] = next_gen
+            outputs.append(
+                Notification(
+                    key=full_key,
+                    state=State(
+                        gens=brand_new_gens,
+                        value=Path(d, name).read_bytes(),
+                    ),
                 )
+            )
 
-            metadata_path = Path(output_dir) / "metadata.json"
-            batch_metadata: dict[str, Any] | None = None
-            if metadata_path.exists():
-                batch_metadata = json.loads(metadata_path.read_text())
+        metadata_path = Path(batch.output_dir) / "metadata.json"
+        batch_metadata: dict[str, Any] | None = None
+        if metadata_path.exists():
+            batch_metadata = json.loads(metadata_path.read_text())
 
-            if batch_value:
-                self.batch_messages[tuple(batch_key.items())] = (batch_value[0], batch_value[1], batch_metadata)
+        self.batch_messages[tuple(batch_key.items())] = (batch_value[0], batch_value[1], batch_metadata)
 
-            yield from outputs
+        yield from outputs
+
+    def _limit_exceeded(self, returncode: int, usage: Usage) -> str | None:
+        """
+        Which limit a failed batch ran into, going by how it exited and what
+        it used; None if it just failed.
+        """
+        if self.limits is None:
+            return None
+        if self.cpu_limit is not None:
+            # SIGKILL comes from the hard limit, if SIGXCPU was ignored; but
+            # only counts if it had used the CPU, rather than being killed
+            # by something else
+            cpu = usage.user + usage.system
+            if returncode == -signal.SIGXCPU or (returncode == -signal.SIGKILL and cpu >= self.cpu_limit):
+                return f"used more than the cpu_limit of {self.cpu_limit}s"
+        if self.memory_limit is not None and usage.max_rss_kb >= self.memory_limit * 1024 * MEMORY_LIMIT_NEAR:
+            return f"used more than the memory_limit of {self.memory_limit} MiB"
+        return None
+
+    def project_results(self) -> Iterable[tuple[str, list[Modified], Finished]]:
+        """(project path, changes, finished) for each of `project_paths`, once the run is done."""
+        if self.cancelled:
+            # This should also encompass exit codes other than 0 and 99
+            for project_path in self.project_paths:
+                yield project_path, [], Finished(self.prefixed_name, RuleStatus.ERROR, self.cancel_reason)
+        else:
+            yield self.match_prefix, *self.compute_diff_messages()
 
     def compute_diff_messages(self) -> tuple[list[Modified], Finished]:
         assert not self.cancelled
         assert self.outputs_final
+        return self._diff_messages(sorted(set(self.accepted_state) | set(self.output_state)), self.batch_messages.items())
+
+    def _diff_messages(
+        self,
+        keys: Iterable[str],
+        batch_messages: Iterable[tuple[tuple[tuple[str, int], ...], tuple[str, int, dict[str, Any] | None]]],
+    ) -> tuple[list[Modified], Finished]:
         assert self.index is not None
 
         changes: list[Modified] = []
-        for k in sorted(set(self.accepted_state) | set(self.output_state)):
+        for k in keys:
             if k in self.accepted_state and k in self.output_state:
                 # Diff but be careful of erasures...
                 a = self.accepted_state[k].value
@@ -312,7 +726,7 @@ class GenericPreparedStep(Step[str, bytes | Erasure]):
         disclaimer = None
         rc = set()
         metadata: dict[str, Any] | None = None
-        for key_generations, v in self.batch_messages.items():
+        for key_generations, v in batch_messages:
             if all(self.output_state[k].gens[self.index] == g for k, g in key_generations):
                 # Keep, fully applies!
                 msgs.append(v[0])
@@ -350,6 +764,175 @@ class GenericPreparedStep(Step[str, bytes | Erasure]):
         )
 
 
+class _PendingBatch:
+    """A batch whose processes a `Supervisor` is running."""
+
+    def __init__(self, gen: int, notifications: list[Notification[str, bytes | Erasure]], slots: list[SlotPool]) -> None:
+        self.gen = gen
+        self.notifications = notifications
+        #: Held until the batch is finished
+        self.slots = slots
+        self.batches: list[_ProjectBatch] = []
+        self.futures: list[Future[ProcessResult]] = []
+        #: Why it couldn't be started, if it couldn't
+        self.error = ""
+
+
+class _ProjectBatch:
+    """The files from one project in a batch, and where its command runs."""
+
+    def __init__(self, project_path: str, notifications: list[Notification[str, bytes | Erasure]]) -> None:
+        self.project_path = project_path
+        self.notifications = notifications
+        self._workdir = TemporaryDirectory()
+        self._output_dir = TemporaryDirectory()
+        self.workdir = self._workdir.name
+        self.output_dir = self._output_dir.name
+        self.filenames: list[str] = []
+        #: key -> our gen of it, for `batch_messages`
+        self.batch_key: dict[str, int] = {}
+        self.cmd: list[str | Path] = []
+        self.env: dict[str, str] = {}
+        self.usage = Usage()
+
+    def cleanup(self) -> None:
+        self._workdir.cleanup()
+        self._output_dir.cleanup()
+
+
+class CoalescedFileStep(GenericPreparedStep):
+    """
+    One step for a file-scoped rule's files in many projects.
+
+    Each file belongs to the deepest of `projects` it's in (and none, if it's in
+    one of that project's `excluded_project_dirs`); batches can hold files from
+    several projects, and the command is run once for each of those, in the
+    project's directory, just as separate steps would.  This saves having every
+    notification go through a step per project.
+    """
+
+    def __init__(self, *, projects: Mapping[str, Sequence[str]], **kwargs: Any) -> None:
+        super().__init__(project_path="", **kwargs)
+        #: project path -> its excluded_project_dirs
+        self.projects = {path: tuple(excluded) for path, excluded in projects.items()}
+        self._common_prefix = _common_dir(self.projects)
+        #: project path -> why it was given up on; the others carry on
+        self.failed_projects: dict[str, str] = {}
+
+    @property
+    def project_paths(self) -> Sequence[str]:
+        return list(self.projects)
+
+    @property
+    def common_prefix(self) -> str:
+        return self._common_prefix
+
+    def _owner(self, key: str) -> str | None:
+        i = len(key)
+        while i >= 0:
+            i = key.rfind("/", 0, i)
+            path = key[: i + 1]
+            excluded = self.projects.get(path)
+            if excluded is not None:
+                return None if _in_dirs(key, excluded) else path
+        return None
+
+    def _by_project(
+        self, notifications: list[Notification[str, bytes | Erasure]]
+    ) -> Iterable[tuple[str, list[Notification[str, bytes | Erasure]]]]:
+        groups: dict[str, list[Notification[str, bytes | Erasure]]] = {}
+        for n in notifications:
+            owner = self._owner(n.key)
+            assert owner is not None
+            groups.setdefault(owner, []).append(n)
+        for project_path, group in groups.items():
+            if all(n.state.value is ERASURE for n in group):
+                # Nothing left to give the command
+                continue
+            yield project_path, group
+
+    def _fail_project(self, project_path: str, reason: str) -> None:
+        """
+        Gives up on just `project_path`, undoing what was done to its files as
+        `cancel` does for a whole step, so that it's reported as an error the
+        way a step of its own would have been.
+        """
+        LOG.info("Cancel %s in %r", reason, project_path)
+        with self.state_lock:
+            if self.cancelled or self.outputs_final or project_path in self.failed_projects:
+                return
+            self.failed_projects[project_path] = reason
+            new_gen = next(self.gen_counter)
+            for k, state in list(self.output_state.items()):
+                if self._owner(k) != project_path:
+                    continue
+                if k in self.accepted_state:
+                    state = self.accepted_state[k]
+                    reverted = state.with_changes(gens=self.update_generations(state.gens, new_gen))
+                else:
+                    reverted = state.with_changes(gens=self.update_generations(state.gens, new_gen), value=ERASURE)
+                self.output_state[k] = reverted
+                self.output_notifications.append(Notification(key=k, state=reverted))
+
+    def _project_failed(self, project_path: str) -> bool:
+        return self.cancelled or project_path in self.failed_projects
+
+    def project_results(self) -> Iterable[tuple[str, list[Modified], Finished]]:
+        if self.cancelled:
+            yield from super().project_results()
+            return
+        assert self.outputs_final
+        keys: dict[str, list[str]] = {path: [] for path in self.projects}
+        for k in sorted(set(self.accepted_state) | set(self.output_state)):
+            owner = self._owner(k)
+            assert owner is not None
+            keys[owner].append(k)
+        messages: dict[str, list[tuple[tuple[tuple[str, int], ...], tuple[str, int, dict[str, Any] | None]]]] = {
+            path: [] for path in self.projects
+        }
+        for key_generations, v in self.batch_messages.items():
+            owner = self._owner(key_generations[0][0])
+            assert owner is not None
+            messages[owner].append((key_generations, v))
+        for project_path in self.projects:
+            if project_path in self.failed_projects:
+                yield project_path, [], Finished(self.prefixed_name, RuleStatus.ERROR, self.failed_projects[project_path])
+            else:
+                yield project_path, *self._diff_messages(keys[project_path], messages[project_path])
+
+
+def nested_project_dirs(projects: Iterable[Any]) -> dict[str, tuple[str, ...]]:
+    """Each project's path -> the paths of the projects nested in it."""
+    nested: dict[str, list[str]] = {p.subdir: [] for p in projects}
+    for path in nested:
+        i = len(path) - 1
+        while i > 0:
+            i = path.rfind("/", 0, i)
+            parent = nested.get(path[: i + 1])
+            if parent is not None:
+                parent.append(path)
+    return {path: tuple(sorted(inner)) for path, inner in nested.items()}
+
+
+def _decode(output: bytes) -> str:
+    # Most batches print nothing, so this is usually free
+    return output.decode("utf-8", errors="replace") if output else ""
+
+
+def _in_dirs(key: str, dirs: Iterable[str]) -> bool:
+    for d in dirs:
+        d = d.rstrip("/")
+        if key == d or key.startswith(f"{d}/"):
+            return True
+    return False
+
+
+def _common_dir(paths: Iterable[str]) -> str:
+    """The longest directory (with a trailing slash, or "") that all of `paths` are in."""
+    common = os.path.commonprefix(list(paths))
+    return common[: common.rfind("/") + 1]
+
+
 def analyze_dir(directory: str, expected: Mapping[str, bytes | Erasure]) -> tuple[set[str], set[str], set[str]]:
     # TODO dicts?
     changed = set()
@@ -410,6 +993,45 @@ def match_prefix_patterns(filename: str, prefix: str, patterns: Sequence[str]) -
     return None
 
 
+def _has_magic(pat: str) -> bool:
+    return any(c in pat for c in "*?[")
+
+
+def _literal_ends(pat: str) -> tuple[str, str]:
+    """The literal text before the first, and after the last, wildcard in `pat`."""
+    start = min(pat.index(c) for c in "*?[" if c in pat)
+    end = max(pat.rindex(c) for c in "*?[]" if c in pat)
+    return pat[:start], pat[end + 1 :]
+
+
+def _pattern_pair_may_overlap(a: str, b: str) -> bool:
+    # Compare just the last component, which a pattern without a slash is
+    # matched against (see `_pattern_matches`), and is the end of the path
+    # otherwise.  That's enough to tell e.g. "*.py" and "pyproject.toml" apart.
+    a = a.rsplit("/", 1)[-1]
+    b = b.rsplit("/", 1)[-1]
+    if not _has_magic(a):
+        return fnmatch(a, b) if _has_magic(b) else a == b
+    if not _has_magic(b):
+        return fnmatch(b, a)
+    a_start, a_end = _literal_ends(a)
+    b_start, b_end = _literal_ends(b)
+    return (a_start.startswith(b_start) or b_start.startswith(a_start)) and (a_end.endswith(b_end) or b_end.endswith(a_end))
+
+
+def patterns_may_overlap(a_prefix: str, a_patterns: Sequence[str], b_prefix: str, b_patterns: Sequence[str]) -> bool:
+    """
+    Whether some file might match both `match_prefix_patterns(..., a_prefix, a_patterns)`
+    and `match_prefix_patterns(..., b_prefix, b_patterns)`.
+
+    This errs on the side of True; False means they certainly can't.
+    """
+    if not (a_prefix.startswith(b_prefix) or b_prefix.startswith(a_prefix)):
+        # Different projects
+        return False
+    return any(_pattern_pair_may_overlap(a, b) for a in a_patterns for b in b_patterns)
+
+
 class BaseRule:
     def __init__(self, rule_config: RuleConfig) -> None:
         self.rule_config = rule_config
@@ -447,12 +1069,94 @@ class BaseRule:
         """
         return True  # no setup required
 
+    def prepare_key(self) -> Hashable | None:
+        """
+        Identifies what `prepare()` sets up, if that's worth doing ahead of time.
+
+        When testing, rules that share a key are prepared once, by one worker,
+        before their tests start, rather than every test's worker blocking in
+        `prepare()` at once.  None (the default) means `prepare()` is cheap.
+        """
+        return None
+
+    def fingerprint_paths(self) -> Sequence[Path]:
+        """
+        Files, other than the rule config, whose contents decide what this rule does.
+
+        Cached test results for the rule are reused until one of these (or the
+        config) changes.  Since a rule's command may run anything from the
+        rule repo, this is every file in the rule's directory (and below, less
+        the tests, which are cached on their own, and directories with rules of
+        their own); impls that know exactly what they run can narrow it.
+        """
+        if self.rule_config.script_path is None:
+            return ()
+        rule_dir = self.rule_config.script_path.parent
+        paths: list[Path] = []
+        for dirpath, dirnames, filenames in os.walk(rule_dir):
+            if dirpath != str(rule_dir) and any(name in filenames for name in RULE_CONFIG_NAMES):
+                # Other rules, which can be a whole repo's worth when this one's at the root
+                dirnames[:] = []
+                continue
+            dirnames[:] = [d for d in dirnames if not d.startswith(".") and d not in ("__pycache__", "tests")]
+            paths.extend(Path(dirpath, name) for name in filenames)
+        return paths
+
+    def step_options(self) -> dict[str, Any]:
+        """Keyword arguments for `GenericPreparedStep` about how and when its batches run."""
+        return {
+            "order": self.rule_config.order,
+            "urgency": self.rule_config.urgency,
+            "outputs": self.rule_config.outputs,
+            "concurrency": self.rule_config.concurrency or self.rule_config.impl,
+            "timeout": self.rule_config.timeout,
+            "cpu_limit": self.rule_config.cpu_limit,
+            "memory_limit": self.rule_config.memory_limit,
+        }
+
+    def relevant_projects(self, projects: Sequence[Any]) -> Sequence[Any]:
+        """
+        The `projects` of one of the rule's `project_types` (all of them, if it
+        doesn't say), so that there are no steps for the others.
+        """
+        types = self.rule_config.project_types
+        if types is None:
+            return projects
+        relevant = [p for p in projects if p.typ in types]
+        if len(relevant) < len(projects):
+            LOG.log(
+                VLOG_1,
+                "Skipping %d of %d projects for %s, which only applies to %s",
+                len(projects) - len(relevant),
+                len(projects),
+                self.rule_config.prefixed_name,
+                ", ".join(types),
+            )
+        return relevant
+
     def add_steps_to_run(self, projects: Any, env: Mapping[str, str], run: Run[str, bytes | Erasure]) -> None:
         prefixed_name = self.rule_config.prefixed_name
+        relevant = self.relevant_projects(projects)
 
-        if self.rule_config.scope == Scope.FILE:
-            for p in projects:
-                excluded_project_dirs = tuple(q.subdir for q in projects if q.subdir != p.subdir and q.subdir.startswith(p.subdir))
+        nested = nested_project_dirs(projects)
+
+        if self.rule_config.scope == Scope.FILE and len(relevant) > COALESCE_PROJECTS:
+            LOG.log(VLOG_1, "Coalescing %s's steps for %d projects", prefixed_name, len(relevant))
+            run.add_step(
+                CoalescedFileStep(
+                    prefixed_name=prefixed_name,
+                    patterns=self.rule_config.inputs,  # Don't default, let it raise
+                    projects={p.subdir: nested[p.subdir] for p in relevant},
+                    cmdline=self.command_parts,
+                    extra_env={**env, **self.command_env},
+                    append_filenames=True,
+                    rule_prepare=self.prepare,
+                    batch_size=self.rule_config.batch_size,
+                    **self.step_options(),
+                )
+            )
+        elif self.rule_config.scope == Scope.FILE:
+            for p in relevant:
                 run.add_step(
                     GenericPreparedStep(
                         prefixed_name=prefixed_name,
@@ -462,8 +1166,9 @@ class BaseRule:
                         extra_env={**env, **self.command_env},
                         append_filenames=True,
                         rule_prepare=self.prepare,
-                        excluded_project_dirs=excluded_project_dirs,
+                        excluded_project_dirs=nested[p.subdir],
                         batch_size=self.rule_config.batch_size,
+                        **self.step_options(),
                     )
                 )
         elif self.rule_config.scope == Scope.PROJECT:
@@ -471,8 +1176,7 @@ class BaseRule:
             # same file multiple times; but that's better than not handling
             # project-relative paths.  There's some work to do here once they
             # can nest.
-            for p in projects:
-                excluded_project_dirs = tuple(q.subdir for q in projects if q.subdir != p.subdir and q.subdir.startswith(p.subdir))
+            for p in relevant:
                 run.add_step(
                     GenericPreparedStep(
                         prefixed_name=prefixed_name,
@@ -484,12 +1188,14 @@ class BaseRule:
                         extra_env={**env, **self.command_env},
                         append_filenames=False,
                         rule_prepare=self.prepare,
-                        excluded_project_dirs=excluded_project_dirs,
+                        excluded_project_dirs=nested[p.subdir],
                         eager=False,
                         batch_size=-1,
+                        **self.step_options(),
                     )
                 )
-        else:  # REPO
+        elif relevant or self.rule_config.project_types is None:
+            # REPO, unless none of the projects are the right type
             run.add_step(
                 GenericPreparedStep(
                     prefixed_name=prefixed_name,
@@ -503,5 +1209,6 @@ class BaseRule:
                     rule_prepare=self.prepare,
                     eager=False,
                     batch_size=-1,
+                    **self.step_options(),
                 )
             )
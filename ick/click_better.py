@@ -1,7 +1,67 @@
 from __future__ import annotations
 
+import functools
+import importlib
+from typing import TYPE_CHECKING, Any
+
 import click
 
+if TYPE_CHECKING:
+    from click.shell_completion import CompletionItem
+
+    # Only generic in newer click
+    _LazyEnumParamType = click.ParamType[Any, Any]
+    _ShardParamType = click.ParamType[tuple[int, int], Any]
+else:
+    _LazyEnumParamType = _ShardParamType = click.ParamType
+
+
+class LazyEnumChoice(_LazyEnumParamType):
+    """
+    Case-insensitive click.Choice of an Enum, which isn't imported until the
+    option is actually used (or shown in help).
+    """
+
+    name = "choice"
+
+    def __init__(self, module: str, name: str) -> None:
+        self._module = module
+        self._name = name
+
+    @functools.cached_property
+    def _choice(self) -> click.Choice[Any]:
+        return click.Choice(getattr(importlib.import_module(self._module), self._name), case_sensitive=False)
+
+    def get_metavar(self, param: click.Parameter, ctx: click.Context) -> str | None:
+        return self._choice.get_metavar(param, ctx)
+
+    def get_missing_message(self, param: click.Parameter, ctx: click.Context | None) -> str | None:
+        return self._choice.get_missing_message(param, ctx)
+
+    def convert(self, value: Any, param: click.Parameter | None, ctx: click.Context | None) -> Any:
+        return self._choice.convert(value, param, ctx)
+
+    def shell_complete(self, ctx: click.Context, param: click.Parameter, incomplete: str) -> list[CompletionItem]:
+        return self._choice.shell_complete(ctx, param, incomplete)
+
+
+class Shard(_ShardParamType):
+    """An `i/n` option value, meaning the i-th (from 1) of n shards."""
+
+    name = "i/n"
+
+    def convert(self, value: Any, param: click.Parameter | None, ctx: click.Context | None) -> tuple[int, int]:
+        if isinstance(value, tuple):
+            return value
+        index, sep, count = str(value).partition("/")
+        try:
+            i, n = int(index), int(count)
+        except ValueError:
+            self.fail(f"{value!r} is not in the form i/n", param, ctx)
+        if not sep or not 1 <= i <= n:
+            self.fail(f"{value!r} is not in the form i/n, with 1 <= i <= n", param, ctx)
+        return i, n
+
 
 class FlexibleGroup(click.Group):
     """Click Group that accepts global options after the subcommand name."""
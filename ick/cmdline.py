@@ -1,31 +1,23 @@
 from __future__ import annotations
 
-import collections
-import json
-import re
+# Imports here are kept to a minimum, and everything else is imported by the
+# subcommand that needs it, so that `ick --help` and friends start quickly.
+# tests/test_cmdline.py::test_help_imports_are_lazy keeps an eye on this.
 import sys
 from pathlib import Path
-from typing import IO, Any, Callable, Iterable, Optional
+from typing import IO, TYPE_CHECKING, Any, Callable, Iterable, Optional
 
 import click
-import keke
-from feedforward import Run
-from moreorless.click import echo_color_precomputed_diff
-from rich import print
-from vmodule import vmodule_init
-
-from ick._env_check import check_writable_dirs
-from ick.add_rule import add_rule_structure
-from ick.util import convert_path_to_python_identifiers
-from ick_protocol import RuleStatus, Scope, Urgency
-
-from ._regex_translate import rule_name_re
-from .click_better import FlexibleGroup
-from .config import RuntimeConfig, Settings, load_main_config, load_rules_config, one_repo_config
-from .git import find_repo_root
-from .project_finder import find_projects as find_projects_fn
-from .runner import HighLevelResult, Runner, _demo_done_callback, _demo_status_callback, fmt_name
-from .types_project import maybe_repo
+
+from .click_better import FlexibleGroup, LazyEnumChoice, Shard
+
+if TYPE_CHECKING:
+    from feedforward import Run
+
+    from ick_protocol import Scope, Urgency
+
+    from .runner import HighLevelResult
+    from .schedule import Priority
 
 ALLOW_LEGACY_NAME_FILTER_OPTION = "--allow-legacy-name-filter"
 
@@ -41,6 +33,7 @@ def _flatten_tags(tags: Iterable[str]) -> frozenset[str]:
 @click.option("--verbose", type=int, help="Log verbosity (unset=WARNING, 0=INFO, 1=VLOG_1, 2=VLOG_2, ..., 10=DEBUG)")
 @click.option("--vmodule", help="comma-separated logger=level values, same scheme as --verbose")
 @click.option("--trace", type=click.File(mode="w"), help="Trace output filename")
+@click.option("--profile", type=click.Path(dir_okay=False, writable=True), help="Profile ick with cProfile, saving the stats to this file")
 @click.option("--isolated-repo", is_flag=True, help="Isolate from user-level config", envvar="ICK_ISOLATED_REPO")
 @click.option("--target", default=".", help="Directory to modify")  # TODO path, existing
 @click.option("--rules-repo", help="ad-hoc rules repo to use, either a URL or directory")
@@ -51,6 +44,7 @@ def main(
     verbose: int,
     vmodule: str,
     trace: IO[str] | None,
+    profile: str | None,
     isolated_repo: bool,
     target: str,
     rules_repo: str | None,
@@ -58,23 +52,36 @@ def main(
     """
     Applier of fine source code fixes since 2025
     """
+    import keke
+
+    from ._env_check import check_writable_dirs
+    from .config import RuntimeConfig, Settings, load_main_config, load_rules_config, one_repo_config
+    from .git import find_repo_root
+    from .timings import TIMINGS, profiling
+    from .types_project import maybe_repo
+
+    TIMINGS.reset()
     verbose_init(v, verbose, vmodule)
     ctx.with_resource(keke.TraceOutput(file=trace))
+    if profile:
+        ctx.with_resource(profiling(profile))
 
     if msg := check_writable_dirs():
         raise click.ClickException(f"{msg}; ick may hang or fail")
 
     # This takes a target because rules can be defined in the target repo too
     cur = Path(target).expanduser()
-    conf = load_main_config(cur, isolated_repo=isolated_repo)
-    if rules_repo is not None:
-        rules_config = one_repo_config(rules_repo)
-    else:
-        rules_config = load_rules_config(cur, isolated_repo=isolated_repo)
-    ctx.obj = RuntimeConfig(conf, rules_config, Settings(isolated_repo=isolated_repo))
+    with TIMINGS.phase("load config"):
+        conf = load_main_config(cur, isolated_repo=isolated_repo)
+        if rules_repo is not None:
+            rules_config = one_repo_config(rules_repo)
+        else:
+            rules_config = load_rules_config(cur, isolated_repo=isolated_repo)
+        ctx.obj = RuntimeConfig(conf, rules_config, Settings(isolated_repo=isolated_repo))
 
-    repo_path = find_repo_root(cur)
-    ctx.obj.repo = maybe_repo(repo_path, ctx.with_resource)
+    with TIMINGS.phase("list repo"):
+        repo_path = find_repo_root(cur)
+        ctx.obj.repo = maybe_repo(repo_path, ctx.with_resource)
 
 
 @main.command()
@@ -83,6 +90,10 @@ def find_projects(ctx: click.Context) -> None:
     """
     Lists projects found in the current repo
     """
+    from rich import print
+
+    from .project_finder import find_projects as find_projects_fn
+
     for proj in find_projects_fn(ctx.obj.repo, ctx.obj.repo.zfiles, ctx.obj.main_config):
         print(f"{proj.subdir!r:20} ({proj.typ})")
 
@@ -105,6 +116,10 @@ def list_rules(
     """
     Lists rules applicable to the current repo
     """
+    from ick_protocol import Urgency
+
+    from .runner import Runner
+
     ctx.obj.filter_config.min_urgency = min(Urgency)  # List all urgencies unless specified by filters
     apply_filters(ctx, filters, substring, tags=_flatten_tags(tags), allow_legacy_name_filter=allow_legacy_name_filter)
     r = Runner(ctx.obj, ctx.obj.repo)
@@ -120,6 +135,21 @@ def list_rules(
 @click.option("-k", "substring", default="", help="Substring match on rule name")
 @click.option("-t", "--tag", "tags", multiple=True, help="Filter rules by tag; accepts a comma-separated list and/or repeated flags")
 @click.option("--update", is_flag=True, help="Update expected test output with actual rule output")
+@click.option("--no-cache", is_flag=True, help="Rerun tests even if they passed before and nothing they depend on has changed")
+@click.option("--since", metavar="REF", help="Only test rules affected by changes to the rule repo since this git ref")
+@click.option("-j", "--jobs", type=click.IntRange(min=0), default=0, help="Run tests in this many processes (default: threads)")
+@click.option("--shard", type=Shard(), help="Only run the i-th of n roughly equal shards of the tests, e.g. 2/4")
+@click.option("--json", "json_flag", is_flag=True, help="Outputs test results and timings json by prefixed rule name")
+@click.option(
+    "--json-file",
+    "json_file",
+    type=click.File(mode="w"),
+    default=None,
+    help="Write JSON results to a file while showing human-readable output on stdout",
+)
+@click.option("--junit-xml", type=click.Path(dir_okay=False, path_type=Path), help="Write results to a JUnit XML file")
+@click.option("--durations", type=click.IntRange(min=0), default=0, metavar="N", help="Show the N slowest tests")
+@click.option("--watch", is_flag=True, help="Keep running, and rerun the tests of rules that change")
 @click.argument("filters", nargs=-1)
 def test_rules(
     ctx: click.Context,
@@ -127,6 +157,15 @@ def test_rules(
     substring: str,
     tags: tuple[str, ...],
     update: bool,
+    no_cache: bool,
+    since: Optional[str],
+    jobs: int,
+    shard: Optional[tuple[int, int]],
+    json_flag: bool,
+    json_file: IO[str] | None,
+    junit_xml: Optional[Path],
+    durations: int,
+    watch: bool,
     filters: list[str],
 ) -> None:
     """
@@ -136,11 +175,60 @@ def test_rules(
 
     Use --update to overwrite expected output with the actual output from the
     current rule implementation. Review the changes before committing.
+
+    Tests that passed before, and whose rule and test files haven't changed
+    since, aren't rerun; use --no-cache to run them anyway.
+
+    Use --since to only test rules affected by changes since a git ref, e.g.
+    `--since origin/main` in CI.
+
+    Use --shard to split the tests across several machines; every shard
+    collects the same tests and runs its own share of them.
+
+    Use --json, --json-file, or --junit-xml for results with how long each
+    test took to set up, run, and compare, and --durations to list the
+    slowest.
+
+    Use --watch while writing a rule: after the first run, the tests of rules
+    whose script, config, or tests change are rerun until you press ctrl-c.
     """
+    from ick_protocol import Urgency
+
+    from .runner import Runner
+
     ctx.obj.filter_config.min_urgency = min(Urgency)  # Test all urgencies unless specified by filters
     apply_filters(ctx, filters, substring, tags=_flatten_tags(tags), allow_legacy_name_filter=allow_legacy_name_filter)
     r = Runner(ctx.obj, ctx.obj.repo)
-    sys.exit(r.test_rules(update=update))
+    if watch:
+        if json_flag or json_file or shard:
+            raise click.UsageError("--watch can't be used with --json, --json-file, or --shard")
+        try:
+            r.watch_tests(
+                update=update,
+                use_cache=not no_cache,
+                since=since,
+                jobs=jobs,
+                junit_xml=junit_xml,
+                durations=durations,
+            )
+        except KeyboardInterrupt:
+            pass
+        return
+    if json_flag:
+        json_file = sys.stdout
+    sys.exit(
+        r.test_rules(
+            update=update,
+            use_cache=not no_cache,
+            since=since,
+            jobs=jobs,
+            shard=shard,
+            quiet=json_flag,
+            json_file=json_file,
+            junit_xml=junit_xml,
+            durations=durations,
+        )
+    )
 
 
 @main.command()
@@ -153,14 +241,14 @@ def test_rules(
 @click.option("--inputs", multiple=True, default=None, help="List of input files and glob patterns (recommended)")
 @click.option(
     "--urgency",
-    default=Urgency.LATER,
-    type=click.Choice(Urgency, case_sensitive=False),
+    default="later",
+    type=LazyEnumChoice("ick_protocol", "Urgency"),
     help="Urgency level for the rule",
 )
 @click.option(
     "--scope",
-    default=Scope.FILE,
-    type=click.Choice(Scope, case_sensitive=False),
+    default="file",
+    type=LazyEnumChoice("ick_protocol", "Scope"),
     help="Scope of the rule",
 )
 @click.option("--description", type=str, help="Description for the rule")
@@ -180,6 +268,13 @@ def add_rule(
     rule-name (TEXT): The name of the new rule\n
     target-directory (PATH): The desired directory of the new rule.
     """
+    from rich import print
+
+    from ick_protocol import Scope
+
+    from .add_rule import add_rule_structure
+    from .util import convert_path_to_python_identifiers
+
     # TODO: Check if rule name already exists using ctx.obj
     if impl != "python":
         print("Rule structure initialization for non-python rules is not implemented yet")
@@ -220,9 +315,37 @@ def add_rule(
     default=None,
     help="Write JSON results to a file while showing human-readable output on stdout",
 )
+@click.option(
+    "--timings",
+    is_flag=True,
+    help="Show how long each rule's batches took, and what their processes used (as 'timings' in JSON output), then how long each of ick's phases took",
+)
 @click.option("--skip-update", is_flag=True, help="When loading rules from a repo, don't pull if some version already exists locally")
+@click.option(
+    "--update-ttl",
+    type=float,
+    default=300,
+    envvar="ICK_UPDATE_TTL",
+    show_default=True,
+    help="Seconds after pulling a rules repo to use it as-is; once older it's used anyway, and pulled in the background",
+)
+@click.option("--strict-update", is_flag=True, help="Always pull rules repos before running, and wait for it")
 @click.option("--emojis", is_flag=True, help="Show a waterfall of emojis as work is being done")
 @click.option("--parallelism", type=int, default=0, help="Number of parallel workers (default: auto)")
+@click.option(
+    "--processes",
+    type=int,
+    default=0,
+    help="Number of rule processes that can run at once, for rules that mostly wait on I/O (default: same as --parallelism)",
+)
+@click.option(
+    "--priority",
+    type=click.Choice(["order", "urgency"]),
+    default="order",
+    show_default=True,
+    help="With 'urgency', run more urgent rules first (within the same order) and show each rule's results as soon as it's done",
+)
+@click.option("--jobserver", "serve_jobserver", is_flag=True, help="Share ick's workers with rules that run make, as a make jobserver")
 @click.option("-k", "substring", default="", help="Substring match on rule name (including prefix)")
 @click.option("-t", "--tag", "tags", multiple=True, help="Filter rules by tag; accepts a comma-separated list and/or repeated flags")
 @click.option("-q", "--question", is_flag=True, help="Exit 1 if any rule needs work, exit 2 on errors (like make -q)")
@@ -236,9 +359,15 @@ def run(
     apply: bool,
     json_flag: bool,
     json_file: IO[str] | None,
+    timings: bool,
     skip_update: bool,
+    update_ttl: float,
+    strict_update: bool,
     emojis: bool,
     parallelism: int,
+    processes: int,
+    priority: Priority,
+    serve_jobserver: bool,
     allow_legacy_name_filter: bool,
     substring: str,
     tags: tuple[str, ...],
@@ -257,7 +386,25 @@ def run(
     filter or -k.
 
     Use --apply to apply rules' changes.
+
+    When run from make with -j, ick shares make's job slots (the recipe needs
+    a leading '+' with make before 4.4).  Use --jobserver to share ick's own
+    workers the same way with rules that run make.
+
+    Use --priority urgency to hear about urgent rules first.
     """
+    import collections
+    import dataclasses
+    import json
+
+    from moreorless.click import echo_color_precomputed_diff
+    from rich import print
+
+    from ick_protocol import RuleStatus, Urgency
+
+    from .runner import Runner, _demo_done_callback, _demo_status_callback, fmt_name
+    from .schedule import IckRun, format_eta
+    from .timings import TIMINGS
 
     num_provided = sum([dry_run, patch, apply])
     if num_provided > 1:
@@ -269,6 +416,8 @@ def run(
     ctx.obj.settings.dry_run = dry_run
     ctx.obj.settings.apply = apply
     ctx.obj.settings.skip_update = skip_update
+    ctx.obj.settings.update_ttl = 0 if strict_update else update_ttl
+    ctx.obj.settings.background_update = not strict_update
 
     if filters:
         ctx.obj.filter_config.min_urgency = min(Urgency)
@@ -285,26 +434,28 @@ def run(
     if emojis:
         status_callback = _demo_status_callback
         done_callback = _demo_done_callback
-    elif not json_flag and sys.stderr.isatty():
+    elif not json_flag and sys.stderr.isatty() and priority != "urgency":
         bar = None
 
         def progressbar_status(run: Run[Any, Any]) -> None:
             nonlocal bar
             if not bar:
-                bar = click.progressbar(length=len(run._steps), label="Running...")
+                bar = click.progressbar(length=len(run._steps), label="Running...", show_eta=False, item_show_func=lambda eta: eta)
                 ctx.with_resource(bar)
-            bar.update(run._finalized_idx)
+            bar.update(run._finalized_idx, current_item=format_eta(run.eta()) if isinstance(run, IckRun) else None)
 
         status_callback = progressbar_status
         done_callback = lambda _: print("\n")  # noqa: E731
 
-    r = Runner(ctx.obj, ctx.obj.repo, parallelism=parallelism)
+    r = Runner(ctx.obj, ctx.obj.repo, parallelism=parallelism, serve_jobserver=serve_jobserver, processes=processes, priority=priority)
     steps = r.build_steps_for_rules(
         status_callback=status_callback,
         done_callback=done_callback,
     )
 
     exit_code = 0
+    # Results that are reported as they come in, rather than all at the end
+    stream = priority == "urgency"
 
     def _collect_json_result(result: HighLevelResult, results_to_modify: dict[str, Any]) -> None:
         """Collect results into a dict for JSON output."""
@@ -319,74 +470,84 @@ def run(
             "message": result.finished.message,
             "metadata": result.finished.metadata,
         }
+        if timings:
+            output["timings"] = dataclasses.asdict(result.usage) if result.usage else None
         results_to_modify[result.rule].append(output)
 
-    if json_flag:
-        results: dict[str, Any] = collections.defaultdict(list)
-        for result in r.run_steps(steps):
-            _collect_json_result(result, results)
-            if result.finished.status == RuleStatus.ERROR:
-                exit_code = max(exit_code, 2)
-            elif result.finished.status == RuleStatus.NEEDS_WORK and question:
-                exit_code = max(exit_code, 1)
+    # Less time in run_steps' own phases, this is how long we took showing the results
+    with TIMINGS.phase("output"):
+        if json_flag:
+            results: dict[str, Any] = collections.defaultdict(list)
+            for result in r.run_steps(steps):
+                _collect_json_result(result, results)
+                if result.finished.status == RuleStatus.ERROR:
+                    exit_code = max(exit_code, 2)
+                elif result.finished.status == RuleStatus.NEEDS_WORK and question:
+                    exit_code = max(exit_code, 1)
 
-        json.dump({"results": results}, sys.stdout, indent=4, sort_keys=True)
-        sys.stdout.write("\n")
+            json.dump({"results": results}, sys.stdout, indent=4, sort_keys=True)
+            sys.stdout.write("\n")
 
-    else:
-        json_results: dict[str, Any] = collections.defaultdict(list)
-        for result in r.run_steps(steps):
-            if json_file is not None:
-                _collect_json_result(result, json_results)
-            where = f" on {result.project}" if result.project else ""
-            print(f"-> [bold]{fmt_name(result.rule)}[/bold]{where}: ", end="")
-            match result.finished.status:
-                case RuleStatus.ERROR:
-                    exit_code = max(exit_code, 2)
-                    print("[red]ERROR[/red]")
-                    lines = result.finished.message.splitlines()
-                    assert ctx.parent is not None
-                    if ctx.parent.params.get("v", 0) > 0:
-                        for line in lines:
+        else:
+            json_results: dict[str, Any] = collections.defaultdict(list)
+            for result in r.run_steps(steps, stream=stream):
+                if json_file is not None:
+                    _collect_json_result(result, json_results)
+                where = f" on {result.project}" if result.project else ""
+                print(f"-> [bold]{fmt_name(result.rule)}[/bold]{where}: ", end="")
+                match result.finished.status:
+                    case RuleStatus.ERROR:
+                        exit_code = max(exit_code, 2)
+                        print("[red]ERROR[/red]")
+                        lines = result.finished.message.splitlines()
+                        assert ctx.parent is not None
+                        if ctx.parent.params.get("v", 0) > 0:
+                            for line in lines:
+                                print("    ", line)
+                        elif lines:
+                            print("    ", lines[0])
+                            if len(lines) >= 3:
+                                print("    ", "... (pass -v for complete message)")
+                            if len(lines) > 1:
+                                print("    ", lines[-1])
+                    case RuleStatus.NEEDS_WORK:
+                        if question:
+                            exit_code = max(exit_code, 1)
+                        print("[yellow]NEEDS_WORK[/yellow]")
+                        for line in result.finished.message.splitlines():
                             print("    ", line)
-                    elif lines:
-                        print("    ", lines[0])
-                        if len(lines) >= 3:
-                            print("    ", "... (pass -v for complete message)")
-                        if len(lines) > 1:
-                            print("    ", lines[-1])
-                case RuleStatus.NEEDS_WORK:
-                    if question:
-                        exit_code = max(exit_code, 1)
-                    print("[yellow]NEEDS_WORK[/yellow]")
-                    for line in result.finished.message.splitlines():
-                        print("    ", line)
-                case RuleStatus.SUCCESS:
-                    print("[green]OK[/green]")
-                case _:  # pragma: no cover
-                    assert False, f"Unhandled status {result.finished.status}"
-
-            if patch:
-                for mod in result.modifications:
-                    if mod.diff:
-                        echo_color_precomputed_diff(mod.diff)
-            elif dry_run:
-                for mod in result.modifications:
-                    print("    ", mod.filename, mod.diffstat)
-            else:
-                assert apply
-                for mod in result.modifications:
-                    path = ctx.obj.repo.root / mod.filename
-                    if mod.new_bytes is None:
-                        path.unlink()
-                    else:
-                        path.parent.mkdir(parents=True, exist_ok=True)
-                        path.write_bytes(mod.new_bytes)
-                    print(f"   Change made: {mod.filename:30s} {mod.diffstat}")
-
-        if json_file is not None:
-            json.dump({"results": json_results}, json_file, indent=4, sort_keys=True)
-            json_file.write("\n")
+                    case RuleStatus.SUCCESS:
+                        print("[green]OK[/green]")
+                    case _:  # pragma: no cover
+                        assert False, f"Unhandled status {result.finished.status}"
+                if timings and result.usage:
+                    print("    ", f"[dim]{result.usage}[/dim]")
+
+                if patch:
+                    for mod in result.modifications:
+                        if mod.diff:
+                            echo_color_precomputed_diff(mod.diff)
+                elif dry_run:
+                    for mod in result.modifications:
+                        print("    ", mod.filename, mod.diffstat)
+                else:
+                    assert apply
+                    for mod in result.modifications:
+                        with TIMINGS.phase("apply"):
+                            path = ctx.obj.repo.root / mod.filename
+                            if mod.new_bytes is None:
+                                path.unlink()
+                            else:
+                                path.parent.mkdir(parents=True, exist_ok=True)
+                                path.write_bytes(mod.new_bytes)
+                        print(f"   Change made: {mod.filename:30s} {mod.diffstat}")
+
+            if json_file is not None:
+                json.dump({"results": json_results}, json_file, indent=4, sort_keys=True)
+                json_file.write("\n")
+
+    if timings:
+        click.echo(f"\nTime spent in each phase:\n{TIMINGS.summary()}", err=True, nl=False)
 
     if exit_code:
         sys.exit(exit_code)
@@ -410,6 +571,12 @@ def apply_filters(
     tags: Iterable[str] = (),
     allow_legacy_name_filter: bool = False,
 ) -> None:
+    import re
+
+    from ick_protocol import Urgency
+
+    from ._regex_translate import rule_name_re
+
     if substring and filters:
         raise click.UsageError("Cannot use -k together with positional filters")
     if substring and " " in substring:
@@ -445,4 +612,6 @@ def verbose_init(v: int, verbose: Optional[int], vmodule: Optional[str]) -> None
             verbose = 0  # INFO
         else:
             verbose = None  # WARNING
+    from vmodule import vmodule_init
+
     vmodule_init(verbose, vmodule)
@@ -79,6 +79,10 @@ class MainConfig(Struct):
     # set in user settings.
     repo_settings: Optional[RepoSettings] = None
 
+    # How many batches of each concurrency class (by default, a rule's impl)
+    # can run at once; classes not listed only share the overall parallelism.
+    concurrency: Optional[dict[str, int]] = None
+
     def inherit(self, less_specific_defaults: MainConfig) -> None:
         # TODO this is way more verbose than I'd like.
         # "union" semantics
@@ -101,9 +105,21 @@ class MainConfig(Struct):
         )
         self.repo_settings = self.repo_settings if self.repo_settings is not None else less_specific_defaults.repo_settings
 
+        # "override" semantics, per class
+        if self.concurrency is None or less_specific_defaults.concurrency is None:
+            self.concurrency = self.concurrency if self.concurrency is not None else less_specific_defaults.concurrency
+        else:
+            self.concurrency = {**less_specific_defaults.concurrency, **self.concurrency}
+
+
+# Each docker batch can use several cores itself
+DEFAULT_CONCURRENCY = {
+    "docker": 2,
+}
 
 DEFAULT_MAIN_CONFIG = MainConfig(
     project_root_markers=DEFAULT_PROJECT_MARKERS,
+    concurrency=DEFAULT_CONCURRENCY,
     explicit_project_dirs=None,
     skip_project_root_in_repo_root=False,
     outer_project_dirs=None,
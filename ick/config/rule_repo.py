@@ -1,47 +1,111 @@
 from __future__ import annotations
 
 import functools
+import os
+import re
+import subprocess
 import sys
 from concurrent.futures import ThreadPoolExecutor
-from glob import glob
+from hashlib import sha256
 from logging import getLogger
 from pathlib import Path
 from posixpath import dirname
-from typing import Sequence, Type
+from tempfile import NamedTemporaryFile
+from typing import TYPE_CHECKING, Any, Callable, Optional, Sequence, Type
 
 from keke import ktrace
-from msgspec import ValidationError
+from msgspec import DecodeError, Struct, ValidationError
 from msgspec.json import encode as encode_json
+from msgspec.msgpack import Decoder as MsgpackDecoder
+from msgspec.msgpack import encode as encode_msgpack
 from msgspec.toml import decode as decode_toml
 from parse_errors import ParseContext
 from vmodule import VLOG_1, VLOG_2
 
-from ..base_rule import BaseRule
+from .._regex_translate import literal_prefixes, may_start_with
 from ..git import local_cache_path, update_local_cache
-from . import PyprojectRulesConfig, RuleConfig, RuleRepoConfig, Ruleset, RuntimeConfig
+from ..sh import run_cmd
+from . import FilterConfig, PyprojectRulesConfig, RuleConfig, RuleRepoConfig, Ruleset, RuntimeConfig
+
+if TYPE_CHECKING:
+    from ..base_rule import BaseRule
 
 LOG = getLogger(__name__)
 
+#: Names of files that can define rules, in the order they are loaded.
+RULE_CONFIG_NAMES = ("ick.toml", "ick.toml.local", "pyproject.toml")
+
+#: Bump this whenever RuleConfig or RuleRepoConfig change shape, so that stale
+#: catalog cache entries are ignored rather than misinterpreted.
+CATALOG_CACHE_VERSION = 2
+
+
+class RuleSelector:
+    """
+    Answers, as early as possible, whether rules could be chosen by a `FilterConfig`.
+
+    Names are matched with both the new (`full_name`) and legacy (slash-joined
+    `prefixed_name`) patterns, because the caller decides later which of those
+    is used.  Only the literal prefix of each pattern is used for pruning
+    rulesets and directories, so that is conservative; `matches` is exact.
+    """
+
+    def __init__(self, filter_config: FilterConfig) -> None:
+        self.filter_config = filter_config
+        # A `full_name` never contains the prefix separator
+        self.new_prefixes = [p for p in literal_prefixes(filter_config.name_filter_re) if ":" not in p]
+        self.legacy_prefixes = literal_prefixes(filter_config.legacy_name_filter_re)
+        self._new_match = re.compile(filter_config.name_filter_re).fullmatch
+        self._legacy_match = re.compile(filter_config.legacy_name_filter_re).fullmatch
+
+    def may_match_base(self, prefix: str, base: str) -> bool:
+        """
+        Whether any rule defined in `base` (a directory relative to the root of
+        a ruleset with `prefix`, ending in a slash) could match.
+        """
+        legacy_base = (prefix + "/" if prefix not in ("", ".") else "") + base
+        return may_start_with(self.new_prefixes, base) or may_start_with(self.legacy_prefixes, legacy_base)
+
+    def matches(self, rule: RuleConfig) -> bool:
+        if rule.urgency < self.filter_config.min_urgency:
+            return False
+        if self.filter_config.tags and not set(rule.tags) & set(self.filter_config.tags):
+            return False
+        return bool(self._new_match(rule.full_name) or self._legacy_match(rule.prefixed_name.replace(":", "/")))
+
 
 @ktrace()
-def discover_rules(rtc: RuntimeConfig) -> Sequence[RuleConfig]:
+def discover_rules(rtc: RuntimeConfig, filter_config: Optional[FilterConfig] = None) -> Sequence[RuleConfig]:
     """
     Returns list of rules in the order that they would be applied.
 
-    It is the responsibility of the caller to filter and handle things like
-    project-level ignores.
+    If `filter_config` is given, rulesets and rule configs that can't contain a
+    matching rule are never updated or loaded, and only rules that match it
+    (by either the new or legacy name pattern) are returned.  It is still the
+    responsibility of the caller to pick between those name patterns and
+    handle things like project-level ignores.
     """
     rules: list[RuleConfig] = []
 
+    selector = RuleSelector(filter_config) if filter_config is not None else None
     skip_update = rtc.settings.skip_update
-    rulesets_list = list(rtc.rules_config.ruleset)
-    for ruleset in rulesets_list:
+    rulesets_list = []
+    for ruleset in rtc.rules_config.ruleset:
+        if selector is not None and not selector.may_match_base(ruleset.prefix or "", ""):
+            LOG.log(VLOG_1, "Skipping %s, no rules can match", ruleset)
+            continue
         LOG.log(VLOG_1, "Processing %s", ruleset)
+        rulesets_list.append(ruleset)
 
     # Update all remote caches in parallel first, so that file loading never
     # races with a git pull on the same working tree.  The FileLock in
     # update_local_cache serialises any duplicate URLs naturally.
-    _update = functools.partial(maybe_update_local_cache, skip_update=skip_update)
+    _update = functools.partial(
+        maybe_update_local_cache,
+        skip_update=skip_update,
+        ttl=rtc.settings.update_ttl,
+        background=rtc.settings.background_update,
+    )
     with ThreadPoolExecutor(max_workers=10) as executor:
         futures = [(r, executor.submit(_update, r)) for r in rulesets_list]
 
@@ -54,7 +118,8 @@ def discover_rules(rtc: RuntimeConfig) -> Sequence[RuleConfig]:
 
         # Note: We want all of the map to finish before we do any of the loading below.
 
-        load_futures = [(r, executor.submit(load_rule_repo, r)) for r in rulesets_list]
+        _load = load_rule_repo if selector is None else functools.partial(load_rule_repo, selector=selector)
+        load_futures = [(r, executor.submit(_load, r)) for r in rulesets_list]
 
     # Prefixes should be unique; they override here
     rulesets: dict[str, RuleRepoConfig] = {}
@@ -67,36 +132,201 @@ def discover_rules(rtc: RuntimeConfig) -> Sequence[RuleConfig]:
     for k, v in rulesets.items():
         rules.extend(v.rule)
 
+    if selector is not None:
+        rules = [r for r in rules if selector.matches(r)]
+
     rules.sort(key=lambda h: (h.order, h.prefixed_name))
 
     return rules
 
 
 @ktrace("ruleset.url", "ruleset.path")
-def maybe_update_local_cache(ruleset: Ruleset, *, skip_update: bool) -> None:
+def maybe_update_local_cache(ruleset: Ruleset, *, skip_update: bool, ttl: float = 0, background: bool = False) -> None:
     if ruleset.url:
-        update_local_cache(ruleset.url, skip_update=skip_update)
+        update_local_cache(ruleset.url, skip_update=skip_update, ttl=ttl, background=background)
 
 
-@ktrace("ruleset.url", "ruleset.path")
-def load_rule_repo(ruleset: Ruleset) -> RuleRepoConfig:
+class CatalogEntry(Struct):
+    """
+    A cached, fully resolved `RuleRepoConfig` for one ruleset.
+
+    For rulesets from a url, `fingerprint` is the HEAD sha of the cached
+    checkout.  For local paths it's a hash of the stat info of `stat_paths`,
+    which are all the directories that were searched plus the config files that
+    were found, so that adding, removing, or editing any of them is noticed
+    without having to glob or decode anything.
+    """
+
+    version: int
+    key: str
+    fingerprint: str
+    config: RuleRepoConfig
+    stat_paths: list[str] = []
+
+
+def _enc_hook(obj: Any) -> Any:
+    if isinstance(obj, Path):
+        return str(obj)
+    raise NotImplementedError(f"Objects of type {type(obj)} are not supported")
+
+
+def _dec_hook(typ: type, obj: Any) -> Any:
+    if typ is Path:
+        return Path(obj)
+    raise NotImplementedError(f"Objects of type {typ} are not supported")
+
+
+# msgspec works out how to decode a type the first time it's used, and doing
+# that from several threads at once can crash the interpreter.  Making the
+# decoders here does it once, at import time, before discover_rules loads
+# rulesets in parallel.
+_CATALOG_DECODER = MsgpackDecoder(CatalogEntry, dec_hook=_dec_hook)
+MsgpackDecoder(PyprojectRulesConfig)
+
+
+def _ruleset_repo_path(ruleset: Ruleset) -> Path:
     if ruleset.url:
         # TODO config for a subdir within?
-        # This never updates for you, that is in the function above.
-        repo_path = local_cache_path(ruleset.url)
+        # This never updates for you, that is in maybe_update_local_cache.
+        return local_cache_path(ruleset.url)
+    assert isinstance(ruleset.path, str)
+    return Path(ruleset.base_path or "", ruleset.path).resolve()
+
+
+def _catalog_key(ruleset: Ruleset, repo_path: Path) -> str:
+    return f"{ruleset.prefix}\0{ruleset.url or ''}\0{repo_path}"
+
+
+def _catalog_cache_path(key: str) -> Path:
+    import platformdirs
+
+    cache_dir = Path(platformdirs.user_cache_dir("ick", "advice-animal")).expanduser()
+    return cache_dir / "catalog" / f"{sha256(key.encode()).hexdigest()[:16]}.msgpack"
+
+
+def _head_sha(repo_path: Path) -> Optional[str]:
+    try:
+        return run_cmd(["git", "rev-parse", "HEAD"], cwd=repo_path).strip()
+    except (OSError, subprocess.CalledProcessError) as e:
+        LOG.log(VLOG_1, "Unable to find HEAD of %s, falling back to stat: %s", repo_path, e)
+        return None
+
+
+def _stat_fingerprint(repo_path: Path, stat_paths: Sequence[str]) -> str:
+    h = sha256()
+    for rel in stat_paths:
+        try:
+            st = os.stat(Path(repo_path, rel))
+        except OSError:
+            h.update(f"{rel}\0missing\n".encode())
+        else:
+            h.update(f"{rel}\0{st.st_mtime_ns}\0{st.st_size}\n".encode())
+    return h.hexdigest()
+
+
+def _read_catalog(cache_path: Path, key: str) -> Optional[CatalogEntry]:
+    try:
+        data = cache_path.read_bytes()
+    except OSError:
+        return None
+    try:
+        entry = _CATALOG_DECODER.decode(data)
+    except (DecodeError, ValidationError) as e:
+        LOG.log(VLOG_1, "Ignoring unreadable rule catalog cache %s: %s", cache_path, e)
+        return None
+    if entry.version != CATALOG_CACHE_VERSION or entry.key != key:
+        return None
+    return entry
+
+
+def _write_catalog(cache_path: Path, entry: CatalogEntry) -> None:
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so that concurrent runs never see a partial file.
+        with NamedTemporaryFile(dir=cache_path.parent, prefix=cache_path.name, delete=False) as f:
+            f.write(encode_msgpack(entry, enc_hook=_enc_hook))
+        os.replace(f.name, cache_path)
+    except OSError as e:
+        LOG.log(VLOG_1, "Unable to write rule catalog cache %s: %s", cache_path, e)
+
+
+def find_rule_configs(repo_path: Path, want_dir: Optional[Callable[[str], bool]] = None) -> tuple[list[str], list[str]]:
+    """
+    Find the files that might define rules in a rule repo.
+
+    Returns a pair of (config filenames, directories searched), both relative
+    to `repo_path` and using forward slashes.  Directories named `tests` hold
+    test fixtures and are never searched, nor are hidden directories.  If
+    `want_dir` is given, it's called with the slash-terminated relative path of
+    each subdirectory, and ones it returns false for are not searched.
+    """
+    # We walk the filesystem here because it might not be from a git repo, or
+    # that repo might be modified.  It also will let us more easily refer to a
+    # subdir in the future.
+    found: dict[str, list[str]] = {name: [] for name in RULE_CONFIG_NAMES}
+    searched: list[str] = []
+    for dirpath, dirnames, filenames in os.walk(repo_path, followlinks=True):
+        rel = Path(dirpath).relative_to(repo_path).as_posix()
+        base = "" if rel == "." else rel + "/"
+        searched.append(rel)
+        dirnames[:] = [d for d in dirnames if d != "tests" and not d.startswith(".") and (want_dir is None or want_dir(base + d + "/"))]
+        for name in RULE_CONFIG_NAMES:
+            if name in filenames:
+                found[name].append(base + name)
+    return [f for name in RULE_CONFIG_NAMES for f in found[name]], searched
+
+
+@ktrace("ruleset.url", "ruleset.path")
+def load_rule_repo(ruleset: Ruleset, selector: Optional[RuleSelector] = None) -> RuleRepoConfig:
+    """
+    Load all the rules in a ruleset, using the catalog cache when it's current.
+
+    On a cache miss with a `selector`, directories that can't define a matching
+    rule are skipped; the result then may be missing rules, and isn't cached.
+    """
+    repo_path = _ruleset_repo_path(ruleset)
+    key = _catalog_key(ruleset, repo_path)
+    cache_path = _catalog_cache_path(key)
+
+    head = _head_sha(repo_path) if ruleset.url else None
+    entry = _read_catalog(cache_path, key)
+    if entry is not None:
+        if head is not None:
+            current = head
+        else:
+            current = _stat_fingerprint(repo_path, entry.stat_paths)
+        if entry.fingerprint == current:
+            LOG.log(VLOG_1, "Loaded rules for %s from catalog cache %s", repo_path, cache_path)
+            return entry.config
+
+    pruned: list[str] = []
+
+    def want_dir(base: str) -> bool:
+        assert selector is not None
+        if selector.may_match_base(ruleset.prefix or "", base):
+            return True
+        pruned.append(base)
+        return False
+
+    configs, searched = find_rule_configs(repo_path, want_dir if selector is not None else None)
+    rc = _load_rule_configs(ruleset, repo_path, configs)
+    if pruned:
+        LOG.log(VLOG_1, "Skipped loading %s from %s, no rules can match", pruned, repo_path)
+        return rc
+
+    if head is not None:
+        entry = CatalogEntry(CATALOG_CACHE_VERSION, key, head, rc)
     else:
-        assert isinstance(ruleset.path, str)
-        repo_path = Path(ruleset.base_path or "", ruleset.path).resolve()
+        stat_paths = searched + configs
+        entry = CatalogEntry(CATALOG_CACHE_VERSION, key, _stat_fingerprint(repo_path, stat_paths), rc, stat_paths)
+    _write_catalog(cache_path, entry)
+    return rc
+
 
+def _load_rule_configs(ruleset: Ruleset, repo_path: Path, potential_configs: Sequence[str]) -> RuleRepoConfig:
     rc = RuleRepoConfig(repo_path=repo_path)
 
     LOG.log(VLOG_1, "Loading rules from %s", repo_path)
-    # We use a regular glob here because it might not be from a git repo, or
-    # that repo might be modified.  It also will let us more easily refer to a
-    # subdir in the future.
-    potential_configs = [f for f in glob("**/ick.toml", root_dir=repo_path, recursive=True) if "tests" not in Path(f).parts]
-    potential_configs += [f for f in glob("**/ick.toml.local", root_dir=repo_path, recursive=True) if "tests" not in Path(f).parts]
-    potential_configs += [f for f in glob("**/pyproject.toml", root_dir=repo_path, recursive=True) if "tests" not in Path(f).parts]
     for filename in potential_configs:
         p = Path(repo_path, filename)
         LOG.log(VLOG_1, "Config found at %s", filename)
@@ -149,6 +379,10 @@ def load_regular(p: Path, data: bytes) -> RuleRepoConfig:
 
 @ktrace("rule.impl")
 def get_impl(rule: RuleConfig) -> Type[BaseRule]:
+    # Rule impls (and what they import) are only loaded once a rule using
+    # them is actually selected.
+    from ..base_rule import BaseRule
+
     name = f"ick.rules.{rule.impl}"
     name = name.replace("-", "_")
     __import__(name)
@@ -6,7 +6,7 @@ from __future__ import annotations
 
 from logging import getLogger
 from pathlib import Path
-from typing import Optional, Sequence
+from typing import Literal, Optional, Sequence
 
 from keke import ktrace
 from msgspec import Struct, ValidationError, field
@@ -109,7 +109,11 @@ class RuleConfig(Struct):
     full_name: str = ""  # subdir + name, e.g. "python/move_isort_cfg" — prefix excluded
     prefixed_name: str = ""  # user prefix + ':' + full_name, e.g. "rule:python/move_isort_cfg"
 
-    batch_size: int = 10
+    batch_size: int | Literal["auto"] = 10  # "auto" picks sizes from measured per-process and per-file cost
+    concurrency: Optional[str] = None  # Shares the slots of this class, see MainConfig.concurrency; defaults to impl
+    timeout: Optional[float] = None  # Wall-clock seconds, per batch
+    cpu_limit: Optional[float] = None  # CPU seconds, per batch
+    memory_limit: Optional[int] = None  # MiB of address space, per batch
     inputs: Optional[Sequence[str]] = None
     outputs: Optional[Sequence[str]] = None
     extra_inputs: Optional[Sequence[str]] = None
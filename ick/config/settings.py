@@ -10,6 +10,8 @@ from ick_protocol import Risk, Urgency
 class Settings(Struct):
     """
     skip_update: When loading rules from a repo, don't pull if some version already exists locally
+    update_ttl: Seconds after fetching a rules repo that it's used without fetching again
+    background_update: Once a rules repo is past its TTL, use it anyway and fetch for the next run
     """
 
     #: Intended to be explicitly set based on flags
@@ -20,6 +22,10 @@ class Settings(Struct):
     isolated_repo: bool = False
     #: Intended to be explicitly set based on flags
     skip_update: bool = False
+    #: Intended to be explicitly set based on flags
+    update_ttl: float = 0
+    #: Intended to be explicitly set based on flags
+    background_update: bool = False
 
 
 class FilterConfig(Struct):
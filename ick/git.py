@@ -1,18 +1,31 @@
 from __future__ import annotations
 
+import os
 import posixpath
 import re
+import sys
+import time
 from hashlib import sha256
 from logging import getLogger
 from pathlib import Path
+from subprocess import DEVNULL, CalledProcessError, Popen
 from urllib.parse import urlparse
 
+from vmodule import VLOG_1
+
 from .sh import run_cmd
 
 LOG = getLogger(__name__)
 
 DEFAULT_BRANCH_NAME = "main"
 
+#: Contents of the fetch stamp when a background refresh has fetched, but the
+#: working tree hasn't been updated to match yet.
+_PENDING = "pending"
+
+#: Checkouts that haven't been used in this many seconds are removed.
+UNUSED_WORKTREE_AGE = 30 * 86400
+
 
 def _is_sha(ref: str) -> bool:
     """Check if a ref looks like a git SHA (7-40 hex digits)."""
@@ -55,40 +68,261 @@ def local_cache_path(url: str) -> Path:
     return cache_dir / _get_local_cache_name(clean_url, ref)
 
 
-def update_local_cache(url: str, *, skip_update: bool, freeze: bool = False) -> Path:
+def _store_path(clean_url: str) -> Path:
+    """
+    The bare, blobless repo holding objects for every checkout of `clean_url`.
+    """
+    import platformdirs
+
+    cache_dir = Path(platformdirs.user_cache_dir("ick", "advice-animal")).expanduser()
+    return cache_dir / "stores" / (_get_local_cache_name(clean_url, DEFAULT_BRANCH_NAME) + ".git")
+
+
+def _sidecar(local_checkout: Path, suffix: str) -> Path:
+    # Not with_suffix, refs like v1.2 have dots in them.
+    return local_checkout.with_name(local_checkout.name + suffix)
+
+
+def _fetch_stamp_path(local_checkout: Path) -> Path:
+    return _sidecar(local_checkout, ".fetched")
+
+
+def _is_frozen(local_checkout: Path) -> bool:
+    # The second is where older versions kept it, in a full clone.
+    return _sidecar(local_checkout, ".freeze").exists() or (local_checkout / ".git" / "freeze").exists()
+
+
+def _is_legacy_clone(local_checkout: Path) -> bool:
+    """
+    Whether this is a full clone made by an older version, rather than a worktree.
+    """
+    return (local_checkout / ".git").is_dir()
+
+
+def _has_ref(git_dir: Path, ref: str) -> bool:
+    try:
+        run_cmd(["git", "rev-parse", "--verify", "--quiet", ref], cwd=git_dir)
+    except CalledProcessError:
+        return False
+    return True
+
+
+def _read_fetch_stamp(stamp: Path) -> tuple[float, bool]:
+    """
+    Returns (seconds since the last fetch, whether it's pending a reset).
+
+    A missing stamp (e.g. a checkout made by an older version) is infinitely old.
+    """
+    try:
+        age = time.time() - stamp.stat().st_mtime
+        pending = stamp.read_text() == _PENDING
+    except OSError:
+        return float("inf"), False
+    return age, pending
+
+
+def _write_fetch_stamp(stamp: Path, *, pending: bool, keep_mtime: bool = False) -> None:
+    try:
+        st = stamp.stat() if keep_mtime else None
+        stamp.write_text(_PENDING if pending else "")
+        if st is not None:
+            os.utime(stamp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    except OSError as e:
+        LOG.log(VLOG_1, "Unable to write %s: %s", stamp, e)
+
+
+def _spawn_refresh(url: str, ttl: float) -> None:
+    """
+    Start a detached process that fetches `url` for the next run.
+
+    It only fetches; the working tree is reset under the lock by the next
+    `update_local_cache`, so that files aren't changing while they're loaded.
+    """
+    LOG.log(VLOG_1, "Refreshing %s in the background", url)
+    try:
+        Popen(
+            [sys.executable, "-m", "ick.git", url, f"{ttl:g}"],
+            stdin=DEVNULL,
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as e:
+        LOG.warning("Unable to refresh %s in the background: %s", url, e)
+
+
+def _ensure_store(clean_url: str, store: Path) -> bool:
+    """
+    Clone the store for `clean_url` if it doesn't exist yet.  The caller holds its lock.
+
+    Returns whether it was just created (and so is up to date).
+    """
+    if store.exists():
+        return False
+    # Blobless, so that only the blobs for refs that are actually checked out
+    # get downloaded, and only once no matter how many refs use them.
+    run_cmd(["git", "clone", "--bare", "--filter=blob:none", clean_url, store])
+    # Bare clones don't have remote-tracking branches; worktrees for branches
+    # track these, same as a normal clone.
+    run_cmd(["git", "config", "remote.origin.fetch", "+refs/heads/*:refs/remotes/origin/*"], cwd=store)
+    run_cmd(["git", "fetch", "origin"], cwd=store)
+    return True
+
+
+def _add_worktree(clean_url: str, ref: str, local_checkout: Path) -> None:
+    """
+    Check out `ref` from the store for `clean_url` as a new worktree at `local_checkout`.
+    """
+    from filelock import FileLock
+
+    store = _store_path(clean_url)
+    with FileLock(store.with_suffix(".lock")):
+        fresh = _ensure_store(clean_url, store)
+        if _is_sha(ref):
+            if not _has_ref(store, f"{ref}^{{commit}}"):
+                run_cmd(["git", "fetch", "origin", ref], cwd=store)
+            run_cmd(["git", "worktree", "add", "--detach", local_checkout, ref], cwd=store)
+        else:
+            if not fresh:
+                run_cmd(["git", "fetch", "origin"], cwd=store)
+            if _has_ref(store, f"refs/remotes/origin/{ref}"):
+                # Tracks remote branch (old code expects to `git pull` in these
+                # dirs, and this allows us to share them)
+                run_cmd(["git", "worktree", "add", "-B", ref, local_checkout, f"origin/{ref}"], cwd=store)
+            else:
+                # Must be a tag, which like a SHA never gets updated
+                run_cmd(["git", "fetch", "origin", f"refs/tags/{ref}:refs/tags/{ref}"], cwd=store)
+                run_cmd(["git", "worktree", "add", "--detach", local_checkout, f"refs/tags/{ref}"], cwd=store)
+        prune_worktrees(store)
+
+
+def _fetch(clean_url: str, local_checkout: Path) -> None:
+    from filelock import FileLock
+
+    if _is_legacy_clone(local_checkout):
+        run_cmd(["git", "fetch", "origin"], cwd=local_checkout)
+        return
+    store = _store_path(clean_url)
+    with FileLock(store.with_suffix(".lock")):
+        run_cmd(["git", "fetch", "origin"], cwd=store)
+
+
+def _reset(ref: str, local_checkout: Path) -> None:
+    # Tags (and anything else without a remote-tracking branch) stay put.
+    if _has_ref(local_checkout, f"refs/remotes/origin/{ref}"):
+        run_cmd(["git", "reset", "--hard", f"origin/{ref}"], cwd=local_checkout)
+
+
+def update_local_cache(
+    url: str,
+    *,
+    skip_update: bool,
+    freeze: bool = False,
+    ttl: float = 0,
+    background: bool = False,
+) -> Path:
+    """
+    Ensure there's a checkout of `url` (which may have an `@ref` suffix) and return its path.
+
+    Checkouts are worktrees sharing one object store per url, so pinning many
+    refs of the same repo only downloads each object once.  Full clones made
+    by older versions keep working.
+
+    An existing checkout that was fetched less than `ttl` seconds ago is used
+    as-is.  Past that, it's fetched and reset before returning, unless
+    `background` is set, in which case the stale checkout is returned right
+    away and a fetch is started for the next run to pick up.
+    """
     from filelock import FileLock
 
     clean_url, ref = _split_url_ref(url)
     local_checkout = local_cache_path(url)
-    freeze_name = local_checkout / ".git" / "freeze"
+    stamp = _fetch_stamp_path(local_checkout)
     is_sha = _is_sha(ref)
     with FileLock(local_checkout.with_suffix(".lock")):
         if not local_checkout.exists():
-            # HEAD will be detached on subsequent updates (see below)
-            # TODO: consider --depth 1 since we don't need full history.
-            clone_cmd = ["git", "clone"]
-            if is_sha:
-                # For SHA refs, use --revision to clone and checkout in one step
-                clone_cmd += ["--reference-if-able", str(local_cache_path(clean_url)), f"--revision={ref}"]
-            else:
-                # For branches/tags, use single-branch optimization
-                clone_cmd += ["--single-branch", "--branch", ref]
-                if ref != DEFAULT_BRANCH_NAME:
-                    # Reuse objects from the main cache dir to save bandwidth
-                    clone_cmd += ["--reference-if-able", str(local_cache_path(clean_url))]
-            run_cmd(clone_cmd + [clean_url, local_checkout])
+            _add_worktree(clean_url, ref, local_checkout)
+            _write_fetch_stamp(stamp, pending=False)
         elif not skip_update and not is_sha:
             # SHAs are immutable and never need updating
-            if not freeze_name.exists():
-                run_cmd(["git", "fetch", "origin"], cwd=local_checkout)
-                # Tracks remote branch (old code expects to `git pull` in these
-                # dirs, and this allows us to share them)
-                run_cmd(["git", "reset", "--hard", f"origin/{ref}"], cwd=local_checkout)
+            if not _is_frozen(local_checkout):
+                age, pending = _read_fetch_stamp(stamp)
+                if age >= ttl and not background:
+                    _fetch(clean_url, local_checkout)
+                    _reset(ref, local_checkout)
+                    _write_fetch_stamp(stamp, pending=False)
+                else:
+                    if pending:
+                        # A background refresh already did the slow part
+                        _reset(ref, local_checkout)
+                        _write_fetch_stamp(stamp, pending=False, keep_mtime=True)
+                    if age >= ttl:
+                        _spawn_refresh(url, ttl)
+                    else:
+                        LOG.log(VLOG_1, "%s was fetched %.0fs ago, not updating", url, age)
         if freeze:
-            freeze_name.touch()
+            _sidecar(local_checkout, ".freeze").touch()
+        _sidecar(local_checkout, ".used").touch()
     return local_checkout
 
 
+def refresh_local_cache(url: str, *, ttl: float = 0) -> None:
+    """
+    Fetch an existing checkout without touching its working tree.
+
+    This is what `update_local_cache` runs in the background.  Several runs
+    might have started one, so this does nothing if another already finished
+    within `ttl`.
+    """
+    from filelock import FileLock
+
+    clean_url, _ = _split_url_ref(url)
+    local_checkout = local_cache_path(url)
+    stamp = _fetch_stamp_path(local_checkout)
+    with FileLock(local_checkout.with_suffix(".lock")):
+        if not local_checkout.exists() or _is_frozen(local_checkout):
+            return
+        age, _ = _read_fetch_stamp(stamp)
+        if age < ttl:
+            return
+        _fetch(clean_url, local_checkout)
+        _write_fetch_stamp(stamp, pending=True)
+
+
+def prune_worktrees(store: Path, *, max_age: float = UNUSED_WORKTREE_AGE) -> None:
+    """
+    Remove checkouts from `store` that haven't been used for `max_age` seconds.
+
+    The caller holds the store's lock.  Checkouts that are frozen, or locked
+    because they're being updated right now, are left alone.
+    """
+    from filelock import FileLock, Timeout
+
+    now = time.time()
+    for line in run_cmd(["git", "worktree", "list", "--porcelain"], cwd=store).splitlines():
+        if not line.startswith("worktree "):
+            continue
+        worktree = Path(line[len("worktree ") :])
+        if worktree == store or _is_frozen(worktree):
+            continue
+        try:
+            age = now - _sidecar(worktree, ".used").stat().st_mtime
+        except OSError:
+            continue
+        if age < max_age:
+            continue
+        try:
+            with FileLock(worktree.with_suffix(".lock"), timeout=0):
+                LOG.info("Removing %s, unused for %d days", worktree, age // 86400)
+                run_cmd(["git", "worktree", "remove", "--force", worktree], cwd=store)
+                for suffix in (".used", ".fetched"):
+                    _sidecar(worktree, suffix).unlink(missing_ok=True)
+        except Timeout:
+            pass
+    # Forget about any that were deleted by hand
+    run_cmd(["git", "worktree", "prune"], cwd=store)
+
+
 def find_repo_root(path: Path) -> Path:
     """
     Find the project root, looking upward from the given path.
@@ -111,3 +345,7 @@ def find_repo_root(path: Path) -> Path:
 
     # TODO what's the right fallback here?  I'd almost rather an exception.
     return path
+
+
+if __name__ == "__main__":
+    refresh_local_cache(sys.argv[1], ttl=float(sys.argv[2]))
@@ -0,0 +1,144 @@
+"""
+Works out which rules are affected by the changes in a rule repo since some ref.
+
+A rule is affected when any of these changed:
+
+* its entry in an `ick.toml`, `ick.toml.local`, or `pyproject.toml`
+* a file from `BaseRule.fingerprint_paths` (for python rules, the script and
+  the modules it imports from the rule repo)
+* anything under its `tests/<rule>/` directory
+
+Any other change to a config file (e.g. its `[[ruleset]]` sections) might
+affect every rule, and is reported with `ImpactUnknown`.
+"""
+
+from __future__ import annotations
+
+import subprocess
+from collections import defaultdict
+from logging import getLogger
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterable, Optional
+
+import tomllib
+from vmodule import VLOG_1
+
+from .config.rule_repo import RULE_CONFIG_NAMES
+from .sh import run_cmd
+
+if TYPE_CHECKING:
+    from .base_rule import BaseRule
+
+LOG = getLogger(__name__)
+
+
+class ImpactUnknown(Exception):
+    """Raised when the changes can't be narrowed down to particular rules."""
+
+
+def changed_files(top: Path, since: str) -> set[Path]:
+    """
+    Files under the git worktree `top` that differ from `since`, including
+    uncommitted and untracked ones.
+    """
+    try:
+        diff = run_cmd(["git", "diff", "--name-only", "--no-renames", "-z", since, "--"], cwd=top)
+        untracked = run_cmd(["git", "ls-files", "--others", "--exclude-standard", "-z"], cwd=top)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise ImpactUnknown(f"unable to diff {top} against {since!r}: {getattr(e, 'stderr', '') or e}".strip())
+    return {top / name for name in (diff + untracked).split("\0") if name}
+
+
+def _rule_tables(path: Path, text: Optional[str]) -> tuple[dict[str, Any], dict[str, Any]]:
+    """
+    Returns (rule entries by name, everything else) from a config file's text.
+    """
+    if text is None:
+        return {}, {}
+    try:
+        data = tomllib.loads(text)
+    except tomllib.TOMLDecodeError as e:
+        raise ImpactUnknown(f"unable to parse {path}: {e}")
+    if path.name == "pyproject.toml":
+        data = data.get("tool", {}).get("ick", {})
+    rules = {r.get("name"): r for r in data.pop("rule", [])}
+    return rules, data
+
+
+def _git_show(top: Path, since: str, path: Path) -> Optional[str]:
+    try:
+        return run_cmd(["git", "show", f"{since}:{path.relative_to(top).as_posix()}"], cwd=top)
+    except subprocess.CalledProcessError:
+        # Didn't exist yet
+        return None
+
+
+def changed_rule_entries(repo_path: Path, top: Path, since: str, changed: Iterable[Path]) -> set[str]:
+    """
+    Returns the `full_name` of rules whose config entries differ from `since`.
+    """
+    names: set[str] = set()
+    for path in changed:
+        if path.name not in RULE_CONFIG_NAMES or not path.is_relative_to(repo_path):
+            continue
+        rel = path.parent.relative_to(repo_path)
+        if "tests" in rel.parts:
+            # Not searched for rules, see `find_rule_configs`
+            continue
+        old_rules, old_rest = _rule_tables(path, _git_show(top, since, path))
+        new_rules, new_rest = _rule_tables(path, path.read_text() if path.exists() else None)
+        if old_rest != new_rest:
+            raise ImpactUnknown(f"shared config in {path} changed")
+        base = "" if rel == Path() else rel.as_posix() + "/"
+        for name in old_rules.keys() | new_rules.keys():
+            if old_rules.get(name) != new_rules.get(name):
+                LOG.log(VLOG_1, "Config for %s changed in %s", name, path)
+                names.add(base + str(name))
+    return names
+
+
+def _toplevel(repo_path: Path) -> Path:
+    try:
+        return Path(run_cmd(["git", "rev-parse", "--show-toplevel"], cwd=repo_path).strip())
+    except (OSError, subprocess.CalledProcessError):
+        raise ImpactUnknown(f"{repo_path} is not in a git repo")
+
+
+def impacted_rules(rules: Iterable[BaseRule], since: str) -> set[str]:
+    """
+    Returns the `prefixed_name` of each of `rules` affected by changes since `since`.
+
+    Raises `ImpactUnknown` if every rule should be considered affected.
+    """
+    by_repo: dict[Path, list[BaseRule]] = defaultdict(list)
+    for rule_instance in rules:
+        assert rule_instance.rule_config.repo_path is not None
+        by_repo[rule_instance.rule_config.repo_path.resolve()].append(rule_instance)
+
+    impacted: set[str] = set()
+    for repo_path, repo_rules in by_repo.items():
+        top = _toplevel(repo_path).resolve()
+        changed = changed_files(top, since)
+        if not changed:
+            continue
+        entries = changed_rule_entries(repo_path, top, since, changed)
+        impacted.update(r.rule_config.prefixed_name for r in repo_rules if r.rule_config.full_name in entries)
+        impacted.update(rules_using(repo_rules, changed))
+    return impacted
+
+
+def rules_using(rules: Iterable[BaseRule], changed: set[Path]) -> set[str]:
+    """
+    Returns the `prefixed_name` of each of `rules` whose implementation or tests
+    include one of the `changed` (resolved) paths.
+
+    This doesn't look at config; see `changed_rule_entries` for that.
+    """
+    used: set[str] = set()
+    for rule_instance in rules:
+        config = rule_instance.rule_config
+        assert config.test_path is not None
+        test_path = config.test_path.resolve()
+        if any(p.resolve() in changed for p in rule_instance.fingerprint_paths()) or any(p.is_relative_to(test_path) for p in changed):
+            used.add(config.prefixed_name)
+    return used
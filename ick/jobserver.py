@@ -0,0 +1,167 @@
+"""
+Shares job slots with GNU make, through its jobserver protocol.
+
+When `ick run` is started by `make -jN`, `MAKEFLAGS` says where make's tokens
+are, and ick takes one for each batch it runs (beyond the one that make gave
+ick itself) so that together they run at most N jobs.  Otherwise, with
+`--jobserver`, ick serves its own parallelism as tokens, for rules that
+themselves run make.
+
+See https://www.gnu.org/software/make/manual/html_node/Job-Slots.html
+"""
+
+from __future__ import annotations
+
+import os
+import select
+import shlex
+import shutil
+import tempfile
+import threading
+from logging import getLogger
+from typing import Optional
+
+from vmodule import VLOG_1
+
+LOG = getLogger(__name__)
+
+
+def _parse_auth(makeflags: str) -> Optional[str]:
+    auth = None
+    for word in shlex.split(makeflags):
+        # --jobserver-fds is what make before 4.2 called it; the last one wins
+        for prefix in ("--jobserver-auth=", "--jobserver-fds="):
+            if word.startswith(prefix):
+                auth = word[len(prefix) :]
+    return auth
+
+
+class Jobserver:
+    """
+    Tokens from (or for) a make jobserver, with the same `acquire`/`release`
+    as a semaphore.
+
+    Like every jobserver client, we implicitly hold one token already, so the
+    first batch at a time doesn't need to read one.
+    """
+
+    def __init__(
+        self,
+        read_fd: int,
+        write_fd: int,
+        *,
+        nonblocking: bool,
+        env: dict[str, str] | None = None,
+        pass_fds: tuple[int, ...] = (),
+        own_fds: tuple[int, ...] = (),
+        tmpdir: Optional[str] = None,
+    ) -> None:
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.nonblocking = nonblocking
+        #: Environment for child processes, so that a nested make can find us
+        self.env = env or {}
+        #: Inherited fds that child processes need to keep to use the jobserver
+        self.pass_fds = pass_fds
+        self._own_fds = own_fds
+        self._tmpdir = tmpdir
+        self._lock = threading.Lock()
+        self._implicit_free = True
+        self._tokens: list[bytes] = []
+
+    @classmethod
+    def from_makeflags(cls, makeflags: str) -> Optional[Jobserver]:
+        """
+        The jobserver described by a `MAKEFLAGS` value, or None if there isn't
+        one we can use.
+        """
+        auth = _parse_auth(makeflags)
+        if not auth:
+            return None
+        if auth.startswith("fifo:"):
+            path = auth[len("fifo:") :]
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+            except OSError as e:
+                LOG.warning("Unable to open make jobserver fifo %s, ignoring it: %s", path, e)
+                return None
+            return cls(fd, fd, nonblocking=True, own_fds=(fd,))
+        try:
+            read_fd, write_fd = (int(fd) for fd in auth.split(","))
+        except ValueError:
+            LOG.log(VLOG_1, "Unsupported make jobserver %r", auth)
+            return None
+        if read_fd < 0 or write_fd < 0:
+            # Make says there's a jobserver, but not for us
+            return None
+        try:
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+        except OSError:
+            LOG.warning("Make's jobserver fds weren't inherited; prefix the recipe line with '+' to share make's job slots")
+            return None
+        try:
+            # A separate open file description for the pipe, so that we can read
+            # without blocking and without affecting make's
+            own = os.open(f"/proc/self/fd/{read_fd}", os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return cls(read_fd, write_fd, nonblocking=False, pass_fds=(read_fd, write_fd))
+        return cls(own, write_fd, nonblocking=True, pass_fds=(read_fd, write_fd), own_fds=(own,))
+
+    @classmethod
+    def serve(cls, jobs: int) -> Jobserver:
+        """A new jobserver with `jobs` slots, for rules that run make."""
+        tmpdir = tempfile.mkdtemp(prefix="ick-jobserver-")
+        path = os.path.join(tmpdir, "fifo")
+        os.mkfifo(path, 0o600)
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        os.write(fd, b"+" * (jobs - 1))
+        env = {"MAKEFLAGS": f"-j{jobs} --jobserver-auth=fifo:{path}"}
+        return cls(fd, fd, nonblocking=True, env=env, own_fds=(fd,), tmpdir=tmpdir)
+
+    def acquire(self, blocking: bool = False) -> bool:
+        """
+        Takes a token, returning whether we got one.
+
+        Unless `blocking`, returns False right away when there are none free.
+        """
+        with self._lock:
+            if self._implicit_free:
+                self._implicit_free = False
+                return True
+        if not self.nonblocking or blocking:
+            ready, _, _ = select.select([self.read_fd], [], [], None if blocking else 0)
+            if not ready:
+                return False
+        try:
+            # If some other client won the race since select, this can block
+            # until a token is freed, but not lose one
+            token = os.read(self.read_fd, 1)
+        except (BlockingIOError, InterruptedError):
+            return False
+        if not token:
+            return False
+        with self._lock:
+            self._tokens.append(token)
+        return True
+
+    def release(self) -> None:
+        with self._lock:
+            if not self._tokens:
+                self._implicit_free = True
+                return
+            token = self._tokens.pop()
+        os.write(self.write_fd, token)
+
+    def close(self) -> None:
+        with self._lock:
+            tokens, self._tokens = self._tokens, []
+        if tokens:
+            # Shouldn't happen, but make would wait for these forever
+            os.write(self.write_fd, b"".join(tokens))
+        for fd in self._own_fds:
+            os.close(fd)
+        self._own_fds = ()
+        if self._tmpdir:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
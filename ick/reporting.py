@@ -0,0 +1,97 @@
+"""
+Machine-readable reports of `ick test-rules` results.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Sequence
+from xml.etree import ElementTree as ET
+
+if TYPE_CHECKING:
+    from .base_rule import BaseRule
+    from .runner import TestResult
+
+RuleResults = Sequence[tuple["BaseRule", Sequence["TestResult"]]]
+
+
+def short_name(result: TestResult) -> str:
+    """The test's directory, relative to the rule's tests, e.g. `change_made`."""
+    rule_test_path = result.rule_instance.rule_config.test_path
+    assert rule_test_path is not None
+    return result.test_path.relative_to(rule_test_path).as_posix()
+
+
+def display_name(result: TestResult) -> str:
+    return f"{result.rule_instance.rule_config.prefixed_name}: {short_name(result)}"
+
+
+def status(result: TestResult) -> str:
+    if result.updated:
+        return "updated"
+    elif result.cached:
+        return "cached"
+    elif result.success:
+        return "pass"
+    return "fail"
+
+
+def slowest(rule_results: RuleResults, n: int) -> list[TestResult]:
+    """The `n` tests that took longest to run; cached results didn't run, so aren't included."""
+    results = [result for _, results in rule_results for result in results if not result.cached]
+    return sorted(results, key=lambda r: r.wall_time, reverse=True)[:n]
+
+
+def results_json(rule_results: RuleResults) -> dict[str, Any]:
+    """
+    Results keyed by prefixed rule name, like `ick run --json`.
+
+    Each is a list (empty for rules without tests) of one dict per test, with
+    its status and how many seconds each part of it took.
+    """
+    rules: dict[str, Any] = {}
+    for rule_instance, results in rule_results:
+        rules[rule_instance.rule_config.prefixed_name] = [
+            {
+                "test": short_name(result),
+                "status": status(result),
+                "message": result.message,
+                "diff": result.diff,
+                "wall_time": result.wall_time,
+                "setup_time": result.setup_time,
+                "run_time": result.run_time,
+                "compare_time": result.compare_time,
+            }
+            for result in results
+        ]
+    return {"results": rules}
+
+
+def write_junit_xml(rule_results: RuleResults, path: Path) -> None:
+    """
+    Write results in the JUnit XML format that CI systems display, with one
+    testsuite per rule.
+    """
+    root = ET.Element("testsuites", name="ick test-rules")
+    for rule_instance, results in rule_results:
+        name = rule_instance.rule_config.prefixed_name
+        suite = ET.SubElement(
+            root,
+            "testsuite",
+            name=name,
+            tests=str(len(results)),
+            failures=str(sum(status(r) == "fail" for r in results)),
+            time=f"{sum(r.wall_time for r in results):.3f}",
+        )
+        for result in results:
+            case = ET.SubElement(suite, "testcase", classname=name, name=short_name(result), time=f"{result.wall_time:.3f}")
+            props = ET.SubElement(case, "properties")
+            for part in ("setup", "run", "compare"):
+                ET.SubElement(props, "property", name=f"{part}_time", value=f"{getattr(result, part + '_time'):.3f}")
+            if status(result) == "fail":
+                failure = ET.SubElement(case, "failure", message=result.message.splitlines()[0] if result.message else "failed")
+                failure.text = "\n".join(t for t in (result.traceback, result.message, result.diff) if t)
+            elif status(result) != "pass":
+                ET.SubElement(case, "system-out").text = status(result)
+    ET.indent(root)
+    ET.ElementTree(root).write(path, encoding="utf-8", xml_declaration=True)
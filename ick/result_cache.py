@@ -0,0 +1,120 @@
+"""
+Remembers which rule tests passed, so that unchanged ones needn't be rerun.
+
+A test's key covers everything that can change its result: the rule's config,
+the files it's implemented in (see `BaseRule.fingerprint_paths`), and the
+contents of the test's `input/` and `output/` trees.  Only passing results are
+recorded; a failure might have been caused by something outside of those (a
+missing tool, the network) and should be rerun to see if it's been fixed.
+"""
+
+from __future__ import annotations
+
+import functools
+import inspect
+import os
+from hashlib import sha256
+from logging import getLogger
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from msgspec.json import encode as encode_json
+from vmodule import VLOG_1
+
+if TYPE_CHECKING:
+    from .base_rule import BaseRule
+
+LOG = getLogger(__name__)
+
+#: Bump this whenever the way keys are computed changes.
+RESULT_CACHE_VERSION = 1
+
+
+@functools.cache
+def _ick_version() -> str:
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        return version("ick")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def _enc_hook(obj: Any) -> Any:
+    if isinstance(obj, Path):
+        return str(obj)
+    raise NotImplementedError(f"Objects of type {type(obj)} are not supported")
+
+
+def _update_with_file(h: Any, path: Path) -> None:
+    try:
+        h.update(path.read_bytes())
+    except OSError:
+        h.update(b"\0missing")
+
+
+def rule_fingerprint(rule_instance: BaseRule) -> str:
+    """
+    Hash of what a rule does: its config, impl, and `fingerprint_paths()`.
+    """
+    h = sha256()
+    h.update(f"{RESULT_CACHE_VERSION}\0{_ick_version()}\0".encode())
+    h.update(encode_json(rule_instance.rule_config, enc_hook=_enc_hook))
+    # The impl itself (e.g. ick/rules/pygrep.py) decides a lot of the behavior
+    h.update(b"\0impl\0")
+    _update_with_file(h, Path(inspect.getfile(type(rule_instance))))
+    for path in sorted(rule_instance.fingerprint_paths()):
+        h.update(f"\0{path}\0".encode())
+        _update_with_file(h, path)
+    return h.hexdigest()
+
+
+def tree_digest(root: Path) -> str:
+    """
+    Hash of the names and contents of everything under `root`.
+    """
+    h = sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        rel = Path(dirpath).relative_to(root).as_posix()
+        h.update(f"d\0{rel}\0".encode())
+        for name in sorted(filenames):
+            p = Path(dirpath, name)
+            if p.is_symlink():
+                h.update(f"l\0{name}\0{os.readlink(p)}\0".encode())
+            else:
+                h.update(f"f\0{name}\0{p.stat().st_size}\0".encode())
+                _update_with_file(h, p)
+    return h.hexdigest()
+
+
+def result_key(fingerprint: str, test_name: str, test_path: Path) -> str:
+    h = sha256()
+    h.update(f"{fingerprint}\0{test_name}\0".encode())
+    h.update(tree_digest(test_path / "input").encode())
+    h.update(b"\0")
+    h.update(tree_digest(test_path / "output").encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cache_dir: Path | None = None) -> None:
+        if cache_dir is None:
+            import platformdirs
+
+            cache_dir = Path(platformdirs.user_cache_dir("ick", "advice-animal")).expanduser() / "test-results"
+        self.cache_dir = cache_dir
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def passed(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def record_pass(self, key: str) -> None:
+        p = self._path(key)
+        try:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            p.touch()
+        except OSError as e:
+            LOG.log(VLOG_1, "Unable to record test result in %s: %s", p, e)
@@ -1,5 +1,6 @@
 import os
 from pathlib import Path
+from typing import Hashable
 
 import platformdirs
 
@@ -43,3 +44,6 @@ class Rule(BaseRule):
 
     def prepare(self) -> bool:
         return self.venv.prepare()
+
+    def prepare_key(self) -> Hashable | None:
+        return self.venv.env_path
@@ -1,5 +1,6 @@
 import os
 import shlex
+from typing import Hashable
 
 from ..base_rule import BaseRule
 from ..config import RuleConfig
@@ -28,3 +29,6 @@ class Rule(BaseRule):
     def prepare(self) -> bool:
         run_cmd(["docker", "pull", self.image_name], env=self.command_env)
         return True
+
+    def prepare_key(self) -> Hashable | None:
+        return ("docker", self.image_name)
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+import ast
 import os
 import textwrap
 from pathlib import Path
+from typing import Hashable, Iterable, Sequence
 
 import platformdirs
 
@@ -39,6 +41,55 @@ def path_to_module(relative_path: Path) -> str:
     return module_path
 
 
+def _module_files(repo_path: Path, module: str) -> Iterable[Path]:
+    """Yield the files in `repo_path` that importing `module` would run."""
+    parts = module.split(".")
+    for i in range(1, len(parts) + 1):
+        base = repo_path.joinpath(*parts[:i])
+        if (base / "__init__.py").is_file():
+            yield base / "__init__.py"
+        elif i == len(parts) and base.with_suffix(".py").is_file():
+            yield base.with_suffix(".py")
+
+
+def local_imports(repo_path: Path, script: Path) -> set[Path]:
+    """
+    Find the files in `repo_path` that `script` imports, transitively.
+
+    This is static, so imports done with `importlib` aren't found.
+    """
+    found: set[Path] = set()
+    todo = [script]
+    while todo:
+        path = todo.pop()
+        try:
+            tree = ast.parse(path.read_bytes(), str(path))
+        except (OSError, SyntaxError, ValueError):
+            continue
+        # For both a module and an __init__.py, this is the containing package
+        package_parts = list(path.relative_to(repo_path).parent.parts)
+        modules: list[str] = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                if node.level:
+                    base_parts = package_parts[: len(package_parts) - node.level + 1]
+                    base = ".".join(base_parts + ([node.module] if node.module else []))
+                else:
+                    base = node.module or ""
+                if base:
+                    modules.append(base)
+                # `from pkg import submodule`
+                modules.extend(f"{base}.{alias.name}" if base else alias.name for alias in node.names)
+        for module in modules:
+            for f in _module_files(repo_path, module):
+                if f not in found and f != script:
+                    found.add(f)
+                    todo.append(f)
+    return found
+
+
 class Rule(BaseRule):
     def __init__(self, rule_config: RuleConfig) -> None:
         super().__init__(rule_config)
@@ -105,3 +156,14 @@ class Rule(BaseRule):
         if not self.venv.prepare():
             return False
         return True
+
+    def prepare_key(self) -> Hashable | None:
+        return self.venv.env_path
+
+    def fingerprint_paths(self) -> Sequence[Path]:
+        if self.rule_config.data:
+            return ()
+        assert self.rule_config.script_path is not None
+        assert self.rule_config.repo_path is not None
+        py_script = self.rule_config.script_path.with_suffix(".py")
+        return [py_script, *local_imports(self.rule_config.repo_path, py_script)]
@@ -1,22 +1,26 @@
 from __future__ import annotations
 
 import collections
+import functools
 import io
 import json
+import os
 import re
-from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import ExitStack
 from dataclasses import dataclass
-from glob import glob
 from logging import getLogger
+from multiprocessing.util import Finalize
 from pathlib import Path
-from shutil import copytree, rmtree
-from tempfile import TemporaryDirectory
-from typing import Any, Callable, Iterable, Sequence
+from shutil import copyfile
+from time import perf_counter
+from typing import IO, Any, Callable, Hashable, Iterable, Sequence, TypeVar
 
 import moreorless
 from feedforward import Run, Step
 from feedforward.erasure import Erasure  # todo: export this properly from feedforward
+from feedforward.util import get_default_parallelism
 from keke import ktrace
 from moreorless import unified_diff
 from rich import print
@@ -25,14 +29,27 @@ from ick_protocol import Finished, Modified, RuleStatus
 
 from .base_rule import BaseRule, GenericPreparedStep
 from .config import RuntimeConfig
-from .config.rule_repo import discover_rules
+from .config.rule_repo import RULE_CONFIG_NAMES, discover_rules
 from .config.rule_repo import get_impl as get_impl
+from .impact import ImpactUnknown, impacted_rules, rules_using
+from .jobserver import Jobserver
 from .project_finder import find_projects
-from .types_project import BaseRepo, Project, maybe_repo
-from .util import clean_output
+from .reporting import display_name, results_json, slowest, write_junit_xml
+from .result_cache import ResultCache, result_key, rule_fingerprint
+from .schedule import URGENCIES, IckRun, Priority, TimingHistory
+from .sh import Usage
+from .supervisor import Supervisor
+from .timings import TIMINGS
+from .types_project import BaseRepo, Project, RepoPool, rule_test_repo
+from .util import FileEntry, bytes_entry, clean_output, tree_manifest
 
 LOG = getLogger(__name__)
 
+_T = TypeVar("_T")
+
+#: How often (in seconds) `run_steps(stream=True)` checks for finished steps
+STREAM_INTERVAL = 0.1
+
 
 # TODO temporary; this should go in protocol and be better typed...
 @dataclass
@@ -40,13 +57,15 @@ class HighLevelResult:
     """
     Capture the result of running ick in a structured way.
 
-    rule is the prefixed name of the rule
+    rule is the prefixed name of the rule; usage is what its batches took in
+    this project, if it ran any
     """
 
     rule: str
     project: str
     modifications: Sequence[Modified]
     finished: Finished
+    usage: Usage | None = None
 
 
 def fmt_name(name: str) -> str:
@@ -66,8 +85,16 @@ class TestResult:
     message: str = ""
     success: bool = False
     updated: bool = False
+    #: Passed last time, and nothing it depends on has changed since
+    cached: bool = False
     diff: str = ""
     traceback: str = ""
+    #: Seconds spent on the whole test, and on making its repo and steps,
+    #: running the rule, and checking (or with --update, writing) the output
+    wall_time: float = 0.0
+    setup_time: float = 0.0
+    run_time: float = 0.0
+    compare_time: float = 0.0
 
 
 class ErrorRule(BaseRule):
@@ -93,12 +120,127 @@ class ErrorRule(BaseRule):
         step.cancel(self.status)
 
 
+def shard_work(work: Sequence[tuple[BaseRule, tuple[Path, ...]]], index: int, count: int) -> list[tuple[BaseRule, tuple[Path, ...]]]:
+    """
+    Keep shard `index` (of `count`, 1-based) of the tests in `work`.
+
+    Tests are dealt out round-robin in (rule name, test path) order, so shards
+    get about the same number of tests however they're spread across rules,
+    and every machine agrees on the split.  A rule without tests counts as one
+    test, so that exactly one shard reports it.
+    """
+    assert 1 <= index <= count
+    mine: dict[str, tuple[Path, ...]] = {}
+    n = 0
+    for rule_instance, test_paths in sorted(work, key=lambda w: w[0].rule_config.prefixed_name):
+        name = rule_instance.rule_config.prefixed_name
+        if not test_paths:
+            if n % count == index - 1:
+                mine[name] = ()
+            n += 1
+            continue
+        kept = tuple(p for i, p in enumerate(sorted(test_paths), n) if i % count == index - 1)
+        n += len(test_paths)
+        if kept:
+            mine[name] = kept
+    # Keep the original (printing) order
+    return [
+        (rule_instance, mine[rule_instance.rule_config.prefixed_name])
+        for rule_instance, _ in work
+        if rule_instance.rule_config.prefixed_name in mine
+    ]
+
+
+def _prepare_rule(rule_instance: BaseRule) -> None:
+    try:
+        rule_instance.prepare()
+    except Exception as e:
+        # Each test will call prepare again, and report this properly
+        LOG.info("Preparing %s failed: %r", rule_instance.rule_config.prefixed_name, e)
+
+
+def _submit_after(first: Future[Any], submit: Callable[[], Future[_T]]) -> Future[_T]:
+    """
+    Call `submit` once `first` is done, without tying up a worker to wait for it.
+
+    Returns a future for the result of the future that `submit` returns.
+    """
+    outer: Future[_T] = Future()
+
+    def copy_result(inner: Future[_T]) -> None:
+        if inner.cancelled():
+            # e.g. the pool was shut down; exception() would raise
+            outer.cancel()
+        elif (e := inner.exception()) is not None:
+            outer.set_exception(e)
+        else:
+            outer.set_result(inner.result())
+
+    def chain(_: Future[Any]) -> None:
+        try:
+            inner = submit()
+        except BaseException as e:
+            outer.set_exception(e)
+        else:
+            inner.add_done_callback(copy_result)
+
+    first.add_done_callback(chain)
+    return outer
+
+
+#: The Runner and RepoPool for tests run in this process, see `Runner.test_rules`
+_worker_state: tuple[Runner, RepoPool] | None = None
+
+
+def _init_test_worker(runner: Runner) -> None:
+    global _worker_state
+    repo_pool = RepoPool()
+    # Worker processes don't run atexit handlers, but do run these
+    Finalize(None, repo_pool.close, exitpriority=0)
+    _worker_state = (runner, repo_pool)
+
+
+def _perform_test_in_worker(
+    rule_instance: BaseRule, test_path: Path, update: bool, cache: ResultCache | None, key: str | None
+) -> TestResult:
+    assert _worker_state is not None
+    runner, repo_pool = _worker_state
+    return runner._perform_test(rule_instance, test_path, repo_pool, update=update, cache=cache, key=key)
+
+
+def _same_lines(a: bytes, b: bytes) -> bool:
+    """Whether `a` and `b` only differ in their line endings."""
+    return a.replace(b"\r\n", b"\n") == b.replace(b"\r\n", b"\n")
+
+
+def _test_cache_key(test_path: Path, fingerprint: str) -> str | None:
+    """
+    The `ResultCache` key for a test, or None if it's missing input/ or output/
+    (which is reported when it's run).
+    """
+    if not ((test_path / "input").exists() and (test_path / "output").exists()):
+        return None
+    return result_key(fingerprint, str(test_path.relative_to(Path.cwd())), test_path)
+
+
 class Runner:
-    def __init__(self, rtc: RuntimeConfig, repo: BaseRepo, parallelism: int = 0) -> None:
+    def __init__(
+        self,
+        rtc: RuntimeConfig,
+        repo: BaseRepo,
+        parallelism: int = 0,
+        serve_jobserver: bool = False,
+        processes: int = 0,
+        priority: Priority = "order",
+    ) -> None:
         self.rtc = rtc
-        self.rules = discover_rules(rtc)
+        with TIMINGS.phase("discover rules"):
+            self.rules = discover_rules(rtc, rtc.filter_config)
         self.repo: BaseRepo = repo
         self.parallelism = parallelism
+        self.serve_jobserver = serve_jobserver
+        self.processes = processes
+        self.priority = priority
         self.ick_env_vars = {
             "ICK_REPO_PATH": str(repo.root),
         }
@@ -108,7 +250,8 @@ class Runner:
             self.ick_env_vars["ICK_APPLY"] = "1"
 
         # TODO there's a var on repo to store this...
-        self.projects: list[Project] = find_projects(repo, repo.zfiles, self.rtc.main_config)
+        with TIMINGS.phase("find projects"):
+            self.projects: list[Project] = find_projects(repo, repo.zfiles, self.rtc.main_config)
 
     def iter_rule_impl(self) -> Iterable[BaseRule]:
         def matched_rules(*, legacy: bool) -> list[BaseRule]:
@@ -139,7 +282,9 @@ class Runner:
         elif not rules:
             legacy_rules = matched_rules(legacy=True)
 
-        if not rules and len(self.rules) > 0:
+        # Filtering happens while loading, so self.rules may be empty even
+        # though some of the configured rulesets do have rules.
+        if not rules and (self.rules or self.rtc.rules_config.ruleset):
             pattern = self.rtc.filter_config.name_filter_re
             hint = ""
             if legacy_rules:
@@ -156,17 +301,43 @@ class Runner:
         *,
         status_callback: Callable[[Run[Any, Any]], None] | None = None,
         done_callback: Callable[[Run[Any, Any]], None] | None = None,
-    ) -> Run[str, bytes | Erasure]:
-        """Compose a feedforward Run with steps for all rules."""
-        run: Run[str, bytes | Erasure] = Run(
-            parallelism=self.parallelism,
-            status_callback=status_callback,
-            done_callback=done_callback,
-        )
-        for impl in self.iter_rule_impl():
-            impl.add_steps_to_run(self.projects, self.ick_env_vars, run)
-        run.add_step(Step())  # Final sink
-        return run
+    ) -> IckRun:
+        """
+        Compose a feedforward Run with steps for all rules.
+
+        Steps are scheduled, and their timings recorded, using the
+        `TimingHistory` from previous runs (see `ick.schedule`).  If we were
+        started by make, or `serve_jobserver`, batches also take tokens from a
+        make jobserver (see `ick.jobserver`).  Rules' processes are run by a
+        `Supervisor`, so up to `processes` of them can run at once however
+        many threads there are.
+
+        With `priority="urgency"`, more urgent rules come before others with
+        the same `order`, both in the run and when being given workers.
+        """
+        with TIMINGS.phase("build steps"):
+            processes = self.processes or self.parallelism or get_default_parallelism()
+            jobserver = Jobserver.from_makeflags(os.environ.get("MAKEFLAGS", ""))
+            if jobserver is None and self.serve_jobserver:
+                jobserver = Jobserver.serve(processes)
+            run = IckRun(
+                history=TimingHistory(),
+                concurrency=self.rtc.main_config.concurrency,
+                jobserver=jobserver,
+                supervisor=Supervisor(processes),
+                priority=self.priority,
+                parallelism=self.parallelism,
+                status_callback=status_callback,
+                done_callback=done_callback,
+            )
+            impls = list(self.iter_rule_impl())
+            if self.priority == "urgency":
+                # Stable, so still by name within an urgency
+                impls.sort(key=lambda impl: (impl.rule_config.order, -URGENCIES.index(impl.rule_config.urgency)))
+            for impl in impls:
+                impl.add_steps_to_run(self.projects, self.ick_env_vars, run)
+            run.add_step(Step())  # Final sink
+            return run
 
     def build_steps_for_test(
         self,
@@ -177,17 +348,56 @@ class Runner:
     ) -> Run[str, bytes | Erasure]:
         """Compose a feedforward Run with steps for a single rule test."""
         run: Run[str, bytes | Erasure] = Run()
-        project = Project(repo, "", "python", "invalid.bin")
+        # Of a type the rule applies to, so that its steps aren't pruned
+        typ = impl.rule_config.project_types[0] if impl.rule_config.project_types else "python"
+        project = Project(repo, "", typ, "invalid.bin")
         env_vars = self.ick_env_vars | {"ICK_TEST_NAME": test_name}
         impl.add_steps_to_run([project], env_vars, run)
         run.add_step(Step())  # Final sink
         return run
 
-    def test_rules(self, *, update: bool = False) -> int:
+    def test_rules(
+        self,
+        *,
+        update: bool = False,
+        use_cache: bool = True,
+        since: str | None = None,
+        jobs: int = 0,
+        shard: tuple[int, int] | None = None,
+        quiet: bool = False,
+        json_file: IO[str] | None = None,
+        junit_xml: Path | None = None,
+        durations: int = 0,
+        work: Sequence[tuple[BaseRule, tuple[Path, ...]]] | None = None,
+    ) -> int:
         """
         Returns an exit code (0 on success)
+
+        Tests that passed before, and whose rule and test files are unchanged,
+        aren't rerun unless `use_cache` is false.  Updating and collecting
+        coverage always run every test.
+
+        If `since` is a git ref, only rules affected by changes to the rule repo
+        since then are tested (see `ick.impact`).
+
+        Tests run in threads, or in `jobs` processes if that's nonzero.  With
+        `shard` as (index, count), only that 1-based shard's share of the tests
+        is run (see `shard_work`).
+
+        Results, with how long each part of each test took, can also be
+        written to `json_file` and `junit_xml` (see `ick.reporting`), and the
+        slowest `durations` tests are listed at the end.  `quiet` skips the
+        human-readable output, e.g. when `json_file` is stdout.
+
+        `work` is the (rule, test paths) to run, defaulting to `iter_tests()`.
         """
-        print("[dim]testing...[/dim]")
+
+        echo: Callable[..., None] = print if not quiet else (lambda *args, **kwargs: None)
+
+        echo("[dim]testing...[/dim]")
+        cache = None
+        if use_cache and not update and not bool(int(os.environ.get("ICK_COVERAGE_PY", "0"))):
+            cache = ResultCache()
         buffered_output = io.StringIO()
 
         def buf_print(text: str) -> None:
@@ -200,7 +410,13 @@ class Runner:
             buffered_output.write("\n")
 
         # Collect all work upfront so we can submit everything to the thread pool at once.
-        all_work = list(self.iter_tests())
+        all_work = list(self.iter_tests() if work is None else work)
+        if since is not None:
+            all_work, note = self._select_impacted(all_work, since)
+            echo(f"[dim]{note}[/dim]")
+
+        if shard is not None:
+            all_work = shard_work(all_work, *shard)
 
         # Each test gets its own TestResult; _perform_test only touches shared Runner
         # state that is read-only after __init__ (now that self.repo mutation is gone).
@@ -210,39 +426,84 @@ class Runner:
         # run concurrently in the background.
         final_status = 0
         total_updated = 0
-        with ThreadPoolExecutor() as executor:
-            rule_futures: list[tuple[BaseRule, list[tuple[Future[None], TestResult]]]] = []
+        total_cached = 0
+        with ExitStack() as stack:
+            repo_pool = stack.enter_context(RepoPool())
+            if jobs:
+                # Each worker gets a copy of this Runner once, not with every test
+                executor: Executor = stack.enter_context(ProcessPoolExecutor(jobs, initializer=_init_test_worker, initargs=(self,)))
+            else:
+                executor = stack.enter_context(ThreadPoolExecutor())
+            # A rule's tests aren't submitted until its env is prepared, by one
+            # worker per distinct env, so that the others can run tests for
+            # rules that are ready instead of all waiting on the same lock.
+            prepared: dict[Hashable, Future[None]] = {}
+            rule_futures: list[tuple[BaseRule, list[Future[TestResult]]]] = []
             for rule_instance, test_paths in all_work:
-                futures: list[tuple[Future[None], TestResult]] = []
+                futures: list[Future[TestResult]] = []
+                # Tests that passed before are looked up here, rather than by
+                # the workers, so that a rule whose tests are all cached never
+                # has its env prepared
+                keys: dict[Path, str | None] = {}
+                if cache is not None and test_paths:
+                    fingerprint = rule_fingerprint(rule_instance)
+                    keys = {test_path: _test_cache_key(test_path, fingerprint) for test_path in test_paths}
+                cached = {test_path for test_path, key in keys.items() if key is not None and cache is not None and cache.passed(key)}
+                prepare_key = rule_instance.prepare_key() if set(test_paths) - cached else None
+                if prepare_key is not None and prepare_key not in prepared:
+                    prepared[prepare_key] = executor.submit(_prepare_rule, rule_instance)
                 for test_path in sorted(test_paths):
-                    result = TestResult(rule_instance, test_path)
-                    fut = executor.submit(self._perform_test, rule_instance, test_path, result, update=update)
-                    futures.append((fut, result))
+                    if test_path in cached:
+                        done: Future[TestResult] = Future()
+                        done.set_result(TestResult(rule_instance, test_path, success=True, cached=True))
+                        futures.append(done)
+                        continue
+                    key = keys.get(test_path)
+                    submit: Callable[[], Future[TestResult]]
+                    if jobs:
+                        submit = functools.partial(executor.submit, _perform_test_in_worker, rule_instance, test_path, update, cache, key)
+                    else:
+                        submit = functools.partial(
+                            executor.submit,
+                            self._perform_test,
+                            rule_instance,
+                            test_path,
+                            repo_pool,
+                            update=update,
+                            cache=cache,
+                            key=key,
+                        )
+                    futures.append(submit() if prepare_key is None else _submit_after(prepared[prepare_key], submit))
                 rule_futures.append((rule_instance, futures))
 
+            rule_results: list[tuple[BaseRule, list[TestResult]]] = []
             for rule_instance, futures in rule_futures:
+                results: list[TestResult] = []
+                rule_results.append((rule_instance, results))
                 success = True
                 any_updated = False
                 qn = fmt_name(rule_instance.rule_config.prefixed_name)
-                print(f"  [bold]{qn}[/bold]: ", end="")
+                echo(f"  [bold]{qn}[/bold]: ", end="")
                 if not futures:
-                    print("<no-test>", end="")
+                    echo("<no-test>", end="")
                     buf_print(
                         f"{qn}: [yellow]no tests[/yellow] in {rule_instance.rule_config.test_path}",
                     )
                 else:
-                    for fut, result in futures:
-                        fut.result()  # blocks until this test is done; propagates unexpected exceptions
+                    for fut in futures:
+                        result = fut.result()  # blocks until this test is done; propagates unexpected exceptions
+                        results.append(result)
                         if result.updated:
                             any_updated = True
                             total_updated += 1
-                            print("[yellow]U[/]", end="")
+                            echo("[yellow]U[/]", end="")
                         elif result.success:
-                            print(".", end="")
+                            total_cached += result.cached
+                            echo(".", end="")
                         else:
                             success = False
                             final_status = 1
-                            print("[red]F[/]", end="")
+                            echo("[red]F[/]", end="")
                             buf_print(f"{'-' * 80}")
                             rule_test_path = result.rule_instance.rule_config.test_path
                             assert rule_test_path is not None
@@ -256,23 +517,80 @@ class Runner:
                             buf_print(result.diff)
 
                 if not success:
-                    print(" [red]FAIL[/]")
+                    echo(" [red]FAIL[/]")
                 elif any_updated:
-                    print(" [yellow]UPDATED[/]")
+                    echo(" [yellow]UPDATED[/]")
                 else:
-                    print(" [green]PASS[/]")
+                    echo(" [green]PASS[/]")
 
         if buffered_output.tell():
-            print()
-            print("DETAILS")
-            print(buffered_output.getvalue())
+            echo()
+            echo("DETAILS")
+            echo(buffered_output.getvalue())
 
         if total_updated:
-            print(f"[yellow]{total_updated} test(s) updated[/yellow]")
+            echo(f"[yellow]{total_updated} test(s) updated[/yellow]")
+        if total_cached:
+            echo(f"[dim]{total_cached} unchanged test(s) passed previously (--no-cache to rerun)[/dim]")
+        if durations:
+            slowest_results = slowest(rule_results, durations)
+            if slowest_results:
+                echo(f"slowest {len(slowest_results)} test(s):")
+                for result in slowest_results:
+                    echo(
+                        f"  {result.wall_time:7.2f}s {display_name(result)}"
+                        f" [dim](setup {result.setup_time:.2f}s, run {result.run_time:.2f}s, compare {result.compare_time:.2f}s)[/dim]"
+                    )
+
+        if json_file is not None:
+            json.dump(results_json(rule_results), json_file, indent=4, sort_keys=True)
+            json_file.write("\n")
+        if junit_xml is not None:
+            write_junit_xml(rule_results, junit_xml)
 
         return final_status
 
-    def _perform_test(self, rule_instance: BaseRule, test_path: Path, result: TestResult, *, update: bool = False) -> None:
+    def _select_impacted(
+        self, all_work: list[tuple[BaseRule, tuple[Path, ...]]], since: str
+    ) -> tuple[list[tuple[BaseRule, tuple[Path, ...]]], str]:
+        """Returns the work affected by changes since `since`, and a note saying how that went."""
+        try:
+            impacted = impacted_rules([rule_instance for rule_instance, _ in all_work], since)
+        except ImpactUnknown as e:
+            return all_work, f"testing all rules, {e}"
+        selected = [
+            (rule_instance, test_paths) for rule_instance, test_paths in all_work if rule_instance.rule_config.prefixed_name in impacted
+        ]
+        return selected, f"{len(impacted)} of {len(all_work)} rule(s) affected by changes since {since}"
+
+    def _perform_test(
+        self,
+        rule_instance: BaseRule,
+        test_path: Path,
+        repo_pool: RepoPool,
+        *,
+        update: bool = False,
+        cache: ResultCache | None = None,
+        key: str | None = None,
+    ) -> TestResult:
+        """
+        Runs one test, recording it in `cache` under `key` if it passes.
+        """
+        start = perf_counter()
+        result = TestResult(rule_instance, test_path)
+        test_name = str(test_path.relative_to(Path.cwd()))
+
+        self._run_test(rule_instance, test_path, test_name, result, repo_pool, update=update)
+
+        if key is not None and result.success:
+            assert cache is not None
+            cache.record_pass(key)
+        result.wall_time = perf_counter() - start
+        return result
+
+    def _run_test(
+        self, rule_instance: BaseRule, test_path: Path, test_name: str, result: TestResult, repo_pool: RepoPool, *, update: bool = False
+    ) -> None:
         inp = test_path / "input"
         outp = test_path / "output"
         if not inp.exists():
@@ -285,100 +603,115 @@ class Runner:
                 result.message = f"Test output directory {outp} is missing"
                 return
 
-        with TemporaryDirectory() as td, ExitStack() as stack:
-            tp = Path(td)
-            copytree(inp, tp, dirs_exist_ok=True)
-
-            repo = maybe_repo(tp, stack.enter_context, for_testing=True)
+        with ExitStack() as stack:
+            start = perf_counter()
+            repo = rule_test_repo(inp, stack.enter_context, repo_pool)
 
             steps = self.build_steps_for_test(
                 impl=rule_instance,
                 repo=repo,
-                test_name=str(test_path.relative_to(Path.cwd())),
+                test_name=test_name,
             )
+            ran = perf_counter()
+            result.setup_time = ran - start
             run_result = next(iter(self.run_steps(steps, repo=repo)))
-            response = run_result.modifications
+            compared = perf_counter()
+            result.run_time = compared - ran
 
-            actual_output = run_result.finished.message
+        self._check_output(inp, outp, run_result, result, update=update)
+        result.compare_time = perf_counter() - compared
 
-            if update:
-                changed = self._write_update(inp, outp, response, run_result.finished.status, actual_output)
-                if changed:
-                    result.updated = True
-                else:
-                    result.success = True
-                return
+    def _check_output(self, inp: Path, outp: Path, run_result: HighLevelResult, result: TestResult, *, update: bool = False) -> None:
+        response = run_result.modifications
+        actual_output = run_result.finished.message
 
-            files_to_check = set(glob("**", root_dir=outp, recursive=True, include_hidden=True))
-            files_to_check = {f for f in files_to_check if (outp / f).is_file()} - {"output.txt", "error.txt"}
+        if update:
+            changed = self._write_update(inp, outp, response, run_result.finished.status, actual_output)
+            if changed:
+                result.updated = True
+            else:
+                result.success = True
+            return
 
-            if run_result.finished.status is RuleStatus.ERROR:
-                # Error state
-                expected_path = outp / "error.txt"
-                if not expected_path.exists():
-                    result.message = f"Test crashed, but {expected_path} doesn't exist so that seems unintended:\n{actual_output}"
-                    return
+        out_manifest = tree_manifest(outp)
+        files_to_check = set(out_manifest) - {"output.txt", "error.txt"}
 
-                expected = clean_output(expected_path.read_text())
-                output = clean_output(actual_output)
-                if expected == output:
-                    result.success = True
-                else:
-                    result.diff = moreorless.unified_diff(expected, output, "error.txt")
-                    result.message = "Different output found"
+        if run_result.finished.status is RuleStatus.ERROR:
+            # Error state
+            expected_path = outp / "error.txt"
+            if not expected_path.exists():
+                result.message = f"Test crashed, but {expected_path} doesn't exist so that seems unintended:\n{actual_output}"
                 return
 
-            for r in response:
-                assert isinstance(r, Modified)
-                if r.new_bytes is None:
-                    if r.filename in files_to_check:
-                        result.message = f"Missing removal of {r.filename!r}"
-                        return
-                else:
-                    if r.filename not in files_to_check:
-                        result.message = f"Unexpected new file: {r.filename!r}"
-                        return
-                    outf = outp / r.filename
-                    if outf.read_bytes() != r.new_bytes:
-                        result.diff = unified_diff(
-                            outf.read_text(),
-                            r.new_bytes.decode(),
-                            r.filename,
-                        )
-                        result.message = f"{r.filename!r} (modified) differs"
-                        return
-                    files_to_check.remove(r.filename)
+            expected = clean_output(expected_path.read_text())
+            output = clean_output(actual_output)
+            if expected == output:
+                result.success = True
+            else:
+                result.diff = moreorless.unified_diff(expected, output, "error.txt")
+                result.message = "Different output found"
+            return
 
-            for unchanged_file in files_to_check:
-                expected = (inp / unchanged_file).read_text()
-                actual = (outp / unchanged_file).read_text()
-                if expected != actual:
-                    result.diff = moreorless.unified_diff(expected, actual, unchanged_file)
-                    result.message = f"{unchanged_file!r} (unchanged) differs"
+        for r in response:
+            assert isinstance(r, Modified)
+            if r.new_bytes is None:
+                if r.filename in files_to_check:
+                    result.message = f"Missing removal of {r.filename!r}"
                     return
-
-            expected_path = outp / "output.txt"
-            if actual_output:
-                # Didn't match expectation
-                if not expected_path.exists():
-                    result.message = f"Test failed, but {expected_path} doesn't exist so that seems unintended:\n{actual_output}"
+            else:
+                if r.filename not in files_to_check:
+                    result.message = f"Unexpected new file: {r.filename!r}"
                     return
+                if out_manifest[r.filename] != bytes_entry(r.new_bytes):
+                    expected_bytes = (outp / r.filename).read_bytes()
+                    if _same_lines(expected_bytes, r.new_bytes):
+                        # The diff would be empty
+                        result.message = f"{r.filename!r} (modified) differs only in line endings"
+                        return
+                    result.diff = unified_diff(
+                        (outp / r.filename).read_text(),
+                        r.new_bytes.decode(),
+                        r.filename,
+                    )
+                    result.message = f"{r.filename!r} (modified) differs"
+                    return
+                files_to_check.remove(r.filename)
 
-                expected = expected_path.read_text()
-                if expected == actual_output:
-                    result.success = True
-                else:
-                    result.diff = moreorless.unified_diff(expected, actual_output, "output.txt")
-                    result.message = "Different output found"
+        in_manifest = tree_manifest(inp) if files_to_check else {}
+        for unchanged_file in sorted(files_to_check):
+            if in_manifest.get(unchanged_file) != out_manifest[unchanged_file]:
+                inf = inp / unchanged_file
+                expected = inf.read_text() if unchanged_file in in_manifest else ""
+                actual = (outp / unchanged_file).read_text()
+                if unchanged_file in in_manifest and expected == actual:
+                    # Only line endings differ, e.g. from git's autocrlf
+                    continue
+                result.diff = moreorless.unified_diff(expected, actual, unchanged_file)
+                result.message = f"{unchanged_file!r} (unchanged) differs"
                 return
 
-            if expected_path.exists():
-                # There was no output, but we expected some
-                expected = expected_path.read_text()
-                result.diff = moreorless.unified_diff(expected, "", "output.txt")
-                result.message = "Expected output, but rule produced none"
+        expected_path = outp / "output.txt"
+        if actual_output:
+            # Didn't match expectation
+            if not expected_path.exists():
+                result.message = f"Test failed, but {expected_path} doesn't exist so that seems unintended:\n{actual_output}"
                 return
 
+            expected = expected_path.read_text()
+            if expected == actual_output:
+                result.success = True
+            else:
+                result.diff = moreorless.unified_diff(expected, actual_output, "output.txt")
+                result.message = "Different output found"
+            return
+
+        if expected_path.exists():
+            # There was no output, but we expected some
+            expected = expected_path.read_text()
+            result.diff = moreorless.unified_diff(expected, "", "output.txt")
+            result.message = "Expected output, but rule produced none"
+            return
+
         result.success = True
 
     def _write_update(
@@ -389,80 +722,169 @@ class Runner:
         status: RuleStatus,
         actual_output: str,
     ) -> bool:
-        """Rebuild output/ with actual rule results. Returns True if anything changed."""
-        old_files: dict[str, bytes] = {}
-        for f in glob("**", root_dir=outp, recursive=True, include_hidden=True):
-            p = outp / f
-            if p.is_file():
-                old_files[f] = p.read_bytes()
-
-        rmtree(outp)
-        outp.mkdir()
+        """
+        Make output/ match the actual rule results. Returns True if anything changed.
 
+        Only files whose size or hash differ from what they should be are
+        rewritten, so this is cheap for large, mostly-unchanged trees.
+        """
+        old_manifest = tree_manifest(outp)
+        in_manifest: dict[str, FileEntry] = {}
+        # The new contents of each file, either bytes or a file in input/ to copy
+        want: dict[str, bytes | Path] = {}
         if status is RuleStatus.ERROR:
-            (outp / "error.txt").write_text(actual_output)
+            want["error.txt"] = actual_output.encode()
         else:
-            copytree(inp, outp, dirs_exist_ok=True)
+            in_manifest = tree_manifest(inp)
+            want = {f: inp / f for f in in_manifest}
             for r in response:
                 assert isinstance(r, Modified)
                 if r.new_bytes is None:
-                    p = outp / r.filename
-                    if p.exists():
-                        p.unlink()
+                    want.pop(r.filename, None)
                 else:
-                    p = outp / r.filename
-                    p.parent.mkdir(parents=True, exist_ok=True)
-                    p.write_bytes(r.new_bytes)
+                    want[r.filename] = r.new_bytes
             if actual_output:
-                (outp / "output.txt").write_text(actual_output)
+                want["output.txt"] = actual_output.encode()
 
-        new_files: dict[str, bytes] = {}
-        for f in glob("**", root_dir=outp, recursive=True, include_hidden=True):
+        changed = False
+        for f in sorted(old_manifest.keys() - want.keys()):
             p = outp / f
-            if p.is_file():
-                new_files[f] = p.read_bytes()
+            p.unlink()
+            changed = True
+            # Don't leave behind directories that only held removed files
+            for parent in p.parents:
+                if parent == outp or any(parent.iterdir()):
+                    break
+                parent.rmdir()
+
+        for f, new in want.items():
+            entry = bytes_entry(new) if isinstance(new, bytes) else in_manifest[f]
+            if old_manifest.get(f) == entry:
+                continue
+            p = outp / f
+            p.parent.mkdir(parents=True, exist_ok=True)
+            if isinstance(new, bytes):
+                p.write_bytes(new)
+            else:
+                copyfile(new, p)
+            changed = True
 
-        return old_files != new_files
+        return changed
 
     def iter_tests(self) -> Iterable[tuple[BaseRule, tuple[Path, ...]]]:
         # Yields (impl, test_paths) for projects in test dir
         for impl in self.iter_rule_impl():
-            test_path = impl.rule_config.test_path
-            assert test_path is not None
-            yield impl, tuple(test_path.glob("*/"))
+            yield impl, self._test_paths(impl)
 
-    def run_steps(self, steps: Run[str, bytes | Erasure], repo: BaseRepo | None = None) -> Iterable[HighLevelResult]:
+    def _test_paths(self, impl: BaseRule) -> tuple[Path, ...]:
+        test_path = impl.rule_config.test_path
+        assert test_path is not None
+        return tuple(test_path.glob("*/"))
+
+    def watch_tests(self, **kwargs: Any) -> None:
+        """
+        Run tests like `test_rules`, then again whenever rules or tests change.
+
+        Only the tests of rules whose implementation (see `rules_using`),
+        config, or tests changed are rerun.  Rule instances are kept between
+        runs, so that loading config and checking venvs isn't repeated.  Runs
+        until interrupted.
+        """
+        from .watch import watcher
+
+        impls = {impl.rule_config.prefixed_name: impl for impl in self.iter_rule_impl()}
+        self.test_rules(work=[(impl, self._test_paths(impl)) for impl in impls.values()], **kwargs)
+        # Only the first run is narrowed down by `since`; later ones are by what changed
+        kwargs.pop("since", None)
+
+        roots = {impl.rule_config.repo_path for impl in impls.values() if impl.rule_config.repo_path is not None}
+        with watcher(roots) as w:
+            while True:
+                print("[dim]watching for changes (ctrl-c to stop)...[/dim]")
+                changed = {p.resolve() for p in w.wait()}
+                affected = set()
+                if any(p.name in RULE_CONFIG_NAMES for p in changed):
+                    self.rules = discover_rules(self.rtc, self.rtc.filter_config)
+                    new_impls = {}
+                    for impl in self.iter_rule_impl():
+                        name = impl.rule_config.prefixed_name
+                        old = impls.get(name)
+                        if old is not None and old.rule_config == impl.rule_config:
+                            new_impls[name] = old
+                        else:
+                            new_impls[name] = impl
+                            affected.add(name)
+                    impls = new_impls
+                affected |= rules_using(impls.values(), changed)
+                if affected:
+                    print()
+                    self.test_rules(work=[(impl, self._test_paths(impl)) for name, impl in impls.items() if name in affected], **kwargs)
+
+    def run_steps(
+        self, steps: Run[str, bytes | Erasure], repo: BaseRepo | None = None, *, stream: bool = False
+    ) -> Iterable[HighLevelResult]:
         """
         Run a series of feedforward steps and yield high-level results.
+
+        With `stream`, each step's results are yielded as soon as it's
+        finished, rather than once they all are.
         """
         # TODO deliberate in a flag: (I think this got separated from code now in build_steps_for_rules)
         # TODO parallelize or show a progress bar, this takes a while...
         if repo is None:
             repo = self.repo
         repo_contents: dict[str, bytes | Erasure] = {}
-        # TODO the version that includes dirty files
-        for f in sorted(repo.zfiles.split("\0")):
-            if not f:
-                continue
-            p = repo.root / f
-            # TODO symlinks, empty dirs?
-            if p.is_file():
-                repo_contents[f] = p.read_bytes()
+        with TIMINGS.phase("load contents"):
+            # TODO the version that includes dirty files
+            for f in sorted(repo.zfiles.split("\0")):
+                if not f:
+                    continue
+                p = repo.root / f
+                # TODO symlinks, empty dirs?
+                if p.is_file():
+                    repo_contents[f] = p.read_bytes()
+
+        if not stream:
+            with TIMINGS.phase("execute"):
+                steps.run_to_completion(repo_contents)
+            yield from self._step_results(steps._steps[:-1])
+            return
 
-        steps.run_to_completion(repo_contents)
-        for s in steps._steps[:-1]:
+        errors: list[BaseException] = []
+
+        def run() -> None:
+            try:
+                steps.run_to_completion(repo_contents)
+            except BaseException as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run, name="ick-run")
+        thread.start()
+        reported = 0
+        while True:
+            running = thread.is_alive()
+            # Steps up to _finalized_idx won't see any more work (private, which
+            # is one reason setup.cfg pins feedforward to 0.8.*)
+            done = steps._finalized_idx + 1 if running else len(steps._steps)
+            done = min(done, len(steps._steps) - 1)
+            yield from self._step_results(steps._steps[reported:done])
+            reported = max(reported, done)
+            if not running:
+                break
+            # What our caller is waiting on, rather than what it's doing
+            with TIMINGS.phase("execute"):
+                thread.join(STREAM_INTERVAL)
+        if errors:
+            raise errors[0]
+
+    def _step_results(self, steps: Iterable[Step[str, bytes | Erasure]]) -> Iterable[HighLevelResult]:
+        for s in steps:
             assert isinstance(s, GenericPreparedStep)
-            if s.cancelled:
-                # This should also encompass exit codes other than 0 and 99
-                # print(f"{s} failed:")
-                # print(f"  {s.cancel_reason}")
-                yield HighLevelResult(s.prefixed_name, s.match_prefix, [], Finished(s.prefixed_name, RuleStatus.ERROR, s.cancel_reason))
-            else:
-                # if any(e == 99 for e in s.exit_codes):
-                #     ...
-
-                changes, finished = s.compute_diff_messages()
-                yield HighLevelResult(s.prefixed_name, s.match_prefix, changes, finished)
+            # Not timing our caller, which is showing (or applying) them
+            with TIMINGS.phase("compute diffs"):
+                results = list(s.project_results())
+            for project_path, changes, finished in results:
+                yield HighLevelResult(s.prefixed_name, project_path, changes, finished, s.usage.get(project_path))
 
     @ktrace()
     def echo_rules(self) -> None:
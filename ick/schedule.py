@@ -0,0 +1,373 @@
+"""
+Decides which steps of an `ick run` get worker threads first, from how long
+they took in previous runs.
+
+feedforward hands spare threads to the first step (in rule `order`) that has
+work, so a slow rule that happens to sort last also starts last and decides
+how long the whole run takes.  `IckRun` instead tries steps that are expected
+to take longest first, while still respecting `order` between rules.
+
+How long a step took, and how many files it was given, is remembered in
+`TimingHistory` (in the ick cache dir) after each run.  The same estimates
+give the ETA shown while running.
+
+Rules with `batch_size = "auto"` also have their cost split into a fixed
+per-process overhead and a per-file cost (`BatchCost`), which decides how
+many files to give each process.
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import threading
+from logging import getLogger
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterable, Literal, Mapping, Optional, Protocol, Sequence
+
+from feedforward import Notification, Run, State
+from feedforward.erasure import Erasure
+from msgspec import DecodeError, Struct, field
+from msgspec.json import decode as decode_json
+from msgspec.json import encode as encode_json
+from vmodule import VLOG_1
+
+from ick_protocol import Urgency
+
+if TYPE_CHECKING:
+    from .base_rule import GenericPreparedStep
+    from .jobserver import Jobserver
+    from .supervisor import Supervisor
+
+LOG = getLogger(__name__)
+
+#: How `IckRun` orders steps within an `order`, see `--priority`
+Priority = Literal["order", "urgency"]
+
+#: Least urgent first
+URGENCIES = sorted(Urgency)
+
+#: Bump this whenever the format of the history file changes.
+TIMINGS_VERSION = 1
+
+#: Weight of the newest run when updating estimates; the rest is history
+SMOOTHING = 0.5
+
+#: With `batch_size = "auto"`, batches are made big enough that starting the
+#: process takes at most this fraction of the time spent on files...
+OVERHEAD_FRACTION = 0.1
+#: ...and until the cost is known, alternate between these sizes to measure it
+PROBE_SIZES = (1, 8)
+
+
+class SlotPool(Protocol):
+    """Limits how many batches can run at once, like a `threading.Semaphore`."""
+
+    def acquire(self, blocking: bool = ...) -> bool: ...
+
+    def release(self) -> None: ...
+
+
+class StepTiming(Struct):
+    seconds: float
+    files: int
+
+
+class BatchCost(Struct):
+    #: Seconds to run a process with no files
+    overhead: float
+    #: Additional seconds for each file
+    per_file: float
+
+
+class History(Struct):
+    version: int = TIMINGS_VERSION
+    #: prefixed rule name -> project path -> how long its step took
+    steps: dict[str, dict[str, StepTiming]] = field(default_factory=dict)
+    #: prefixed rule name -> seconds per file, over all its projects
+    per_file: dict[str, float] = field(default_factory=dict)
+    #: prefixed rule name -> cost of a batch, for rules that had batches of several sizes
+    batch_costs: dict[str, BatchCost] = field(default_factory=dict)
+
+
+def _smooth(old: Optional[float], new: float) -> float:
+    return new if old is None else old * (1 - SMOOTHING) + new * SMOOTHING
+
+
+def fit_batch_cost(samples: Sequence[tuple[int, float]]) -> Optional[BatchCost]:
+    """
+    Least-squares fit of (files, seconds) batch samples to `BatchCost`.
+
+    Returns None unless there are samples of at least two different sizes.
+    """
+    if len({n for n, _ in samples}) < 2:
+        return None
+    mean_n = sum(n for n, _ in samples) / len(samples)
+    mean_t = sum(t for _, t in samples) / len(samples)
+    per_file = sum((n - mean_n) * (t - mean_t) for n, t in samples) / sum((n - mean_n) ** 2 for n, _ in samples)
+    per_file = max(per_file, 0.0)
+    return BatchCost(overhead=max(mean_t - per_file * mean_n, 0.0), per_file=per_file)
+
+
+def auto_batch_size(cost: BatchCost, files: int, slots: int, max_files: int) -> int:
+    """
+    How many files to give the next process, of a step with `files` in total.
+
+    Enough that the overhead of starting it is small compared to the files'
+    cost, but no more than keeps all `slots` busy, and never more than
+    `max_files`.
+    """
+    if cost.per_file > 0:
+        efficient = math.ceil(cost.overhead / (cost.per_file * OVERHEAD_FRACTION))
+    else:
+        efficient = max_files
+    balanced = math.ceil(files / max(slots, 1))
+    return max(1, min(efficient, balanced, max_files))
+
+
+def max_argv_files(cmdline: Sequence[Any], env: Mapping[str, str], names: Iterable[str]) -> int:
+    """
+    How many filenames like `names` can be appended to `cmdline` before
+    exceeding the system's limit on the size of arguments and environment.
+    """
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        arg_max = 32768  # Windows' command line limit
+    # Leave half for safety (e.g. auxv, and env added by wrappers like uv run)
+    used = sum(len(os.fsencode(str(a))) + 1 for a in cmdline) + sum(len(k) + len(v) + 2 for k, v in env.items())
+    lengths = [len(os.fsencode(n)) + 1 + 8 for n in names]  # + 8 for the pointer in argv
+    per_file = max(lengths, default=64)
+    return max(1, (arg_max // 2 - used) // per_file)
+
+
+class TimingHistory:
+    def __init__(self, path: Path | None = None) -> None:
+        if path is None:
+            import platformdirs
+
+            path = Path(platformdirs.user_cache_dir("ick", "advice-animal")).expanduser() / "timings.json"
+        self.path = path
+        self.history = History()
+        try:
+            history = decode_json(path.read_bytes(), type=History)
+        except (OSError, DecodeError) as e:
+            LOG.log(VLOG_1, "No timing history from %s: %s", path, e)
+        else:
+            if history.version == TIMINGS_VERSION:
+                self.history = history
+
+    def expected(self, prefixed_name: str, project: str, files: int) -> Optional[float]:
+        """
+        Seconds a rule's step is expected to take for `files` input files, or
+        None if it's never been seen.
+        """
+        timing = self.history.steps.get(prefixed_name, {}).get(project)
+        if timing is not None:
+            if timing.files and files:
+                return timing.seconds * files / timing.files
+            return timing.seconds
+        per_file = self.history.per_file.get(prefixed_name)
+        if per_file is not None:
+            return per_file * files
+        return None
+
+    def record(self, prefixed_name: str, project: str, seconds: float, files: int) -> None:
+        steps = self.history.steps.setdefault(prefixed_name, {})
+        old = steps.get(project)
+        steps[project] = StepTiming(
+            seconds=_smooth(old.seconds if old else None, seconds),
+            files=round(_smooth(old.files if old else None, files)),
+        )
+        if files:
+            self.history.per_file[prefixed_name] = _smooth(self.history.per_file.get(prefixed_name), seconds / files)
+
+    def batch_cost(self, prefixed_name: str) -> Optional[BatchCost]:
+        return self.history.batch_costs.get(prefixed_name)
+
+    def record_batch_cost(self, prefixed_name: str, cost: BatchCost) -> None:
+        old = self.history.batch_costs.get(prefixed_name)
+        self.history.batch_costs[prefixed_name] = BatchCost(
+            overhead=_smooth(old.overhead if old else None, cost.overhead),
+            per_file=_smooth(old.per_file if old else None, cost.per_file),
+        )
+
+    def save(self) -> None:
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_bytes(encode_json(self.history))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            LOG.log(VLOG_1, "Unable to save timing history to %s: %s", self.path, e)
+
+
+class IckRun(Run[str, bytes | Erasure]):
+    """
+    A `Run` whose threads pick up work from the steps expected to take longest
+    first, within each rule `order`.
+
+    Steps in a `concurrency` class with a limit also share that many slots,
+    on top of the overall `parallelism`, and with a `jobserver` each batch also
+    takes one of its tokens.  With a `supervisor`, its `max_processes` (rather
+    than `parallelism`) is how many batches can run at once.
+
+    With `priority="urgency"`, steps of more urgent rules come first within
+    each `order`, ahead of expected cost.
+
+    Steps without any history keep their place, so with no history at all this
+    schedules exactly like `Run`.
+    """
+
+    def __init__(
+        self,
+        *,
+        history: TimingHistory | None = None,
+        concurrency: Mapping[str, int] | None = None,
+        jobserver: Jobserver | None = None,
+        supervisor: Supervisor | None = None,
+        priority: Priority = "order",
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.priority = priority
+        self.history = history
+        self.jobserver = jobserver
+        self.supervisor = supervisor
+        #: Steps whose inputs were final before the steps ahead of them were
+        self._started_early: set[int] = set()
+        self._early_lock = threading.Lock()
+        #: Shared slots for each concurrency class with a limit
+        self.class_limits = {name: limit for name, limit in (concurrency or {}).items() if limit > 0}
+        self.class_slots = {name: threading.BoundedSemaphore(limit) for name, limit in self.class_limits.items()}
+        #: step index -> expected seconds, for steps with history
+        self.expected: dict[int, float] = {}
+        self._priority: list[int] | None = None
+
+    def _prioritize(self, keys: Iterable[str]) -> None:
+        from .base_rule import GenericPreparedStep
+
+        keys = list(keys)
+        priority: list[tuple[float, int, float, int]] = []
+        for step in self._steps:
+            assert step.index is not None
+            if isinstance(step, GenericPreparedStep):
+                if step.concurrency in self.class_slots:
+                    step.slot_pools.append(self.class_slots[step.concurrency])
+                if self.jobserver is not None:
+                    step.slot_pools.append(self.jobserver)
+                    step.extra_env.update(self.jobserver.env)
+                    step.pass_fds = self.jobserver.pass_fds
+                step.supervisor = self.supervisor
+                batches = self._parallelism if self.supervisor is None else self.supervisor.max_processes
+                step.slots = min(batches, self.class_limits.get(step.concurrency, batches))
+                if self.history is not None:
+                    step.batch_cost = self.history.batch_cost(step.prefixed_name)
+                    cost = self.history.expected(step.prefixed_name, step.match_prefix, step.count_matches(keys))
+                    if cost is not None:
+                        self.expected[step.index] = cost
+                urgency = -URGENCIES.index(step.urgency) if self.priority == "urgency" else 0
+                priority.append((step.order, urgency, -self.expected.get(step.index, 0.0), step.index))
+            else:
+                # The final sink
+                priority.append((float("inf"), 0, 0.0, step.index))
+        self._priority = [index for *_, index in sorted(priority)]
+
+    # This and the rest of the overrides below depend on `Run`'s private
+    # internals, which is why setup.cfg pins feedforward to 0.8.*
+
+    def feedforward(self, next_idx: int, n: Notification[str, bytes | Erasure]) -> None:
+        from .base_rule import GenericPreparedStep
+
+        sender = self._steps[next_idx - 1] if next_idx > 0 else None
+        if isinstance(sender, GenericPreparedStep) and not sender.may_produce(n.key):
+            # Only a cancelled step (or project, see
+            # `CoalescedFileStep._fail_project`) undoing its "changes" to one of
+            # its inputs (see `Step.cancel`), which it didn't change
+            return
+        with self._early_lock:
+            for i in range(next_idx, len(self._steps)):
+                if i in self._started_early:
+                    step: GenericPreparedStep = self._steps[i]  # type: ignore[assignment]
+                    if step.would_match(n.key):
+                        LOG.warning("%s started before it was sent %s, which it won't see", step.prefixed_name, n.key)
+                    continue
+                self._steps[i].notify(n)
+
+    def _check_for_final(self) -> None:
+        super()._check_for_final()
+        if self._deliberate or not self._steps[0].inputs_final:
+            return
+        # A step that waits for all its inputs can start before the steps ahead
+        # of it are done, if their declared outputs can't be any of its inputs
+        from .base_rule import GenericPreparedStep
+
+        with self._early_lock:
+            blockers: list[GenericPreparedStep] = []
+            for i in range(self._finalized_idx + 1, len(self._steps)):
+                step = self._steps[i]
+                if not isinstance(step, GenericPreparedStep):
+                    break
+                if not step.eager and not step.inputs_final and not any(b.may_affect(step) for b in blockers):
+                    LOG.log(VLOG_1, "Starting %s early", step.prefixed_name)
+                    step.inputs_final = True
+                    self._started_early.add(i)
+                if not step.outputs_final:
+                    blockers.append(step)
+
+    def _active_set(self) -> Iterable[int]:
+        if self._priority is None or self._deliberate:
+            return super()._active_set()
+        return [i for i in self._priority if i > self._finalized_idx]
+
+    def run_to_completion(self, inputs: dict[str, bytes | Erasure]) -> dict[str, State[bytes | Erasure]]:
+        self._prioritize(inputs)
+        try:
+            return super().run_to_completion(inputs)
+        finally:
+            if self.jobserver is not None:
+                self.jobserver.close()
+            if self.supervisor is not None:
+                self.supervisor.close()
+            if self.history is not None:
+                self._record()
+
+    def _record(self) -> None:
+        from .base_rule import GenericPreparedStep
+
+        assert self.history is not None
+        for step in self._steps:
+            if isinstance(step, GenericPreparedStep) and not step.cancelled and step.batches:
+                self.history.record(step.prefixed_name, step.match_prefix, step.elapsed, step.files)
+                if cost := fit_batch_cost(step.batch_samples):
+                    self.history.record_batch_cost(step.prefixed_name, cost)
+        self.history.save()
+
+    def eta(self) -> Optional[float]:
+        """
+        Estimated seconds until the run finishes, or None without history.
+
+        This assumes the remaining work spreads evenly over the threads, but
+        can't be done sooner than the longest remaining step.
+        """
+        if not self.expected:
+            return None
+        remaining = []
+        for index, cost in self.expected.items():
+            step: GenericPreparedStep = self._steps[index]  # type: ignore[assignment]
+            if not step.outputs_final:
+                remaining.append(max(cost - step.elapsed - step.running_for(), 0.0))
+        if not remaining:
+            return 0.0
+        return max(sum(remaining) / self._parallelism, max(remaining))
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return ""
+    seconds = round(seconds)
+    if seconds >= 60:
+        return f"ETA {seconds // 60}m{seconds % 60:02d}s"
+    return f"ETA {seconds}s"
@@ -1,10 +1,14 @@
 from __future__ import annotations
 
 import os
+import signal
 import subprocess
+import sys
+import time
+from dataclasses import dataclass
 from logging import getLogger
 from pathlib import Path
-from typing import Any, Sequence
+from typing import Any, Mapping, Optional, Sequence
 
 from keke import ktrace
 from vmodule import VLOG_1, VLOG_2
@@ -34,3 +38,185 @@ def run_cmd_status(cmd: Sequence[str | Path], check: bool = True, cwd: str | Pat
 def run_cmd(cmd: Sequence[str | Path], check: bool = True, cwd: str | Path | None = None, **kwargs: Any) -> str:
     output, _ = run_cmd_status(cmd, check, cwd, **kwargs)
     return output
+
+
+@dataclass
+class Usage:
+    """
+    Where a rule's batches spent their time, and what their processes used.
+
+    One of these is kept for each batch, and they're added up for each step
+    (and project).  The rusage fields come from `os.wait4`, so they cover
+    the command and any children it waited for.
+    """
+
+    batches: int = 0
+    #: Wall-clock seconds writing the batch's files out, running the command,
+    #: and finding what it changed
+    materialize: float = 0.0
+    execute: float = 0.0
+    analyze: float = 0.0
+    #: CPU seconds
+    user: float = 0.0
+    system: float = 0.0
+    #: The most memory any one batch had resident, in KiB
+    max_rss_kb: int = 0
+    #: Blocks read and written
+    inblock: int = 0
+    oublock: int = 0
+
+    @classmethod
+    def from_rusage(cls, rusage: Any, execute: float) -> Usage:
+        # macOS gives bytes rather than KiB
+        max_rss_kb = rusage.ru_maxrss // 1024 if sys.platform == "darwin" else rusage.ru_maxrss
+        return cls(
+            batches=1,
+            execute=execute,
+            user=rusage.ru_utime,
+            system=rusage.ru_stime,
+            max_rss_kb=max_rss_kb,
+            inblock=rusage.ru_inblock,
+            oublock=rusage.ru_oublock,
+        )
+
+    def add(self, other: Usage) -> None:
+        self.batches += other.batches
+        self.materialize += other.materialize
+        self.execute += other.execute
+        self.analyze += other.analyze
+        self.user += other.user
+        self.system += other.system
+        self.max_rss_kb = max(self.max_rss_kb, other.max_rss_kb)
+        self.inblock += other.inblock
+        self.oublock += other.oublock
+
+    def __str__(self) -> str:
+        # Short enough for trace args
+        return (
+            f"{self.batches} batch{'' if self.batches == 1 else 'es'}: materialize {self.materialize:.3f}s, execute {self.execute:.3f}s, "
+            f"analyze {self.analyze:.3f}s, user {self.user:.3f}s, system {self.system:.3f}s, "
+            f"max RSS {self.max_rss_kb} KiB, {self.inblock} blocks in, {self.oublock} out"
+        )
+
+
+class _WaitPopen(subprocess.Popen[bytes]):
+    """A `Popen` that reaps its process with `os.wait4`, keeping its rusage."""
+
+    rusage: Any = None
+
+    def _try_wait(self, wait_flags: int) -> tuple[int, int]:
+        # Overrides the private method that all of Popen's waiting goes through
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # As Popen does when waiting for children has been disabled
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, status)
+
+
+class ResourceLimits:
+    """
+    Limits on a child's CPU time and address space.
+
+    Going over the CPU limit kills the child with SIGXCPU; going over the
+    memory limit makes its allocations fail.
+
+    They're set by a `preexec_fn`, in the child before it execs, so that
+    nothing the command does escapes them.  That rules out `subprocess`'s
+    fast vfork path, so only rules with limits pay for it.
+    """
+
+    def __init__(self, cpu_seconds: Optional[float], memory_mb: Optional[int]) -> None:
+        import resource
+
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.rlimits: list[tuple[int, tuple[int, int]]] = []
+        if cpu_seconds is not None:
+            soft = max(1, int(cpu_seconds + 0.999))
+            # The hard limit is a backstop, in case SIGXCPU is ignored
+            self.rlimits.append((resource.RLIMIT_CPU, (soft, soft + 1)))
+        if memory_mb is not None:
+            limit = memory_mb * 1024 * 1024
+            self.rlimits.append((resource.RLIMIT_AS, (limit, limit)))
+
+    def preexec_fn(self) -> None:
+        """Sets the limits on the current process; pass as `preexec_fn`."""
+        import resource
+
+        for which, limits in self.rlimits:
+            resource.setrlimit(which, limits)
+
+
+def kill_group(proc: subprocess.Popen[bytes]) -> None:
+    """
+    Kills `proc`, started with `start_new_session=True`, along with anything
+    it started that's still running (and holding its pipes open).
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # All gone already
+        pass
+
+
+def limit_resources(cpu_seconds: Optional[float] = None, memory_mb: Optional[int] = None) -> Optional[ResourceLimits]:
+    """
+    Returns the `ResourceLimits` for a child, or None if there are no limits
+    (or no way to set them on this platform).
+    """
+    if cpu_seconds is None and memory_mb is None:
+        return None
+    try:
+        import resource  # noqa: F401
+    except ImportError:
+        LOG.warning("Resource limits aren't supported on this platform, ignoring them")
+        return None
+    return ResourceLimits(cpu_seconds, memory_mb)
+
+
+@ktrace("cmd", "cwd")
+def run_batch(
+    cmd: Sequence[str | Path],
+    *,
+    cwd: str | Path,
+    env: Mapping[str, str],
+    timeout: Optional[float] = None,
+    limits: Optional[ResourceLimits] = None,
+    pass_fds: Sequence[int] = (),
+) -> tuple[int, bytes, bytes, Usage]:
+    """
+    Runs one batch of a rule's command, returning (returncode, stdout, stderr,
+    usage).
+
+    Unlike `run_cmd`, this leaves the output undecoded, since it's usually
+    empty, and only uses a `preexec_fn` for `limits` (see `ResourceLimits`),
+    so that starting a process from a large, busy parent stays cheap.  Raises
+    `subprocess.TimeoutExpired` after killing a command (and its children)
+    that's still running after `timeout` seconds.
+    """
+    LOG.log(VLOG_1, "Run %s in %s", cmd, cwd)
+    start = time.monotonic()
+    with _WaitPopen(
+        cmd,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        pass_fds=pass_fds,
+        preexec_fn=limits.preexec_fn if limits else None,
+        start_new_session=True,
+    ) as proc:
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except BaseException:
+            # Including ctrl-c, which no longer reaches the command itself
+            kill_group(proc)
+            proc.communicate()
+            raise
+    execute = time.monotonic() - start
+    LOG.log(VLOG_2, "Ran %s -> %s", cmd, proc.returncode)
+    usage = Usage.from_rusage(proc.rusage, execute) if proc.rusage else Usage(batches=1, execute=execute)
+    return proc.returncode, stdout, stderr, usage
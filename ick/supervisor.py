@@ -0,0 +1,231 @@
+"""
+Runs rules' processes from one asyncio event loop, rather than from a worker
+thread blocked on each.
+
+Worker threads still prepare each batch and look at what its process did
+afterwards, but while the process runs, the thread is free to do the same for
+other batches.  So how many processes run at once (`max_processes`) no longer
+depends on how many threads there are, which matters for rules that spend
+their time waiting on I/O rather than using a core.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import os
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Mapping, Optional, Sequence
+
+from vmodule import VLOG_1, VLOG_2
+
+from .sh import ResourceLimits, Usage, kill_group
+
+LOG = getLogger(__name__)
+
+#: How much of each of a process's stdout and stderr is kept; rules' output
+#: is shown to people, so anything past this is just counted
+MAX_OUTPUT = 1024 * 1024
+
+_READ_SIZE = 65536
+
+
+@dataclass(frozen=True)
+class ProcessResult:
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+    timed_out: bool = False
+    usage: Optional[Usage] = None
+
+
+async def _read_bounded(stream: asyncio.StreamReader, limit: int) -> bytes:
+    """Reads `stream` until EOF, keeping at most `limit` bytes of it."""
+    chunks = []
+    kept = dropped = 0
+    while chunk := await stream.read(_READ_SIZE):
+        room = max(limit - kept, 0)
+        chunks.append(chunk[:room])
+        kept += min(room, len(chunk))
+        dropped += len(chunk) - min(room, len(chunk))
+    if dropped:
+        chunks.append(f"\n[{dropped} more bytes not shown]\n".encode())
+    return b"".join(chunks)
+
+
+async def _connect(pipe: Any) -> tuple[asyncio.StreamReader, asyncio.BaseTransport]:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader, transport
+
+
+def _set_once(future: asyncio.Future[None]) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+async def _reap(proc: subprocess.Popen[bytes]) -> tuple[int, Any]:
+    """
+    Waits for `proc` to exit, returning its returncode and rusage.
+
+    asyncio's own subprocesses are reaped with `waitpid`, which loses the
+    rusage, so this waits on a pidfd where there are those (Linux), and blocks
+    an executor thread on `os.wait4` elsewhere.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        _, status, rusage = await loop.run_in_executor(None, os.wait4, proc.pid, 0)
+    else:
+        try:
+            exited = loop.create_future()
+            loop.add_reader(pidfd, _set_once, exited)
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+        finally:
+            os.close(pidfd)
+        _, status, rusage = os.wait4(proc.pid, 0)
+    # So that Popen doesn't wait (or signal) it again
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, rusage
+
+
+class Supervisor:
+    """
+    Starts processes on an event loop in its own thread, and tells callers (in
+    any thread) how they went through a `concurrent.futures.Future`.
+
+    At most `max_processes` run at once; the rest wait their turn.  Callers can
+    `reserve` a place first, so that they don't prepare work that would only
+    wait.
+    """
+
+    def __init__(self, max_processes: int, *, max_output: int = MAX_OUTPUT) -> None:
+        assert max_processes > 0
+        self.max_processes = max_processes
+        self.max_output = max_output
+        self._reserved = 0
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._running = asyncio.Semaphore(max_processes)
+        #: Started and not yet reaped, to kill if we're closed first
+        self._procs: set[subprocess.Popen[bytes]] = set()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="ick-supervisor", daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> Supervisor:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def reserve(self) -> bool:
+        """Takes one of the `max_processes` places, returning whether there was one free."""
+        with self._lock:
+            if self._reserved >= self.max_processes:
+                return False
+            self._reserved += 1
+            return True
+
+    def release(self) -> None:
+        """Gives back a place from `reserve`."""
+        with self._lock:
+            assert self._reserved > 0
+            self._reserved -= 1
+
+    def submit(
+        self,
+        cmd: Sequence[str | Path],
+        *,
+        cwd: str | Path,
+        env: Mapping[str, str],
+        timeout: Optional[float] = None,
+        limits: Optional[ResourceLimits] = None,
+        **kwargs: Any,
+    ) -> concurrent.futures.Future[ProcessResult]:
+        """
+        Runs `cmd`, capturing its output.
+
+        The future's result has `timed_out` set if it was killed for running
+        longer than `timeout` seconds; if it couldn't be started at all, the
+        future raises the `OSError` instead.  Output is left undecoded.  Other
+        `kwargs` are as for `subprocess.Popen`.
+        """
+        return asyncio.run_coroutine_threadsafe(self._run(cmd, cwd=cwd, env=env, timeout=timeout, limits=limits, **kwargs), self._loop)
+
+    async def _run(
+        self,
+        cmd: Sequence[str | Path],
+        *,
+        cwd: str | Path,
+        env: Mapping[str, str],
+        timeout: Optional[float],
+        limits: Optional[ResourceLimits],
+        **kwargs: Any,
+    ) -> ProcessResult:
+        async with self._running:
+            LOG.log(VLOG_1, "Run %s in %s", cmd, cwd)
+            start = time.monotonic()
+
+            # Started with Popen rather than asyncio.create_subprocess_exec so
+            # that it's reaped with wait4 (see `_reap`), and in the executor
+            # so that the loop isn't held up by fork and exec meanwhile.  In
+            # its own session, so that on timeout we can kill what it started
+            # too.
+            def popen() -> subprocess.Popen[bytes]:
+                return subprocess.Popen(
+                    list(map(str, cmd)),
+                    cwd=cwd,
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    preexec_fn=limits.preexec_fn if limits else None,
+                    start_new_session=True,
+                    **kwargs,
+                )
+
+            proc = await asyncio.get_running_loop().run_in_executor(None, popen)
+            self._procs.add(proc)
+            reap = asyncio.ensure_future(_reap(proc))
+            stdout_reader, stdout_transport = await _connect(proc.stdout)
+            stderr_reader, stderr_transport = await _connect(proc.stderr)
+            output = [
+                asyncio.ensure_future(_read_bounded(stdout_reader, self.max_output)),
+                asyncio.ensure_future(_read_bounded(stderr_reader, self.max_output)),
+            ]
+            try:
+                _, running = await asyncio.wait((reap, *output), timeout=timeout)
+                if running:
+                    LOG.log(VLOG_1, "Killing %s after %ss", cmd, timeout)
+                    for task in output:
+                        task.cancel()
+                    kill_group(proc)
+                returncode, rusage = await reap
+            finally:
+                self._procs.discard(proc)
+                stdout_transport.close()
+                stderr_transport.close()
+            usage = Usage.from_rusage(rusage, time.monotonic() - start)
+            if running:
+                return ProcessResult(returncode=returncode, stdout=b"", stderr=b"", timed_out=True, usage=usage)
+            stdout, stderr = (task.result() for task in output)
+            LOG.log(VLOG_2, "Ran %s -> %s", cmd, returncode)
+            return ProcessResult(returncode=returncode, stdout=stdout, stderr=stderr, usage=usage)
+
+    def close(self) -> None:
+        if self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        for proc in self._procs:
+            kill_group(proc)
+        self._loop.close()
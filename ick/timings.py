@@ -0,0 +1,100 @@
+"""
+Where ick's own time goes: phase timings for `ick run --timings`, and
+`--profile`.
+"""
+
+from __future__ import annotations
+
+import cProfile
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+from keke import kev
+
+
+class PhaseTimings:
+    """
+    Seconds spent in each phase of a command, in the order they were first
+    entered.  A phase can be entered more than once, e.g. for each result.
+
+    Phases can be nested; time in an inner phase (in the same thread) only
+    counts toward that one.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.monotonic()
+        self.seconds: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.start = time.monotonic()
+            self.seconds.clear()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        #: Seconds spent in inner phases, for each phase we're in
+        nested: list[float] = self._local.__dict__.setdefault("nested", [])
+        nested.append(0.0)
+        with self._lock:
+            self.seconds.setdefault(name, 0.0)
+        start = time.monotonic()
+        try:
+            with kev(name, cat="phase"):
+                yield
+        finally:
+            seconds = time.monotonic() - start
+            inner = nested.pop()
+            if nested:
+                nested[-1] += seconds
+            with self._lock:
+                self.seconds[name] += seconds - inner
+
+    def summary(self) -> str:
+        total = time.monotonic() - self.start
+        with self._lock:
+            rows = list(self.seconds.items())
+        rows.append(("other", max(total - sum(seconds for _, seconds in rows), 0.0)))
+        width = max(len(name) for name, _ in rows)
+        lines = [f"{name:{width}}  {seconds:8.3f}s  {seconds / total if total else 0:4.0%}" for name, seconds in rows]
+        lines.append(f"{'total':{width}}  {total:8.3f}s")
+        return "\n".join(lines) + "\n"
+
+
+#: For the command being run
+TIMINGS = PhaseTimings()
+
+
+@contextmanager
+def profiling(filename: str) -> Iterator[None]:
+    """
+    Profiles everything in the block with cProfile, saving the stats to
+    `filename` (for `pstats`, snakeviz, etc).
+    """
+    profiles = [cProfile.Profile()]
+    if sys.version_info < (3, 12):
+        # Before 3.12, a profile only sees the thread that enabled it, and
+        # most of a run happens in worker threads
+        lock = threading.Lock()
+
+        def start_thread(*args: Any) -> None:
+            sys.setprofile(None)
+            profile = cProfile.Profile()
+            with lock:
+                profiles.append(profile)
+            profile.enable()
+
+        threading.setprofile(start_thread)
+    profiles[0].enable()
+    try:
+        yield
+    finally:
+        profiles[0].disable()
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        pstats.Stats(*profiles).dump_stats(filename)
@@ -1,9 +1,12 @@
 from __future__ import annotations
 
+import os
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from shutil import copytree
+from shutil import copytree, rmtree
 from tempfile import TemporaryDirectory
-from typing import Callable, ContextManager, Iterable, Sequence, TypeVar
+from typing import Any, Callable, ContextManager, Iterable, Iterator, Optional, Sequence, TypeVar
 
 from msgspec import Struct
 
@@ -61,3 +64,96 @@ def maybe_repo(path: Path, enter_context: Callable[[ContextManager[_T]], _T], fo
     else:
         # Basically pretends to be empty, but if you try to clone_aside it will raise
         return BaseRepo(path)
+
+
+def tree_zfiles(path: Path) -> Optional[str]:
+    """
+    List the files under `path` like `git ls-files -z` would once they're added.
+
+    Returns None if there's a `.gitignore`, because then only git can say.
+    """
+    names: list[str] = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        if ".gitignore" in filenames:
+            return None
+        rel = Path(dirpath).relative_to(path)
+        for d in dirnames:
+            # git lists a symlink to a directory as a file; os.walk doesn't descend it
+            if os.path.islink(os.path.join(dirpath, d)):
+                names.append((rel / d).as_posix())
+        dirnames[:] = [d for d in dirnames if d != ".git"]
+        names.extend((rel / f).as_posix() for f in filenames if f != ".git")
+    return "".join(f"{name}\0" for name in sorted(names))
+
+
+class RepoPool:
+    """
+    Empty git repos to hold rule test inputs that need real git to list them.
+
+    Creating a repo costs a `git init`, so they're reused once a test is done
+    with one rather than deleted.  The repos are all deleted when the pool is
+    closed.
+    """
+
+    def __init__(self) -> None:
+        self._td = TemporaryDirectory(prefix="ick-repos-")
+        self._lock = threading.Lock()
+        self._free: list[Path] = []
+        self._created = 0
+
+    def __enter__(self) -> RepoPool:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._td.cleanup()
+
+    def _acquire(self) -> Path:
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self._created += 1
+            root = Path(self._td.name, str(self._created))
+        root.mkdir()
+        run_cmd(["git", "init", "-q"], cwd=root)
+        return root
+
+    def _release(self, root: Path) -> None:
+        # Nothing is ever added to the index, so emptying the worktree is enough
+        for child in root.iterdir():
+            if child.name == ".git":
+                continue
+            if child.is_dir() and not child.is_symlink():
+                rmtree(child)
+            else:
+                child.unlink()
+        with self._lock:
+            self._free.append(root)
+
+    @contextmanager
+    def repo(self, contents: Path) -> Iterator[BaseRepo]:
+        """A repo holding a copy of `contents`, for the duration of the `with`."""
+        root = self._acquire()
+        try:
+            copytree(contents, root, dirs_exist_ok=True)
+            zfiles = run_cmd(["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"], cwd=root)
+            yield BaseRepo(root, zfiles=zfiles)
+        finally:
+            self._release(root)
+
+
+def rule_test_repo(path: Path, enter_context: Callable[[ContextManager[BaseRepo]], BaseRepo], pool: RepoPool) -> BaseRepo:
+    """
+    A repo with the contents of a rule test's `input/` directory.
+
+    Rules run in their own directories, so usually this just lists `path` in
+    place; git (from `pool`) is only used when there's a `.gitignore` to honor.
+    """
+    if (path / ".git").exists():
+        return Repo(path)
+    zfiles = tree_zfiles(path)
+    if zfiles is not None:
+        return BaseRepo(path, zfiles=zfiles)
+    return enter_context(pool.repo(path))
@@ -1,9 +1,13 @@
+import hashlib
 import os
 import re
 from collections.abc import Sequence
 from pathlib import Path
 from typing import Any
 
+#: (size, sha256 hex digest) of a file's contents
+FileEntry = tuple[int, str]
+
 
 def merge(a, b):  # type: ignore[no-untyped-def] # FIX ME
     if a is None:
@@ -93,6 +97,30 @@ def diffstat(diff_text: str) -> str:
     return s
 
 
+def bytes_entry(data: bytes) -> FileEntry:
+    return len(data), hashlib.sha256(data).hexdigest()
+
+
+def tree_manifest(root: Path) -> dict[str, FileEntry]:
+    """
+    The size and hash of every file under `root`, by slash-separated relative path.
+
+    Comparing two of these is much cheaper than comparing the trees' files, and
+    only the ones whose entries differ need reading again to show a diff.
+    """
+    manifest: dict[str, FileEntry] = {}
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        rel = Path(dirpath).relative_to(root)
+        for name in filenames:
+            try:
+                with open(Path(dirpath, name), "rb") as f:
+                    manifest[(rel / name).as_posix()] = (os.fstat(f.fileno()).st_size, hashlib.file_digest(f, "sha256").hexdigest())
+            except FileNotFoundError:
+                # Dangling symlink, which isn't a file
+                continue
+    return manifest
+
+
 def convert_path_to_python_identifiers(path: Path) -> Path:
     return Path(*[part.replace("-", "_") for part in path.parts])
 
@@ -0,0 +1,191 @@
+"""
+Waits for files to change under some directories, for `ick test-rules --watch`.
+
+On Linux this uses inotify (through ctypes, so there's nothing to install);
+elsewhere, or if that fails, it falls back to polling mtimes.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from abc import ABC, abstractmethod
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from vmodule import VLOG_1
+
+LOG = getLogger(__name__)
+
+#: Directories that never hold anything a rule test depends on
+SKIP_DIRS = {".git", "__pycache__", ".mypy_cache", ".ruff_cache", ".pytest_cache"}
+
+#: How long to keep collecting changes after the first, so that saving several
+#: files (or an editor's write-then-rename) is handled as one change
+SETTLE_TIME = 0.05
+
+POLL_INTERVAL = 0.25
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT = struct.Struct("iIII")
+
+
+def _walk_dirs(root: Path) -> Iterable[Path]:
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+        yield Path(dirpath)
+
+
+class Watcher(ABC):
+    def __init__(self, roots: Iterable[Path]) -> None:
+        self.roots = [Path(r).resolve() for r in roots]
+
+    def __enter__(self) -> Watcher:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        pass
+
+    @abstractmethod
+    def wait(self, timeout: Optional[float] = None) -> set[Path]:
+        """
+        Blocks until something changes, and returns the paths that did.
+
+        Returns an empty set if nothing changed within `timeout` seconds.
+        """
+
+
+class InotifyWatcher(Watcher):
+    def __init__(self, roots: Iterable[Path]) -> None:
+        super().__init__(roots)
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs: dict[int, Path] = {}
+        for root in self.roots:
+            self._watch_tree(root)
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _watch_tree(self, root: Path) -> None:
+        for d in _walk_dirs(root):
+            wd = self._add_watch(self.fd, os.fsencode(d), _WATCH_MASK)
+            if wd < 0:
+                # Most likely deleted already, or out of watches (see
+                # fs.inotify.max_user_watches)
+                LOG.log(VLOG_1, "Unable to watch %s: %s", d, os.strerror(ctypes.get_errno()))
+                continue
+            self.dirs[wd] = d
+
+    def _read(self, changed: set[Path]) -> None:
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+            name = os.fsdecode(buf[offset + _EVENT.size : offset + _EVENT.size + length].rstrip(b"\0"))
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so anything could have changed
+                changed.update(self.roots)
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            parent = self.dirs.get(wd)
+            if parent is None:
+                continue
+            path = parent / name
+            if mask & IN_ISDIR:
+                if name in SKIP_DIRS:
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Anything already in it was made before we were watching
+                    self._watch_tree(path)
+                    for d in _walk_dirs(path):
+                        try:
+                            changed.update(d.iterdir())
+                        except OSError:
+                            pass
+            changed.add(path)
+
+    def wait(self, timeout: Optional[float] = None) -> set[Path]:
+        changed: set[Path] = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            self._read(changed)
+            ready, _, _ = select.select([self.fd], [], [], SETTLE_TIME)
+        return changed
+
+
+class PollingWatcher(Watcher):
+    def __init__(self, roots: Iterable[Path], interval: float = POLL_INTERVAL) -> None:
+        super().__init__(roots)
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self) -> dict[Path, tuple[int, int]]:
+        snapshot = {}
+        for root in self.roots:
+            for d in _walk_dirs(root):
+                try:
+                    entries = list(os.scandir(d))
+                except OSError:
+                    continue
+                for entry in entries:
+                    if entry.name in SKIP_DIRS:
+                        continue
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    snapshot[Path(entry.path)] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def wait(self, timeout: Optional[float] = None) -> set[Path]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            new = self._scan()
+            changed = {p for p in self.snapshot.keys() | new.keys() if self.snapshot.get(p) != new.get(p)}
+            self.snapshot = new
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+            time.sleep(self.interval)
+
+
+def watcher(roots: Iterable[Path]) -> Watcher:
+    """The best available `Watcher` for this platform."""
+    roots = list(roots)
+    if sys.platform == "linux":
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as e:
+            LOG.log(VLOG_1, "inotify unavailable, polling instead: %s", e)
+    return PollingWatcher(roots)
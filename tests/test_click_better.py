@@ -1,9 +1,11 @@
 from __future__ import annotations
 
 import click
+import pytest
 from click.testing import CliRunner
 
-from ick.click_better import FlexibleGroup
+from ick.click_better import FlexibleGroup, LazyEnumChoice, Shard
+from ick_protocol import Scope
 
 
 @click.group(cls=FlexibleGroup)
@@ -80,3 +82,20 @@ def test_double_dash_stops_lifting() -> None:
     # --target after -- is not lifted, passed as subcommand positional (click will error)
     # The key is it should NOT silently apply --target to the group
     assert "target=default" in result.output or result.exit_code != 0
+
+
+def test_shard() -> None:
+    shard = Shard()
+    assert shard.convert("2/4", None, None) == (2, 4)
+    assert shard.convert((1, 1), None, None) == (1, 1)
+    for bad in ("0/4", "5/4", "2", "a/b", "2/"):
+        with pytest.raises(click.BadParameter):
+            shard.convert(bad, None, None)
+
+
+def test_lazy_enum_choice() -> None:
+    choice = LazyEnumChoice("ick_protocol", "Scope")
+    assert "_choice" not in choice.__dict__
+    assert choice.convert("FILE", None, None) == Scope.FILE
+    with pytest.raises(click.BadParameter):
+        choice.convert("galaxy", None, None)
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import re
+import subprocess
+import sys
 from types import SimpleNamespace
 from typing import cast
 
@@ -69,3 +72,35 @@ def test_flatten_tags_splits_commas_and_dedupes_flags() -> None:
 
 def test_flatten_tags_empty() -> None:
     assert _flatten_tags(()) == set()
+
+
+#: Modules that aren't needed just to show help, and are slow to import.
+HEAVY_MODULES = ("rich", "msgspec", "yaml", "feedforward", "moreorless", "keke", "ick_protocol", "ick.config", "ick.runner")
+
+#: How much longer ick.cmdline can take to import than click, which it can't
+#: avoid.  This is around 1.6 today, and was over 5 with everything imported
+#: eagerly.  A ratio holds up better than wall time when tests share the CPU.
+IMPORT_TIME_BUDGET = 2.5
+
+
+def _import_times(*args: str) -> dict[str, int]:
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-m", "ick", *args], capture_output=True, encoding="utf-8", check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if m := re.fullmatch(r"import time:\s+\d+ \|\s+(\d+) \| *(\S+)", line):
+            times[m.group(2)] = int(m.group(1))
+    return times
+
+
+def test_help_imports_are_lazy() -> None:
+    times = _import_times("--help")
+    assert "ick.cmdline" in times
+    for name in HEAVY_MODULES:
+        assert name not in times, f"{name} imported by `ick --help`"
+
+    # Timing is noisy, so take the best of a few.
+    ratios = []
+    for _ in range(3):
+        times = _import_times("--help")
+        ratios.append(times["ick.cmdline"] / times["click"])
+    assert min(ratios) < IMPORT_TIME_BUDGET
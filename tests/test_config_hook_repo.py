@@ -6,9 +6,11 @@ from subprocess import CalledProcessError
 import pytest
 from pytest_mock import MockerFixture
 
-from ick.config import MainConfig, RuleConfig, RuleRepoConfig, RulesConfig, Ruleset, RuntimeConfig, Settings
-from ick.config.rule_repo import discover_rules, get_impl, load_pyproject, load_rule_repo
-from ick_protocol import Scope
+from ick._regex_translate import rule_name_re
+from ick.config import FilterConfig, MainConfig, RuleConfig, RuleRepoConfig, RulesConfig, Ruleset, RuntimeConfig, Settings, rule_repo
+from ick.config.rule_repo import RuleSelector, discover_rules, get_impl, load_pyproject, load_rule_repo
+from ick.sh import run_cmd
+from ick_protocol import Scope, Urgency
 
 
 def test_load_rule_repo() -> None:
@@ -134,3 +136,112 @@ def test_discover_warns_on_failure(monkeypatch: pytest.MonkeyPatch, caplog: pyte
 
     assert len(rules) == 3
     assert "broken" in caplog.text
+
+
+def _write_rule_repo(path: Path) -> None:
+    (path / "sub").mkdir(parents=True)
+    (path / "ick.toml").write_text('[[rule]]\nname = "a"\nimpl = "shell"\ncommand = "true"\n')
+    (path / "sub" / "ick.toml").write_text('[[rule]]\nname = "b"\nimpl = "shell"\ncommand = "true"\n')
+
+
+def test_load_rule_repo_uses_catalog_cache(tmp_path: Path, mocker: MockerFixture) -> None:
+    _write_rule_repo(tmp_path / "rules")
+    r = Ruleset(base_path=tmp_path, path="rules")
+
+    first = load_rule_repo(r)
+    assert [rule.full_name for rule in first.rule] == ["a", "sub/b"]
+
+    decode = mocker.patch("ick.config.rule_repo.load_regular", side_effect=AssertionError("should be cached"))
+    second = load_rule_repo(r)
+    assert [(rule.prefixed_name, rule.command, rule.test_path) for rule in second.rule] == [
+        (rule.prefixed_name, rule.command, rule.test_path) for rule in first.rule
+    ]
+    assert second.rule[1].script_path == tmp_path / "rules" / "sub" / "b"
+    decode.assert_not_called()
+
+
+def test_catalog_cache_notices_changes(tmp_path: Path) -> None:
+    _write_rule_repo(tmp_path / "rules")
+    r = Ruleset(base_path=tmp_path, path="rules", prefix="p")
+    assert [rule.prefixed_name for rule in load_rule_repo(r).rule] == ["p:a", "p:sub/b"]
+
+    # Edited config file
+    (tmp_path / "rules" / "ick.toml").write_text('[[rule]]\nname = "renamed"\nimpl = "shell"\ncommand = "true"\n')
+    assert [rule.prefixed_name for rule in load_rule_repo(r).rule] == ["p:renamed", "p:sub/b"]
+
+    # Brand new config file in a brand new directory
+    (tmp_path / "rules" / "sub" / "deeper").mkdir()
+    (tmp_path / "rules" / "sub" / "deeper" / "ick.toml").write_text('[[rule]]\nname = "c"\nimpl = "shell"\ncommand = "true"\n')
+    assert [rule.prefixed_name for rule in load_rule_repo(r).rule] == ["p:renamed", "p:sub/b", "p:sub/deeper/c"]
+
+    # Removed config file
+    (tmp_path / "rules" / "sub" / "ick.toml").unlink()
+    assert [rule.prefixed_name for rule in load_rule_repo(r).rule] == ["p:renamed", "p:sub/deeper/c"]
+
+
+def test_catalog_cache_is_per_prefix(tmp_path: Path) -> None:
+    _write_rule_repo(tmp_path / "rules")
+    a = load_rule_repo(Ruleset(base_path=tmp_path, path="rules", prefix="a"))
+    b = load_rule_repo(Ruleset(base_path=tmp_path, path="rules", prefix="b"))
+    assert a.rule[0].prefixed_name == "a:a"
+    assert b.rule[0].prefixed_name == "b:a"
+
+
+def test_catalog_cache_for_url_is_keyed_by_head(tmp_path: Path, mocker: MockerFixture) -> None:
+    checkout = tmp_path / "checkout"
+    _write_rule_repo(checkout)
+    run_cmd(["git", "init"], cwd=checkout)
+    run_cmd(["git", "add", "."], cwd=checkout)
+    run_cmd(["git", "commit", "-m", "init"], cwd=checkout)
+    mocker.patch("ick.config.rule_repo.local_cache_path", return_value=checkout)
+    r = Ruleset(url="https://example.com/rules.git", prefix="rules")
+
+    assert [rule.name for rule in load_rule_repo(r).rule] == ["a", "b"]
+
+    # Same HEAD means the cache is used, even though the working tree changed.
+    (checkout / "ick.toml").write_text('[[rule]]\nname = "renamed"\nimpl = "shell"\ncommand = "true"\n')
+    assert [rule.name for rule in load_rule_repo(r).rule] == ["a", "b"]
+
+    run_cmd(["git", "commit", "-am", "rename"], cwd=checkout)
+    assert [rule.name for rule in load_rule_repo(r).rule] == ["renamed", "b"]
+
+
+def _name_filter(name: str) -> FilterConfig:
+    return FilterConfig(name_filter_re=rule_name_re(name), legacy_name_filter_re=rule_name_re(name, legacy=True))
+
+
+def test_load_rule_repo_skips_dirs_that_cannot_match(tmp_path: Path, mocker: MockerFixture) -> None:
+    _write_rule_repo(tmp_path / "rules")
+    (tmp_path / "rules" / "other").mkdir()
+    (tmp_path / "rules" / "other" / "ick.toml").write_text("this is not valid toml")
+    r = Ruleset(base_path=tmp_path, path="rules", prefix="p")
+
+    rc = load_rule_repo(r, RuleSelector(_name_filter("sub/b")))
+    # The root config can always hold a matching name, but other/ is never read.
+    assert [rule.full_name for rule in rc.rule] == ["a", "sub/b"]
+
+    # The legacy form can reach into the same directory
+    rc = load_rule_repo(r, RuleSelector(_name_filter("p:sub")))
+    assert [rule.full_name for rule in rc.rule] == ["a", "sub/b"]
+
+    # Partial loads aren't cached, so a full load still sees everything.
+    with pytest.raises(Exception, match="Expected '='"):
+        load_rule_repo(r)
+
+
+def test_discover_rules_with_filter(mocker: MockerFixture) -> None:
+    r1 = Ruleset(base_path=Path.cwd(), path="tests/fixture_rules", prefix="a")
+    r2 = Ruleset(base_path=Path.cwd(), path="tests/fixture_rules", prefix="b")
+    rtc = RuntimeConfig(main_config=MainConfig(), rules_config=RulesConfig(ruleset=[r1, r2]), settings=Settings())
+
+    rules = discover_rules(rtc, _name_filter("hello"))
+    assert [rule.prefixed_name for rule in rules] == ["a:hello", "b:hello"]
+
+    rules = discover_rules(rtc, FilterConfig(min_urgency=Urgency.NOW))
+    assert [rule.prefixed_name for rule in rules] == ["a:hello", "b:hello"]
+
+    # A legacy name can only match one ruleset, and the other is never loaded.
+    load = mocker.spy(rule_repo, "load_rule_repo")
+    rules = discover_rules(rtc, _name_filter("b:hello"))
+    assert [rule.prefixed_name for rule in rules] == ["b:hello"]
+    assert [c.args[0].prefix for c in load.call_args_list] == ["b"]
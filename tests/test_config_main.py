@@ -17,6 +17,17 @@ def test_load_pyproject_errors() -> None:
     assert load_pyproject(Path(), b"[tool.ick.baz]") == MainConfig()
 
 
+def test_concurrency_inherit() -> None:
+    conf = MainConfig(concurrency={"python": 4})
+    conf.inherit(MainConfig(concurrency={"docker": 2, "python": 8}))
+    assert conf.concurrency == {"docker": 2, "python": 4}
+
+    conf = MainConfig()
+    conf.inherit(MainConfig(concurrency={"docker": 2}))
+    assert conf.concurrency == {"docker": 2}
+    assert load_main_config(Path.cwd(), isolated_repo=True).concurrency == {"docker": 2}
+
+
 def test_load_repo_settings_missing_file(tmp_path: Path) -> None:
     assert _load_repo_settings(tmp_path, RepoSettings(file="nonexistent.yaml", key="ick")) is None
 
@@ -1,10 +1,23 @@
+import os
 import sys
+import time
 from pathlib import Path
 
 import pytest
 from pytest_mock import MockerFixture
 
-from ick.git import _get_local_cache_name, _is_sha, _split_url_ref, find_repo_root, update_local_cache
+from ick.git import (
+    _fetch_stamp_path,
+    _get_local_cache_name,
+    _is_sha,
+    _split_url_ref,
+    _store_path,
+    find_repo_root,
+    local_cache_path,
+    prune_worktrees,
+    refresh_local_cache,
+    update_local_cache,
+)
 from ick.sh import run_cmd
 
 
@@ -113,8 +126,6 @@ def test_update_local_cache_branch_clone(tmp_path: Path, mocker: MockerFixture)
     assert branch == "printf-repr"
 
 
-# Apple git doesn't ship with the --revision flag just yet
-@pytest.mark.skipif(sys.platform == "darwin", reason="Apple git lacks --revision flag")
 def test_update_local_cache_sha_clone(tmp_path: Path, mocker: MockerFixture) -> None:
     """Test cloning a SHA ref."""
     mocker.patch("platformdirs.user_cache_dir", return_value=tmp_path)
@@ -131,8 +142,6 @@ def test_update_local_cache_sha_clone(tmp_path: Path, mocker: MockerFixture) ->
     assert branch == ""
 
 
-# Apple git doesn't ship with the --revision flag just yet
-@pytest.mark.skipif(sys.platform == "darwin", reason="Apple git lacks --revision flag")
 def test_update_local_cache_sha_immutable(tmp_path: Path, mocker: MockerFixture) -> None:
     """Test that SHA refs don't get updated (immutable)."""
     mocker.patch("platformdirs.user_cache_dir", return_value=tmp_path)
@@ -149,3 +158,137 @@ def test_update_local_cache_sha_immutable(tmp_path: Path, mocker: MockerFixture)
     head_after = run_cmd(["git", "rev-parse", "HEAD"], cwd=result2).strip()
     assert head_before == head_after
     assert result == result2
+
+
+def _make_upstream(path: Path) -> str:
+    path.mkdir()
+    run_cmd(["git", "init", "-b", "main"], cwd=path)
+    (path / "ick.toml").write_text("# one\n")
+    run_cmd(["git", "add", "."], cwd=path)
+    run_cmd(["git", "commit", "-m", "one"], cwd=path)
+    return f"file://{path}"
+
+
+def _commit_upstream(path: Path) -> str:
+    with open(path / "ick.toml", "a") as f:
+        f.write("# more\n")
+    run_cmd(["git", "commit", "-am", "more"], cwd=path)
+    return run_cmd(["git", "rev-parse", "HEAD"], cwd=path).strip()
+
+
+def _head(path: Path) -> str:
+    return run_cmd(["git", "rev-parse", "HEAD"], cwd=path).strip()
+
+
+def test_update_local_cache_ttl(tmp_path: Path) -> None:
+    url = _make_upstream(tmp_path / "upstream")
+    checkout = update_local_cache(url, skip_update=False, ttl=3600)
+    old = _head(checkout)
+    new = _commit_upstream(tmp_path / "upstream")
+
+    # Recently fetched, so used as-is
+    assert _head(update_local_cache(url, skip_update=False, ttl=3600)) == old
+    # Strict
+    assert _head(update_local_cache(url, skip_update=False, ttl=0)) == new
+
+
+def test_update_local_cache_background(tmp_path: Path, mocker: MockerFixture) -> None:
+    url = _make_upstream(tmp_path / "upstream")
+    checkout = update_local_cache(url, skip_update=False, ttl=60)
+    old = _head(checkout)
+    new = _commit_upstream(tmp_path / "upstream")
+
+    stamp = _fetch_stamp_path(checkout)
+    an_hour_ago = time.time() - 3600
+    os.utime(stamp, (an_hour_ago, an_hour_ago))
+
+    popen = mocker.patch("ick.git.Popen")
+    # Stale, but used immediately while a refresh is started
+    assert _head(update_local_cache(url, skip_update=False, ttl=60, background=True)) == old
+    popen.assert_called_once()
+    assert popen.call_args.args[0] == [sys.executable, "-m", "ick.git", url, "60"]
+
+    # That refresh only fetches...
+    refresh_local_cache(url, ttl=60)
+    assert _head(checkout) == old
+
+    # ...and the next run picks it up without another fetch or refresh.
+    fetch = mocker.spy(sys.modules["ick.git"], "run_cmd")
+    assert _head(update_local_cache(url, skip_update=False, ttl=60, background=True)) == new
+    assert ["git", "fetch", "origin"] not in [c.args[0] for c in fetch.call_args_list]
+    popen.assert_called_once()
+
+
+def test_refresh_local_cache_skips_recent_fetch(tmp_path: Path, mocker: MockerFixture) -> None:
+    url = _make_upstream(tmp_path / "upstream")
+    update_local_cache(url, skip_update=False)
+    run = mocker.patch("ick.git.run_cmd")
+    refresh_local_cache(url, ttl=60)
+    run.assert_not_called()
+
+
+def test_update_local_cache_shares_one_store(tmp_path: Path) -> None:
+    url = _make_upstream(tmp_path / "upstream")
+    first = run_cmd(["git", "rev-parse", "HEAD"], cwd=tmp_path / "upstream").strip()
+    run_cmd(["git", "tag", "v1.0"], cwd=tmp_path / "upstream")
+    run_cmd(["git", "branch", "feature/x"], cwd=tmp_path / "upstream")
+    second = _commit_upstream(tmp_path / "upstream")
+
+    main = update_local_cache(url, skip_update=False)
+    branch = update_local_cache(f"{url}@feature/x", skip_update=False)
+    tag = update_local_cache(f"{url}@v1.0", skip_update=False)
+    sha = update_local_cache(f"{url}@{first}", skip_update=False)
+
+    assert [_head(p) for p in (main, branch, tag, sha)] == [second, first, first, first]
+    assert run_cmd(["git", "branch", "--show-current"], cwd=main).strip() == "main"
+    assert run_cmd(["git", "branch", "--show-current"], cwd=branch).strip() == "feature/x"
+    assert run_cmd(["git", "branch", "--show-current"], cwd=tag).strip() == ""
+
+    store = _store_path(url)
+    for p in (main, branch, tag, sha):
+        assert (p / ".git").is_file()
+        common = run_cmd(["git", "rev-parse", "--path-format=absolute", "--git-common-dir"], cwd=p).strip()
+        assert Path(common) == store
+
+    # Tags and SHAs don't move, branches do
+    third = _commit_upstream(tmp_path / "upstream")
+    for ref in ("", "@feature/x", "@v1.0", f"@{first}"):
+        update_local_cache(url + ref, skip_update=False)
+    assert [_head(p) for p in (main, branch, tag, sha)] == [third, first, first, first]
+
+
+def test_update_local_cache_legacy_clone(tmp_path: Path) -> None:
+    url = _make_upstream(tmp_path / "upstream")
+    checkout = local_cache_path(url)
+    run_cmd(["git", "clone", url, checkout])
+    (checkout / ".git" / "freeze").touch()
+    _commit_upstream(tmp_path / "upstream")
+
+    # Still frozen the old way
+    old = _head(update_local_cache(url, skip_update=False))
+    (checkout / ".git" / "freeze").unlink()
+
+    new = _head(update_local_cache(url, skip_update=False))
+    assert new != old
+    assert (checkout / ".git").is_dir()
+    assert not _store_path(url).exists()
+
+
+def test_prune_worktrees(tmp_path: Path) -> None:
+    url = _make_upstream(tmp_path / "upstream")
+    main = update_local_cache(url, skip_update=False)
+    frozen = update_local_cache(f"{url}@{_head(main)}", skip_update=False, freeze=True)
+    long_ago = time.time() - 90 * 86400
+    for p in (main, frozen):
+        used = p.with_name(p.name + ".used")
+        os.utime(used, (long_ago, long_ago))
+
+    store = _store_path(url)
+    prune_worktrees(store, max_age=86400)
+    assert not main.exists()
+    assert frozen.exists()
+    worktrees = run_cmd(["git", "worktree", "list", "--porcelain"], cwd=store)
+    assert str(main) not in worktrees
+
+    # And it comes back when needed
+    assert _head(update_local_cache(url, skip_update=False)) == _head(frozen)
@@ -0,0 +1,108 @@
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from ick.config import RuleConfig
+from ick.impact import ImpactUnknown, changed_files, impacted_rules, rules_using
+from ick.rules.python import Rule
+
+ICK_TOML = """\
+[[rule]]
+name = "one"
+impl = "python"
+
+[[rule]]
+name = "two"
+impl = "python"
+"""
+
+
+def _git(path: Path, *args: str) -> None:
+    subprocess.run(["git", *args], cwd=path, check=True, capture_output=True)
+
+
+def _rule_repo(path: Path) -> list[Rule]:
+    (path / "sub" / "tests" / "one" / "a").mkdir(parents=True)
+    (path / "sub" / "tests" / "two" / "a").mkdir(parents=True)
+    (path / "sub" / "tests" / "one" / "a" / "input.txt").write_text("x\n")
+    (path / "sub" / "tests" / "two" / "a" / "input.txt").write_text("x\n")
+    (path / "sub" / "ick.toml").write_text(ICK_TOML)
+    (path / "sub" / "helper.py").write_text("X = 1\n")
+    (path / "sub" / "one.py").write_text("from sub.helper import X\n")
+    (path / "sub" / "two.py").write_text("print(2)\n")
+    _git(path, "init")
+    _git(path, "add", ".")
+    _git(path, "-c", "user.name=x", "-c", "user.email=y", "commit", "-m", "init")
+    return [
+        Rule(
+            RuleConfig(
+                name=name,
+                impl="python",
+                full_name=f"sub/{name}",
+                prefixed_name=f"p:sub/{name}",
+                script_path=path / "sub" / name,
+                test_path=path / "sub" / "tests" / name,
+                repo_path=path,
+            )
+        )
+        for name in ("one", "two")
+    ]
+
+
+def test_changed_files(tmp_path: Path) -> None:
+    _rule_repo(tmp_path)
+    assert changed_files(tmp_path, "HEAD") == set()
+    (tmp_path / "sub" / "two.py").write_text("print(3)\n")
+    (tmp_path / "new.txt").write_text("")
+    assert changed_files(tmp_path, "HEAD") == {tmp_path / "sub" / "two.py", tmp_path / "new.txt"}
+
+    with pytest.raises(ImpactUnknown, match="unable to diff"):
+        changed_files(tmp_path, "no-such-ref")
+
+
+def test_impacted_rules(tmp_path: Path) -> None:
+    tmp_path = tmp_path.resolve()
+    rules = _rule_repo(tmp_path)
+    assert impacted_rules(rules, "HEAD") == set()
+
+    # Unrelated files
+    (tmp_path / "README.md").write_text("hi\n")
+    assert impacted_rules(rules, "HEAD") == set()
+
+    # Imported helper
+    (tmp_path / "sub" / "helper.py").write_text("X = 2\n")
+    assert impacted_rules(rules, "HEAD") == {"p:sub/one"}
+    _git(tmp_path, "checkout", "sub/helper.py")
+
+    # Test tree, including new files
+    (tmp_path / "sub" / "tests" / "two" / "b").mkdir()
+    (tmp_path / "sub" / "tests" / "two" / "b" / "input.txt").write_text("y\n")
+    assert impacted_rules(rules, "HEAD") == {"p:sub/two"}
+
+    # Config entry
+    (tmp_path / "sub" / "ick.toml").write_text(ICK_TOML.replace('name = "one"', 'name = "one"\nurgency = "now"'))
+    assert impacted_rules(rules, "HEAD") == {"p:sub/one", "p:sub/two"}
+
+
+def test_impacted_rules_shared_config(tmp_path: Path) -> None:
+    rules = _rule_repo(tmp_path)
+    (tmp_path / "sub" / "ick.toml").write_text(ICK_TOML + '\n[[ruleset]]\npath = "."\n')
+    with pytest.raises(ImpactUnknown, match="shared config"):
+        impacted_rules(rules, "HEAD")
+
+
+def test_impacted_rules_not_git(tmp_path: Path) -> None:
+    config = RuleConfig(name="one", impl="python", script_path=tmp_path / "one", test_path=tmp_path / "tests" / "one", repo_path=tmp_path)
+    with pytest.raises(ImpactUnknown, match="not in a git repo"):
+        impacted_rules([Rule(config)], "HEAD")
+
+
+def test_rules_using(tmp_path: Path) -> None:
+    rules = _rule_repo(tmp_path)
+    sub = tmp_path.resolve() / "sub"
+    assert rules_using(rules, set()) == set()
+    assert rules_using(rules, {sub / "helper.py"}) == {"p:sub/one"}
+    assert rules_using(rules, {sub / "two.py", sub / "tests" / "one" / "a" / "input.txt"}) == {"p:sub/one", "p:sub/two"}
+    assert rules_using(rules, {sub / "tests" / "two" / "b"}) == {"p:sub/two"}
+    assert rules_using(rules, {sub / "ick.toml", sub / "unused.py"}) == set()
@@ -0,0 +1,113 @@
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterable
+
+import pytest
+from feedforward import Notification, Step
+from feedforward.erasure import Erasure
+
+from ick.base_rule import GenericPreparedStep
+from ick.jobserver import Jobserver, _parse_auth
+from ick.schedule import IckRun
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="make's jobserver on windows uses semaphores")
+
+
+def test_parse_auth() -> None:
+    assert _parse_auth("") is None
+    assert _parse_auth("-j4") is None
+    assert _parse_auth("-j4 --jobserver-auth=3,4") == "3,4"
+    assert _parse_auth("-j4 --jobserver-fds=3,4 --jobserver-auth=fifo:/tmp/x") == "fifo:/tmp/x"
+
+
+def test_pipe_tokens() -> None:
+    r, w = os.pipe()
+    try:
+        os.write(w, b"ab")
+        js = Jobserver.from_makeflags(f"-j3 --jobserver-auth={r},{w}")
+        assert js is not None
+        assert js.pass_fds == (r, w)
+        # The implicit one, then make's two
+        assert [js.acquire(), js.acquire(), js.acquire(), js.acquire()] == [True, True, True, False]
+        js.release()
+        js.release()
+        js.release()
+        js.close()
+        assert sorted(os.read(r, 10)) == sorted(b"ab")
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def test_unusable_makeflags() -> None:
+    assert Jobserver.from_makeflags("-j4") is None
+    assert Jobserver.from_makeflags("--jobserver-auth=-2,-2") is None
+    assert Jobserver.from_makeflags("--jobserver-auth=gmake_semaphore_1234") is None
+    assert Jobserver.from_makeflags("--jobserver-auth=fifo:/nonexistent/fifo") is None
+    r, w = os.pipe()
+    os.close(r)
+    os.close(w)
+    assert Jobserver.from_makeflags(f"--jobserver-auth={r},{w}") is None
+
+
+def test_serve() -> None:
+    server = Jobserver.serve(2)
+    makeflags = server.env["MAKEFLAGS"]
+    assert makeflags.startswith("-j2 --jobserver-auth=fifo:")
+    fifo = Path(makeflags.split("fifo:")[1])
+    client = Jobserver.from_makeflags(makeflags)
+    assert client is not None
+    assert client.acquire()  # implicit
+    assert client.acquire()  # the one spare token
+    assert not client.acquire()
+    assert server.acquire()  # implicit
+    assert not server.acquire()
+    client.release()
+    assert server.acquire()
+    client.close()
+    server.close()
+    assert not fifo.exists()
+
+
+def test_ick_run_takes_tokens() -> None:
+    running = 0
+    peak = 0
+    lock = threading.Lock()
+
+    class CountingStep(GenericPreparedStep):
+        def process(
+            self, next_gen: int, notifications: Iterable[Notification[str, bytes | Erasure]]
+        ) -> Iterable[Notification[str, bytes | Erasure]]:
+            nonlocal running, peak
+            list(notifications)
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.05)
+            with lock:
+                running -= 1
+            return []
+
+    jobserver = Jobserver.serve(2)
+    run = IckRun(parallelism=4, jobserver=jobserver)
+    for i in range(2):
+        run.add_step(
+            CountingStep(
+                prefixed_name=f"r{i}",
+                patterns=["*.py"],
+                project_path="",
+                cmdline=[],
+                extra_env={},
+                append_filenames=True,
+                batch_size=1,
+            )
+        )
+    run.add_step(Step())
+    run.run_to_completion({f"{i}.py": b"" for i in range(4)})
+    assert peak == 2
+    assert "MAKEFLAGS" in run._steps[0].extra_env  # type: ignore[attr-defined]
+    # Closed along with the run
+    assert jobserver._tmpdir is None
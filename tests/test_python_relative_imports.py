@@ -6,7 +6,7 @@ from pathlib import Path
 import pytest
 
 from ick.config import RuleConfig
-from ick.rules.python import Rule, path_to_module
+from ick.rules.python import Rule, local_imports, path_to_module
 
 
 def test_python_relative_imports(tmp_path: Path) -> None:
@@ -96,3 +96,23 @@ def test_path_to_module_invalid() -> None:
     # Special characters are not valid
     with pytest.raises(AssertionError, match=r"Path.*my@script\.py.*contains invalid Python identifiers"):
         path_to_module(Path("my@script.py"))
+
+
+def test_local_imports(tmp_path: Path) -> None:
+    (tmp_path / "pkg" / "sub").mkdir(parents=True)
+    (tmp_path / "pkg" / "__init__.py").write_text("")
+    (tmp_path / "pkg" / "sub" / "__init__.py").write_text("from . import deep\n")
+    (tmp_path / "pkg" / "sub" / "deep.py").write_text("import os\n")
+    (tmp_path / "pkg" / "helper.py").write_text("from .sub import thing\n")
+    (tmp_path / "pkg" / "unused.py").write_text("")
+    (tmp_path / "top.py").write_text("")
+    script = tmp_path / "pkg" / "rule.py"
+    script.write_text("import top\nimport sys\nfrom .helper import greet\nfrom pkg import rule\n")
+
+    assert local_imports(tmp_path, script) == {
+        tmp_path / "top.py",
+        tmp_path / "pkg" / "__init__.py",
+        tmp_path / "pkg" / "helper.py",
+        tmp_path / "pkg" / "sub" / "__init__.py",
+        tmp_path / "pkg" / "sub" / "deep.py",
+    }
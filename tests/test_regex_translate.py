@@ -1,6 +1,6 @@
 import re
 
-from ick._regex_translate import rule_name_re, zfilename_re
+from ick._regex_translate import literal_prefixes, may_start_with, rule_name_re, zfilename_re
 
 
 def test_advice_name_matching() -> None:
@@ -32,6 +32,28 @@ def test_advice_name_matching_prefix_with_legacy_join() -> None:
     assert not foo_match("py/bar")
 
 
+def test_literal_prefixes() -> None:
+    assert literal_prefixes(".*") == [""]
+    assert literal_prefixes(rule_name_re("foo/bar")) == ["foo/bar"]
+    assert literal_prefixes(rule_name_re("a") + "|" + rule_name_re("b/c")) == ["a", "b/c"]
+    # Quantifiers make the previous character optional
+    assert literal_prefixes("^abc*") == ["ab"]
+    assert literal_prefixes("^ab?c") == ["a"]
+    # Escapes, groups, and classes end the literal part, and don't split
+    assert literal_prefixes(r"^a\.b") == ["a"]
+    assert literal_prefixes("^a(b|c)") == ["a"]
+    assert literal_prefixes("^x[|]y") == ["x"]
+
+
+def test_may_start_with() -> None:
+    assert may_start_with([""], "anything/")
+    assert may_start_with(["foo/bar"], "")
+    assert may_start_with(["foo/bar"], "foo/")
+    assert may_start_with(["foo"], "foo/bar/")
+    assert not may_start_with(["foo/bar"], "baz/")
+    assert not may_start_with([], "")
+
+
 def test_regex_matching_zfilenames() -> None:
     # start (and end)
     m = zfilename_re(["literal.txt"]).match("literal.txt\0")
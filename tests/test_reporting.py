@@ -0,0 +1,59 @@
+from pathlib import Path
+from xml.etree import ElementTree as ET
+
+from ick.base_rule import BaseRule
+from ick.config import RuleConfig
+from ick.reporting import display_name, results_json, slowest, write_junit_xml
+from ick.runner import TestResult as Result
+
+
+def _rule_results() -> list[tuple[BaseRule, list[Result]]]:
+    rule = BaseRule(RuleConfig(name="r", impl="dummy", prefixed_name="p:r", test_path=Path("/rules/tests/r")))
+    empty = BaseRule(RuleConfig(name="e", impl="dummy", test_path=Path("/rules/tests/e")))
+    ok = Result(rule, Path("/rules/tests/r/ok"), success=True, wall_time=1.0, setup_time=0.25, run_time=0.5, compare_time=0.25)
+    bad = Result(rule, Path("/rules/tests/r/bad"), message="Different output found\nmore", diff="-a\n+b\n", wall_time=3.0)
+    cached = Result(rule, Path("/rules/tests/r/cached"), success=True, cached=True, wall_time=9.0)
+    return [(rule, [ok, bad, cached]), (empty, [])]
+
+
+def test_slowest() -> None:
+    rule_results = _rule_results()
+    assert [display_name(r) for r in slowest(rule_results, 5)] == ["p:r: bad", "p:r: ok"]
+    assert [display_name(r) for r in slowest(rule_results, 1)] == ["p:r: bad"]
+
+
+def test_results_json() -> None:
+    results = results_json(_rule_results())["results"]
+    assert list(results) == ["p:r", "e"]
+    assert results["e"] == []
+    assert [(r["test"], r["status"]) for r in results["p:r"]] == [("ok", "pass"), ("bad", "fail"), ("cached", "cached")]
+    assert results["p:r"][0] == {
+        "test": "ok",
+        "status": "pass",
+        "message": "",
+        "diff": "",
+        "wall_time": 1.0,
+        "setup_time": 0.25,
+        "run_time": 0.5,
+        "compare_time": 0.25,
+    }
+
+
+def test_write_junit_xml(tmp_path: Path) -> None:
+    write_junit_xml(_rule_results(), tmp_path / "junit.xml")
+    root = ET.parse(tmp_path / "junit.xml").getroot()
+    suites = root.findall("testsuite")
+    assert [(s.get("name"), s.get("tests"), s.get("failures")) for s in suites] == [("p:r", "3", "1"), ("e", "0", "0")]
+    ok, bad, cached = suites[0].findall("testcase")
+    assert ok.get("time") == "1.000"
+    assert ok.find("failure") is None
+    assert [(p.get("name"), p.get("value")) for p in ok.iter("property")] == [
+        ("setup_time", "0.250"),
+        ("run_time", "0.500"),
+        ("compare_time", "0.250"),
+    ]
+    failure = bad.find("failure")
+    assert failure is not None
+    assert failure.get("message") == "Different output found"
+    assert failure.text == "Different output found\nmore\n-a\n+b\n"
+    assert cached.findtext("system-out") == "cached"
@@ -0,0 +1,94 @@
+from pathlib import Path
+
+from ick.config import RuleConfig
+from ick.result_cache import ResultCache, result_key, rule_fingerprint, tree_digest
+from ick.rules.python import Rule
+from ick.rules.shell import Rule as ShellRule
+
+
+def _write_test(test_path: Path) -> None:
+    (test_path / "input" / "sub").mkdir(parents=True)
+    (test_path / "output").mkdir()
+    (test_path / "input" / "sub" / "a.txt").write_text("a\n")
+    (test_path / "output" / "a.txt").write_text("b\n")
+
+
+def test_tree_digest(tmp_path: Path) -> None:
+    _write_test(tmp_path)
+    inp = tmp_path / "input"
+    first = tree_digest(inp)
+    assert tree_digest(inp) == first
+
+    (inp / "sub" / "a.txt").write_text("changed\n")
+    assert tree_digest(inp) != first
+
+    (inp / "sub" / "a.txt").write_text("a\n")
+    assert tree_digest(inp) == first
+    (inp / "empty").mkdir()
+    assert tree_digest(inp) != first
+
+
+def test_result_key_covers_input_and_output(tmp_path: Path) -> None:
+    _write_test(tmp_path)
+    key = result_key("fp", "tests/x", tmp_path)
+    assert result_key("other", "tests/x", tmp_path) != key
+    assert result_key("fp", "tests/y", tmp_path) != key
+
+    (tmp_path / "output" / "output.txt").write_text("hi\n")
+    assert result_key("fp", "tests/x", tmp_path) != key
+
+
+def test_rule_fingerprint_follows_script_and_imports(tmp_path: Path) -> None:
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / "__init__.py").write_text("")
+    (tmp_path / "pkg" / "helper.py").write_text("X = 1\n")
+    (tmp_path / "pkg" / "rule.py").write_text("from .helper import X\n")
+    config = RuleConfig(name="rule", impl="python", script_path=tmp_path / "pkg" / "rule", repo_path=tmp_path)
+
+    first = rule_fingerprint(Rule(config))
+    assert rule_fingerprint(Rule(config)) == first
+
+    (tmp_path / "pkg" / "helper.py").write_text("X = 2\n")
+    second = rule_fingerprint(Rule(config))
+    assert second != first
+
+    config.deps = ["attrs"]
+    assert rule_fingerprint(Rule(config)) != second
+
+
+def test_rule_fingerprint_defaults_to_rule_dir(tmp_path: Path) -> None:
+    (tmp_path / "tests" / "rule").mkdir(parents=True)
+    (tmp_path / "rule.sh").write_text("echo 1\n")
+    config = RuleConfig(name="rule", impl="shell", command="sh rule.sh", script_path=tmp_path / "rule", repo_path=tmp_path)
+    rule = ShellRule(config)
+    assert rule.fingerprint_paths() == [tmp_path / "rule.sh"]
+
+    first = rule_fingerprint(rule)
+    # Tests are cached by their own contents
+    (tmp_path / "tests" / "rule" / "x").write_text("")
+    assert rule_fingerprint(rule) == first
+
+    (tmp_path / "rule.sh").write_text("echo 2\n")
+    assert rule_fingerprint(rule) != first
+
+
+def test_rule_fingerprint_skips_other_rules(tmp_path: Path) -> None:
+    # A rule at the root of its repo, with other rules (and their tests) below
+    (tmp_path / "rule.sh").write_text("echo 1\n")
+    (tmp_path / "lib" / "tests").mkdir(parents=True)
+    (tmp_path / "lib" / "helper.sh").write_text("")
+    (tmp_path / "lib" / "tests" / "test_helper.sh").write_text("")
+    (tmp_path / "other" / "tests" / "other").mkdir(parents=True)
+    (tmp_path / "other" / "ick.toml").write_text("")
+    (tmp_path / "other" / "other.sh").write_text("")
+    config = RuleConfig(name="rule", impl="shell", command="sh rule.sh", script_path=tmp_path / "rule", repo_path=tmp_path)
+    rule = ShellRule(config)
+    assert sorted(rule.fingerprint_paths()) == [tmp_path / "lib" / "helper.sh", tmp_path / "rule.sh"]
+
+
+def test_result_cache(tmp_path: Path) -> None:
+    cache = ResultCache(tmp_path / "results")
+    assert not cache.passed("abcd")
+    cache.record_pass("abcd")
+    assert cache.passed("abcd")
+    assert not cache.passed("abce")
@@ -1,9 +1,12 @@
 import subprocess
 import sys
 import threading
+import time
+from concurrent.futures import Future
+from contextlib import ExitStack
 from pathlib import Path
 from types import SimpleNamespace
-from typing import Callable, Iterable, cast
+from typing import Any, Callable, Iterable, cast
 
 import click
 import pytest
@@ -11,11 +14,15 @@ from feedforward import Notification, Run, State
 from feedforward.erasure import Erasure  # todo: export this properly from feedforward
 from feedforward.step import Step
 
-from ick.base_rule import BaseRule, GenericPreparedStep, match_prefix_patterns
+from ick.base_rule import BaseRule, CoalescedFileStep, GenericPreparedStep, match_prefix_patterns, nested_project_dirs, patterns_may_overlap
 from ick.cmdline import apply_filters
 from ick.config import DEFAULT_MAIN_CONFIG, RuleConfig, RulesConfig, RuntimeConfig, Settings
-from ick.runner import Runner
+from ick.result_cache import ResultCache, result_key, rule_fingerprint
+from ick.runner import HighLevelResult, Runner, _submit_after, shard_work
+from ick.runner import TestResult as Result
+from ick.supervisor import Supervisor
 from ick.types_project import BaseRepo
+from ick_protocol import Finished, Modified, RuleStatus, Scope
 
 
 def _step(patterns: list[str], rule_prepare: Callable[[], bool] | None = None) -> GenericPreparedStep:
@@ -89,6 +96,121 @@ def test_step_match_excludes_nested_project_paths() -> None:
     assert not step.match("nested/file.py")
 
 
+@pytest.mark.parametrize("scope", [Scope.FILE, Scope.PROJECT, Scope.REPO])
+def test_add_steps_to_run_prunes_by_project_types(scope: Scope) -> None:
+    projects = [
+        SimpleNamespace(subdir="py/", typ="python"),
+        SimpleNamespace(subdir="java/", typ="java"),
+        SimpleNamespace(subdir="py/nested/", typ="java"),
+    ]
+
+    def steps(project_types: list[str] | None) -> list[GenericPreparedStep]:
+        config = RuleConfig(name="r", impl="shell", scope=scope, inputs=["*"], project_types=project_types)
+        run: Run[str, bytes | Erasure] = Run()
+        BaseRule(config).add_steps_to_run(projects, {}, run)
+        return cast(list[GenericPreparedStep], run._steps)
+
+    def prefixes(project_types: list[str] | None) -> list[str]:
+        return [s.match_prefix for s in steps(project_types)]
+
+    if scope == Scope.REPO:
+        assert prefixes(["python"]) == [""]
+        assert prefixes(["go"]) == []
+        assert prefixes(None) == [""]
+    else:
+        assert prefixes(["python"]) == ["py/"]
+        assert prefixes(["java"]) == ["java/", "py/nested/"]
+        assert prefixes(["go"]) == []
+        assert prefixes(None) == ["py/", "java/", "py/nested/"]
+        # Files in a nested project of another type still aren't the outer one's
+        assert not steps(["python"])[0].match("py/nested/a.py")
+
+
+def test_add_steps_to_run_coalesces_many_projects(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("ick.base_rule.COALESCE_PROJECTS", 2)
+    projects = [SimpleNamespace(subdir=subdir, typ="python") for subdir in ("a/", "b/", "b/nested/")]
+    run: Run[str, bytes | Erasure] = Run()
+    BaseRule(RuleConfig(name="r", impl="shell", inputs=["*.py"])).add_steps_to_run(projects, {}, run)
+    (step,) = run._steps
+    assert isinstance(step, CoalescedFileStep)
+    assert step.projects == {"a/": (), "b/": ("b/nested/",), "b/nested/": ()}
+
+
+def test_coalesced_step_runs_in_each_project() -> None:
+    # Appends the directory it's run in to each file
+    code = "import os, sys\nfor f in sys.argv[1:]:\n    open(f, 'a').write(os.path.basename(os.getcwd()))"
+    step = CoalescedFileStep(
+        prefixed_name="test_rule",
+        patterns=["*.py"],
+        projects={"": ("b/",), "b/": ("b/other/",)},
+        cmdline=[sys.executable, "-c", code],
+        extra_env={},
+        append_filenames=True,
+        batch_size=-1,
+    )
+    assert step.project_paths == ["", "b/"]
+    assert [step.would_match(k) for k in ("x.py", "b/x.py", "b/c/x.py", "b/other/x.py", "b/x.txt")] == [True, True, True, False, False]
+
+    run: Run[str, bytes | Erasure] = Run(parallelism=1)
+    run.add_step(step)
+    run.add_step(Step())
+    run.run_to_completion({"x.py": b"", "b/x.py": b"", "b/c/x.py": b"", "b/other/x.py": b""})
+
+    results = {path: changes for path, changes, _ in step.project_results()}
+    assert list(results) == ["", "b/"]
+    assert [m.filename for m in results[""]] == ["x.py"]
+    assert [m.filename for m in results["b/"]] == ["b/c/x.py", "b/x.py"]
+    # Each project's files were given to the command in that project's directory
+    tmpdirs = {m.new_bytes for m in results["b/"]}
+    assert len(tmpdirs) == 1
+    assert tmpdirs != {m.new_bytes for m in results[""]}
+    # Usage is kept for each project
+    assert {path: usage.batches for path, usage in step.usage.items()} == {"": 1, "b/": 1}
+
+
+@pytest.mark.parametrize("supervised", [False, True])
+def test_coalesced_step_timeout_only_fails_that_project(supervised: bool) -> None:
+    # Hangs on the one project whose file says to
+    code = "import sys, time\nfor f in sys.argv[1:]:\n    if open(f).read() == 'hang': time.sleep(10)\n    open(f, 'a').write('!')"
+    step = CoalescedFileStep(
+        prefixed_name="test_rule",
+        patterns=["*.py"],
+        projects={"a/": (), "b/": (), "c/": ()},
+        cmdline=[sys.executable, "-c", code],
+        extra_env={},
+        append_filenames=True,
+        batch_size=-1,
+        timeout=1,
+    )
+    run: Run[str, bytes | Erasure] = Run(parallelism=1)
+    run.add_step(step)
+    run.add_step(Step())
+    with ExitStack() as stack:
+        if supervised:
+            step.supervisor = stack.enter_context(Supervisor(2))
+        final = run.run_to_completion({"a/x.py": b"", "b/x.py": b"hang", "c/x.py": b""})
+
+    assert not step.cancelled
+    results = {path: (changes, finished) for path, changes, finished in step.project_results()}
+    assert results["b/"] == ([], Finished("test_rule", RuleStatus.ERROR, "Batch of 1 file took longer than the timeout of 1s"))
+    for path in ("a/", "c/"):
+        changes, finished = results[path]
+        assert finished.status == RuleStatus.NEEDS_WORK
+        assert [(m.filename, m.new_bytes) for m in changes] == [(f"{path}x.py", b"!")]
+    assert final["b/x.py"].value == b"hang"
+
+
+def test_nested_project_dirs() -> None:
+    projects = [SimpleNamespace(subdir=subdir) for subdir in ("", "a/", "a/b/c/", "a/bc/", "d/")]
+    assert nested_project_dirs(projects) == {
+        "": ("a/", "a/b/c/", "a/bc/", "d/"),
+        "a/": ("a/b/c/", "a/bc/"),
+        "a/b/c/": (),
+        "a/bc/": (),
+        "d/": (),
+    }
+
+
 def test_step_errors_when_output_hits_excluded_project_path() -> None:
     step = GenericPreparedStep(
         prefixed_name="test_rule",
@@ -113,6 +235,97 @@ def test_step_errors_when_output_hits_excluded_project_path() -> None:
     assert "excluded project path" in step.cancel_reason
 
 
+def _limited_step(code: str, **limits: Any) -> GenericPreparedStep:
+    step = GenericPreparedStep(
+        prefixed_name="test_rule",
+        patterns=["*.py"],
+        project_path="",
+        cmdline=[sys.executable, "-c", code],
+        extra_env={},
+        append_filenames=True,
+        **limits,
+    )
+    step.index = 0
+    return step
+
+
+def _process(step: GenericPreparedStep) -> None:
+    n: Notification[str, bytes | Erasure] = Notification(key="a.py", state=State(gens=(0,), value=b"hello"))
+    step.notify(n)
+    list(step.process(1, [n]))
+
+
+def test_batch_timeout_cancels_step() -> None:
+    step = _limited_step("import time; time.sleep(10)", timeout=0.2)
+    _process(step)
+    assert step.cancelled
+    assert step.cancel_reason == "Batch of 1 file took longer than the timeout of 0.2s"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="rlimits are posix-only")
+def test_batch_cpu_limit_cancels_step() -> None:
+    step = _limited_step("while True: pass", cpu_limit=1)
+    _process(step)
+    assert step.cancelled
+    assert step.cancel_reason == "Batch of 1 file used more than the cpu_limit of 1s"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="rlimits are posix-only")
+def test_batch_memory_limit_cancels_step() -> None:
+    # Touches each MiB, so that it's resident
+    step = _limited_step("x = []\nwhile True: x.append(b'x' * 1024 * 1024)", memory_limit=256)
+    _process(step)
+    assert step.cancelled
+    assert step.cancel_reason == "Batch of 1 file used more than the memory_limit of 256 MiB"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="rlimits are posix-only")
+@pytest.mark.parametrize(
+    "code",
+    [
+        "raise SystemExit(1)",
+        # Only what it used says what limit it hit, not what it says
+        "raise MemoryError",
+        # e.g. the OOM killer
+        "import os, signal; os.kill(os.getpid(), signal.SIGKILL)",
+    ],
+)
+def test_batch_failure_within_limits_is_not_a_limit(code: str) -> None:
+    step = _limited_step(code, memory_limit=256, cpu_limit=10)
+    _process(step)
+    assert not step.cancelled
+
+
+def test_patterns_may_overlap() -> None:
+    assert not patterns_may_overlap("", ["pyproject.toml"], "", ["*.py"])
+    assert patterns_may_overlap("", ["pyproject.toml"], "", ["*.toml"])
+    assert patterns_may_overlap("", ["pyproject.toml"], "", ["sub/pyproject.toml"])
+    assert not patterns_may_overlap("", ["setup.cfg", "*.ini"], "", ["*.py", "*.toml"])
+    assert patterns_may_overlap("", ["*.py"], "", ["test_*"])
+    assert not patterns_may_overlap("", ["*.py"], "", ["*.pyi"])
+    assert not patterns_may_overlap("", ["test_*.py"], "", ["conftest*"])
+    assert patterns_may_overlap("", ["src/*"], "", ["*.txt"])
+    # Nested projects can share files, separate ones can't
+    assert patterns_may_overlap("", ["*.py"], "a/", ["*.py"])
+    assert not patterns_may_overlap("a/", ["*.py"], "b/", ["*.py"])
+
+
+def test_step_cancels_on_undeclared_output() -> None:
+    step = _limited_step("open('setup.cfg', 'w').write('x')", outputs=["pyproject.toml", "setup.cfg"])
+    _process(step)
+    assert not step.cancelled
+
+    step = _limited_step("open('other.txt', 'w').write('x')", outputs=["pyproject.toml"])
+    _process(step)
+    assert step.cancelled
+    assert step.cancel_reason == "Produced output not in its declared outputs: 'other.txt'"
+
+    step = _limited_step("open('a.py', 'w').write('x')", outputs=["pyproject.toml"])
+    _process(step)
+    assert step.cancelled
+    assert step.cancel_reason == "Produced output not in its declared outputs: 'a.py'"
+
+
 def test_timeout_in_prepare_cancels_step() -> None:
     """TimeoutExpired from rule_prepare cancels the step."""
 
@@ -158,6 +371,41 @@ def test_timeout_in_prepare_run_continues_with_next_step(parallelism: int) -> No
     assert result["b.txt"].value == b"modified"
 
 
+def test_run_steps_streams_finished_steps(tmp_path: Path) -> None:
+    (tmp_path / "a.py").write_text("")
+    marker = tmp_path / "marker"
+    first = GenericPreparedStep(
+        prefixed_name="first",
+        patterns=["*.py"],
+        project_path="",
+        cmdline=[sys.executable, "-c", "pass"],
+        extra_env={},
+        append_filenames=True,
+    )
+    # Only succeeds if "first" was reported while it was still running
+    wait = f"import os, sys, time; [time.sleep(0.05) for _ in range(200) if not os.path.exists({str(marker)!r})]; sys.exit(not os.path.exists({str(marker)!r}))"
+    second = GenericPreparedStep(
+        prefixed_name="second",
+        patterns=["*.py"],
+        project_path="",
+        cmdline=[sys.executable, "-c", wait],
+        extra_env={},
+        append_filenames=True,
+    )
+    run: Run[str, bytes | Erasure] = Run(parallelism=2)
+    run.add_step(first)
+    run.add_step(second)
+    run.add_step(Step())
+
+    runner = Runner.__new__(Runner)
+    repo = cast(BaseRepo, SimpleNamespace(root=tmp_path, zfiles="a.py\0"))
+    results = []
+    for result in runner.run_steps(run, repo, stream=True):
+        results.append((result.rule, result.finished.status))
+        marker.touch()
+    assert results == [("first", RuleStatus.SUCCESS), ("second", RuleStatus.SUCCESS)]
+
+
 def test_default_parallelism_is_at_least_two() -> None:
     """Two items must be able to reach the barrier simultaneously."""
     barrier = threading.Barrier(2, timeout=5)
@@ -247,6 +495,192 @@ def test_iter_rule_impl_filters_by_tag() -> None:
     assert matched == {"security-rule", "python-rule"}
 
 
+def test_shard_work() -> None:
+    rules = {name: BaseRule(RuleConfig(name=name, impl="dummy")) for name in ("c", "a", "b")}
+    work = [
+        (rules["c"], (Path("c/2"), Path("c/1"))),
+        (rules["a"], (Path("a/1"), Path("a/2"), Path("a/3"))),
+        (rules["b"], ()),
+    ]
+    # Dealt out as a/1 a/2 a/3 b c/1 c/2
+    assert shard_work(work, 1, 2) == [(rules["c"], (Path("c/1"),)), (rules["a"], (Path("a/1"), Path("a/3")))]
+    assert shard_work(work, 2, 2) == [(rules["c"], (Path("c/2"),)), (rules["a"], (Path("a/2"),)), (rules["b"], ())]
+    assert shard_work(work, 1, 1) == [(r, tuple(sorted(p))) for r, p in work]
+    assert shard_work(work, 3, 7) == [(rules["a"], (Path("a/3"),))]
+
+
+def test_test_rules_prepares_each_env_once_before_its_tests(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    events: list[tuple[str, str]] = []
+    lock = threading.Lock()
+
+    def record(event: str, name: str) -> None:
+        with lock:
+            events.append((event, name))
+
+    class EnvRule(BaseRule):
+        def prepare_key(self) -> str:
+            return "env"
+
+        def prepare(self) -> bool:
+            record("prepare", self.rule_config.name)
+            time.sleep(0.2)
+            record("prepared", self.rule_config.name)
+            return True
+
+    def fake_perform_test(self: Runner, rule_instance: BaseRule, test_path: Path, *args: object, **kwargs: object) -> Result:
+        record("test", test_path.name)
+        return Result(rule_instance, test_path, success=True)
+
+    def rule(cls: type[BaseRule], name: str) -> BaseRule:
+        return cls(RuleConfig(name=name, impl="dummy", test_path=tmp_path / name))
+
+    a, b, c = rule(EnvRule, "a"), rule(EnvRule, "b"), rule(BaseRule, "c")
+    runner = Runner(
+        RuntimeConfig(main_config=DEFAULT_MAIN_CONFIG, rules_config=RulesConfig(), settings=Settings()), BaseRepo(root=tmp_path)
+    )
+    monkeypatch.setattr(
+        runner, "iter_tests", lambda: [(a, (tmp_path / "a1", tmp_path / "a2")), (b, (tmp_path / "b1",)), (c, (tmp_path / "c1",))]
+    )
+    monkeypatch.setattr(Runner, "_perform_test", fake_perform_test)
+
+    assert runner.test_rules(use_cache=False, quiet=True) == 0
+
+    assert [e for e in events if e[0].startswith("prepare")] == [("prepare", "a"), ("prepared", "a")]
+    prepared = events.index(("prepared", "a"))
+    assert {name for _, name in events[prepared + 1 :]} >= {"a1", "a2", "b1"}
+    # Not held up by the other rules' env
+    assert events.index(("test", "c1")) < prepared
+
+
+def test_test_rules_skips_prepare_when_all_cached(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    prepared: list[str] = []
+    ran: list[str] = []
+
+    class EnvRule(BaseRule):
+        def prepare_key(self) -> str:
+            return self.rule_config.name
+
+        def prepare(self) -> bool:
+            prepared.append(self.rule_config.name)
+            return True
+
+    def fake_perform_test(self: Runner, rule_instance: BaseRule, test_path: Path, *args: object, **kwargs: object) -> Result:
+        ran.append(test_path.name)
+        return Result(rule_instance, test_path, success=True)
+
+    for name in ("a1", "a2", "b1"):
+        (tmp_path / name / "input").mkdir(parents=True)
+        (tmp_path / name / "output").mkdir()
+    monkeypatch.chdir(tmp_path)
+    a, b = (EnvRule(RuleConfig(name=name, impl="dummy", test_path=tmp_path / name)) for name in ("a", "b"))
+    cache = ResultCache(tmp_path / "results")
+    monkeypatch.setattr("ick.runner.ResultCache", lambda: cache)
+    for rule, name in ((a, "a1"), (a, "a2"), (b, "b1")):
+        cache.record_pass(result_key(rule_fingerprint(rule), name, tmp_path / name))
+    (tmp_path / "b1" / "input" / "new.py").write_text("")
+
+    runner = Runner(
+        RuntimeConfig(main_config=DEFAULT_MAIN_CONFIG, rules_config=RulesConfig(), settings=Settings()), BaseRepo(root=tmp_path)
+    )
+    monkeypatch.setattr(runner, "iter_tests", lambda: [(a, (tmp_path / "a1", tmp_path / "a2")), (b, (tmp_path / "b1",))])
+    monkeypatch.setattr(Runner, "_perform_test", fake_perform_test)
+
+    assert runner.test_rules(quiet=True) == 0
+
+    # Only b has a test that changed since it passed
+    assert prepared == ["b"]
+    assert ran == ["b1"]
+
+
+def test_submit_after() -> None:
+    first: Future[None] = Future()
+    calls = []
+
+    def submit() -> Future[int]:
+        calls.append(1)
+        inner: Future[int] = Future()
+        inner.set_result(5)
+        return inner
+
+    outer = _submit_after(first, submit)
+    assert not calls and not outer.done()
+    first.set_result(None)
+    assert outer.result() == 5
+
+    failed: Future[int] = Future()
+    failed.set_exception(ValueError("x"))
+    with pytest.raises(ValueError):
+        _submit_after(first, lambda: failed).result()
+
+    cancelled: Future[int] = Future()
+    cancelled.cancel()
+    assert _submit_after(first, lambda: cancelled).cancelled()
+
+
+def test_write_update_only_rewrites_differences(tmp_path: Path) -> None:
+    inp = tmp_path / "input"
+    outp = tmp_path / "output"
+    for d in (inp, outp):
+        (d / "sub").mkdir(parents=True)
+        (d / "same.txt").write_text("same\n")
+        (d / "sub" / "edited.txt").write_text("old\n")
+    (outp / "gone" / "deeper").mkdir(parents=True)
+    (outp / "gone" / "deeper" / "stale.txt").write_text("stale\n")
+    same_inode = (outp / "same.txt").stat().st_ino
+
+    runner = Runner(
+        RuntimeConfig(main_config=DEFAULT_MAIN_CONFIG, rules_config=RulesConfig(), settings=Settings()), BaseRepo(root=tmp_path)
+    )
+    response = [Modified("r", "sub/edited.txt", b"new\n"), Modified("r", "added.txt", b"added\n")]
+    assert runner._write_update(inp, outp, response, RuleStatus.SUCCESS, "some output\n")
+
+    assert sorted(p.relative_to(outp).as_posix() for p in outp.rglob("*")) == [
+        "added.txt",
+        "output.txt",
+        "same.txt",
+        "sub",
+        "sub/edited.txt",
+    ]
+    assert (outp / "same.txt").stat().st_ino == same_inode
+    assert (outp / "sub" / "edited.txt").read_text() == "new\n"
+    assert (outp / "output.txt").read_text() == "some output\n"
+
+    # Already up to date
+    assert not runner._write_update(inp, outp, response, RuleStatus.SUCCESS, "some output\n")
+
+    assert runner._write_update(inp, outp, [], RuleStatus.ERROR, "boom\n")
+    assert [p.name for p in outp.iterdir()] == ["error.txt"]
+
+
+def test_check_output_line_endings(tmp_path: Path) -> None:
+    inp = tmp_path / "input"
+    outp = tmp_path / "output"
+    inp.mkdir()
+    outp.mkdir()
+    # e.g. checked out with autocrlf
+    (inp / "same.txt").write_bytes(b"same\n")
+    (outp / "same.txt").write_bytes(b"same\r\n")
+    (inp / "edited.txt").write_bytes(b"old\n")
+    (outp / "edited.txt").write_bytes(b"new\r\n")
+
+    runner = Runner(
+        RuntimeConfig(main_config=DEFAULT_MAIN_CONFIG, rules_config=RulesConfig(), settings=Settings()), BaseRepo(root=tmp_path)
+    )
+
+    def check(new_bytes: bytes) -> Result:
+        run_result = HighLevelResult("r", "", [Modified("r", "edited.txt", new_bytes)], Finished("r", RuleStatus.NEEDS_WORK, ""))
+        result = Result(BaseRule(RuleConfig(name="r", impl="dummy")), tmp_path)
+        runner._check_output(inp, outp, run_result, result)
+        return result
+
+    # Unchanged files are compared as text
+    assert check(b"new\r\n").success
+
+    result = check(b"new\n")
+    assert not result.success
+    assert result.message == "'edited.txt' (modified) differs only in line endings"
+
+
 def test_stale_gen_metadata_is_dropped() -> None:
     """Metadata keyed to a superseded generation is silently dropped (last-writer-wins)."""
     step = _step(["*.py"])
@@ -281,3 +715,40 @@ def test_current_gen_metadata_survives() -> None:
 
     assert finished.metadata == {"findings": ["kept"]}
     assert finished.message == "the message\n"
+
+
+def test_watch_tests_reruns_changed_rules(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    def rule(name: str) -> BaseRule:
+        return BaseRule(RuleConfig(name=name, impl="dummy", prefixed_name=name, repo_path=tmp_path, test_path=tmp_path / "tests" / name))
+
+    rules = [rule("a"), rule("b")]
+    changes = [{tmp_path / "unrelated.txt"}, {tmp_path / "tests" / "b" / "t1" / "input.txt"}]
+    runs: list[list[str]] = []
+
+    class FakeWatcher:
+        def __enter__(self) -> "FakeWatcher":
+            return self
+
+        def __exit__(self, *args: object) -> None:
+            pass
+
+        def wait(self) -> set[Path]:
+            if not changes:
+                raise KeyboardInterrupt
+            return changes.pop(0)
+
+    def fake_test_rules(self: Runner, work: list[tuple[BaseRule, tuple[Path, ...]]], **kwargs: object) -> int:
+        assert "since" not in kwargs or not runs
+        runs.append([r.rule_config.name for r, _ in work])
+        return 0
+
+    runner = Runner(
+        RuntimeConfig(main_config=DEFAULT_MAIN_CONFIG, rules_config=RulesConfig(), settings=Settings()), BaseRepo(root=tmp_path)
+    )
+    monkeypatch.setattr(runner, "iter_rule_impl", lambda: iter(rules))
+    monkeypatch.setattr(Runner, "test_rules", fake_test_rules)
+    monkeypatch.setattr("ick.watch.watcher", lambda roots: FakeWatcher())
+
+    with pytest.raises(KeyboardInterrupt):
+        runner.watch_tests(since="HEAD", quiet=True)
+    assert runs == [["a", "b"], ["b"]]
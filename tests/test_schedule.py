@@ -0,0 +1,243 @@
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterable
+
+from feedforward import Notification, Run, State, Step
+from feedforward.erasure import Erasure
+
+from ick.base_rule import GenericPreparedStep
+from ick.schedule import BatchCost, IckRun, Priority, TimingHistory, auto_batch_size, fit_batch_cost, format_eta, max_argv_files
+from ick_protocol import Urgency
+
+
+def _step(
+    name: str,
+    order: int = 50,
+    patterns: tuple[str, ...] = ("*.py",),
+    batch_size: int | str = 10,
+    urgency: Urgency = Urgency.LATER,
+) -> GenericPreparedStep:
+    return GenericPreparedStep(
+        prefixed_name=name,
+        patterns=patterns,
+        project_path="",
+        cmdline=[sys.executable, "-c", "pass"],
+        extra_env={},
+        append_filenames=True,
+        order=order,
+        batch_size=batch_size,
+        urgency=urgency,
+    )
+
+
+def test_timing_history(tmp_path: Path) -> None:
+    history = TimingHistory(tmp_path / "timings.json")
+    assert history.expected("p:r", "", 10) is None
+
+    history.record("p:r", "", 4.0, 10)
+    assert history.expected("p:r", "", 10) == 4.0
+    assert history.expected("p:r", "", 20) == 8.0
+    # Other projects are estimated from the rule's cost per file
+    assert history.expected("p:r", "sub/", 5) == 2.0
+
+    history.record("p:r", "", 2.0, 10)
+    assert history.expected("p:r", "", 10) == 3.0
+
+    history.save()
+    assert TimingHistory(tmp_path / "timings.json").expected("p:r", "", 10) == 3.0
+
+    (tmp_path / "timings.json").write_text("garbage")
+    assert TimingHistory(tmp_path / "timings.json").expected("p:r", "", 10) is None
+
+
+def test_ick_run_prioritizes_slow_steps_within_order(tmp_path: Path) -> None:
+    history = TimingHistory(tmp_path / "timings.json")
+    history.record("fast", "", 1.0, 1)
+    history.record("slow", "", 10.0, 1)
+    history.record("later", "", 100.0, 1)
+
+    run = IckRun(history=history, parallelism=4)
+    for step in (_step("new"), _step("fast"), _step("slow"), _step("later", order=60), _step("other", patterns=("*.txt",))):
+        run.add_step(step)
+    run.add_step(Step())
+
+    run._prioritize(["a.py"])
+    assert list(run._active_set()) == [2, 1, 0, 4, 3, 5]
+    assert run.expected == {1: 1.0, 2: 10.0, 3: 100.0}
+    assert run.eta() == 100.0
+
+    run._finalized_idx = 2
+    assert list(run._active_set()) == [4, 3, 5]
+
+
+def test_ick_run_prioritizes_urgent_steps_within_order(tmp_path: Path) -> None:
+    history = TimingHistory(tmp_path / "timings.json")
+    history.record("slow", "", 10.0, 1)
+
+    def active_set(priority: Priority) -> list[int]:
+        run = IckRun(history=history, parallelism=4, priority=priority)
+        for step in (_step("slow"), _step("urgent", urgency=Urgency.URGENT), _step("soon", urgency=Urgency.SOON), _step("first", order=40)):
+            run.add_step(step)
+        run.add_step(Step())
+        run._prioritize(["a.py"])
+        return list(run._active_set())
+
+    assert active_set("order") == [3, 0, 1, 2, 4]
+    # Order still comes first, then urgency, then expected time
+    assert active_set("urgency") == [3, 1, 2, 0, 4]
+
+
+def test_ick_run_records_timings(tmp_path: Path) -> None:
+    run = IckRun(history=TimingHistory(tmp_path / "timings.json"))
+    run.add_step(_step("p:r"))
+    run.add_step(_step("p:unused", patterns=("*.txt",)))
+    run.add_step(Step())
+    run.run_to_completion({"a.py": b"", "b.py": b""})
+    assert run.eta() is None
+
+    history = TimingHistory(tmp_path / "timings.json")
+    expected = history.expected("p:r", "", 2)
+    assert expected is not None and expected > 0
+    assert history.expected("p:unused", "", 2) is None
+
+
+def test_format_eta() -> None:
+    assert format_eta(None) == ""
+    assert format_eta(4.4) == "ETA 4s"
+    assert format_eta(125) == "ETA 2m05s"
+
+
+def test_fit_batch_cost() -> None:
+    assert fit_batch_cost([]) is None
+    assert fit_batch_cost([(10, 1.0), (10, 2.0)]) is None
+    assert fit_batch_cost([(1, 2.5), (11, 3.5), (21, 4.5)]) == BatchCost(overhead=2.4, per_file=0.1)
+    # Noise can't make either negative
+    assert fit_batch_cost([(1, 1.0), (10, 0.5)]) == BatchCost(overhead=0.75, per_file=0.0)
+
+
+def test_auto_batch_size() -> None:
+    # Expensive processes: as few as keep the slots busy
+    assert auto_batch_size(BatchCost(overhead=2.0, per_file=0.002), files=100, slots=4, max_files=1000) == 25
+    # Cheap processes, expensive files: small batches to spread the load
+    assert auto_batch_size(BatchCost(overhead=0.002, per_file=2.0), files=100, slots=4, max_files=1000) == 1
+    assert auto_batch_size(BatchCost(overhead=1.0, per_file=0.1), files=1000, slots=4, max_files=1000) == 100
+    assert auto_batch_size(BatchCost(overhead=1.0, per_file=0.0), files=1000, slots=4, max_files=50) == 50
+    assert auto_batch_size(BatchCost(overhead=1.0, per_file=0.1), files=0, slots=4, max_files=50) == 1
+
+
+def test_max_argv_files() -> None:
+    few = max_argv_files(["prog"], {"A": "x" * 1000}, ["a" * 1000])
+    many = max_argv_files(["prog"], {}, ["a.py", "b/c.py"])
+    assert 1 <= few < many
+
+
+def test_auto_batch_size_step() -> None:
+    step = _step("p:r", batch_size="auto")
+    step.index = 0
+    step.slots = 2
+    for i in range(50):
+        step.notify(Notification(key=f"{i}.py", state=State(gens=(0,), value=b"")))
+
+    # Probes, then sized from the measured cost
+    assert step._next_batch_size() == 1
+    step.batch_samples.append((1, 1.0))
+    assert step._next_batch_size() == 8
+    step.batch_samples.append((8, 1.7))
+    assert step._next_batch_size() == 25
+
+    # Or from history
+    step = _step("p:r", batch_size="auto")
+    step.batch_cost = BatchCost(overhead=0.001, per_file=1.0)
+    step.notify(Notification(key="a.py", state=State(gens=(0,), value=b"")))
+    assert step._next_batch_size() == 1
+
+    run: Run[str, bytes] = Run(parallelism=1)
+    step = _step("p:r", batch_size="auto")
+    run.add_step(step)  # type: ignore[arg-type]
+    run.add_step(Step())
+    run.run_to_completion({f"{i}.py": b"" for i in range(20)})
+    assert sum(n for n, _ in step.batch_samples) == 20
+
+
+def test_ick_run_concurrency_classes() -> None:
+    running: dict[str, int] = {}
+    peak: dict[str, int] = {}
+    lock = threading.Lock()
+
+    class CountingStep(GenericPreparedStep):
+        def process(
+            self, next_gen: int, notifications: Iterable[Notification[str, bytes | Erasure]]
+        ) -> Iterable[Notification[str, bytes | Erasure]]:
+            list(notifications)
+            with lock:
+                running[self.concurrency] = running.get(self.concurrency, 0) + 1
+                peak[self.concurrency] = max(peak.get(self.concurrency, 0), running[self.concurrency])
+            time.sleep(0.05)
+            with lock:
+                running[self.concurrency] -= 1
+            return []
+
+    run = IckRun(parallelism=4, concurrency={"docker": 1, "unlimited": 0})
+    for i, cls in enumerate(["docker", "docker", "pygrep", "pygrep"]):
+        step = CountingStep(
+            prefixed_name=f"r{i}",
+            patterns=["*.py"],
+            project_path="",
+            cmdline=[],
+            extra_env={},
+            append_filenames=True,
+            concurrency=cls,
+            batch_size=1,
+        )
+        run.add_step(step)
+    run.add_step(Step())
+    run.run_to_completion({f"{i}.py": b"" for i in range(4)})
+    assert peak["docker"] == 1
+    assert peak["pygrep"] > 1
+    assert run.class_limits == {"docker": 1}
+
+
+def test_ick_run_starts_unaffected_steps_early() -> None:
+    events: list[str] = []
+    lock = threading.Lock()
+
+    class RecordingStep(GenericPreparedStep):
+        def process(
+            self, next_gen: int, notifications: Iterable[Notification[str, bytes | Erasure]]
+        ) -> Iterable[Notification[str, bytes | Erasure]]:
+            notifications = list(notifications)
+            with lock:
+                events.append(f"start {self.prefixed_name}")
+            if self.prefixed_name == "slow":
+                time.sleep(0.5)
+            with lock:
+                events.append(f"end {self.prefixed_name}")
+            if self.prefixed_name == "slow":
+                # Changes one of its declared outputs
+                yield self.update_notification(notifications[0], next_gen, new_value=b"changed")
+
+    def step(name: str, patterns: list[str], outputs: list[str] | None = None) -> RecordingStep:
+        return RecordingStep(
+            prefixed_name=name,
+            patterns=patterns,
+            project_path="",
+            cmdline=[],
+            extra_env={},
+            append_filenames=False,
+            outputs=outputs,
+            eager=False,
+            batch_size=-1,
+        )
+
+    run = IckRun(parallelism=2)
+    run.add_step(step("slow", ["pyproject.toml"], outputs=["pyproject.toml"]))
+    run.add_step(step("py", ["*.py"]))
+    run.add_step(step("toml", ["*.toml"]))
+    run.add_step(Step())
+    result = run.run_to_completion({"pyproject.toml": b"", "a.py": b""})
+
+    # "py" can't be affected by "slow" so didn't wait for it, "toml" did
+    assert events.index("end py") < events.index("end slow") < events.index("start toml")
+    assert result["pyproject.toml"].value == b"changed"
@@ -0,0 +1,45 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from ick.sh import Usage, limit_resources, run_batch
+
+
+def test_run_batch(tmp_path: Path) -> None:
+    code = "import os, sys; print(os.getcwd()); print('err', file=sys.stderr); sys.exit(2)"
+    returncode, stdout, stderr, usage = run_batch([sys.executable, "-c", code], cwd=tmp_path, env={})
+    assert returncode == 2
+    assert stdout == f"{tmp_path}\n".encode()
+    assert stderr == b"err\n"
+    assert usage.batches == 1
+    assert usage.execute > 0
+    # Starting python takes some of each
+    assert usage.user + usage.system > 0
+    assert usage.max_rss_kb > 1024
+
+
+def test_run_batch_timeout(tmp_path: Path) -> None:
+    with pytest.raises(subprocess.TimeoutExpired):
+        run_batch([sys.executable, "-c", "import time; time.sleep(10)"], cwd=tmp_path, env={}, timeout=0.2)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="rlimits are posix-only")
+def test_limits_applied(tmp_path: Path) -> None:
+    limits = limit_resources(cpu_seconds=5, memory_mb=4096)
+    assert limits is not None
+    code = "import resource; print(resource.getrlimit(resource.RLIMIT_CPU), resource.getrlimit(resource.RLIMIT_AS))"
+    _, stdout, _, _ = run_batch([sys.executable, "-c", code], cwd=tmp_path, env={}, limits=limits)
+    assert stdout == f"(5, 6) ({4096 * 1024 * 1024}, {4096 * 1024 * 1024})\n".encode()
+
+
+def test_usage_add() -> None:
+    total = Usage()
+    total.add(Usage(batches=1, materialize=0.5, execute=1.0, user=0.25, max_rss_kb=100, oublock=2))
+    total.add(Usage(batches=2, analyze=0.5, execute=1.0, system=0.5, max_rss_kb=50, inblock=3, oublock=1))
+    assert total == Usage(batches=3, materialize=0.5, execute=2.0, analyze=0.5, user=0.25, system=0.5, max_rss_kb=100, inblock=3, oublock=3)
+
+
+def test_no_limits() -> None:
+    assert limit_resources() is None
@@ -0,0 +1,149 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from feedforward import Notification, State, Step
+
+from ick.base_rule import GenericPreparedStep
+from ick.schedule import IckRun
+from ick.supervisor import Supervisor
+
+
+def _python(code: str) -> list[str]:
+    return [sys.executable, "-c", code]
+
+
+def test_submit(tmp_path: Path) -> None:
+    with Supervisor(2) as supervisor:
+        result = supervisor.submit(
+            _python("import os, sys; print(os.getcwd(), os.environ['X']); print('err', file=sys.stderr); sys.exit(3)"),
+            cwd=tmp_path,
+            env={"X": "y"},
+        ).result()
+    assert result.returncode == 3
+    assert result.stdout == f"{tmp_path} y\n".encode()
+    assert result.stderr == b"err\n"
+    assert not result.timed_out
+    # Reaped with wait4, so there's rusage
+    assert result.usage is not None
+    assert result.usage.batches == 1
+    assert result.usage.max_rss_kb > 1024
+
+
+def test_submit_bounds_output(tmp_path: Path) -> None:
+    with Supervisor(1, max_output=10) as supervisor:
+        result = supervisor.submit(_python("print('x' * 100000)"), cwd=tmp_path, env={}).result()
+    assert result.stdout == b"x" * 10 + b"\n[99991 more bytes not shown]\n"
+
+
+def test_submit_timeout(tmp_path: Path) -> None:
+    with Supervisor(1) as supervisor:
+        start = time.monotonic()
+        result = supervisor.submit(_python("import time; time.sleep(10)"), cwd=tmp_path, env={}, timeout=0.2).result()
+    assert result.timed_out
+    assert time.monotonic() - start < 5
+    assert result.usage is not None
+    assert result.usage.execute >= 0.2
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="uses /proc")
+def test_submit_timeout_kills_children(tmp_path: Path) -> None:
+    # The child inherits the pipes, so would hold up reading them too
+    code = "import subprocess, sys, time; print(subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)']).pid, flush=True); time.sleep(30)"
+    with Supervisor(1) as supervisor:
+        start = time.monotonic()
+        pid_file = tmp_path / "pid"
+        result = supervisor.submit(
+            _python(f"import sys; sys.stdout = open({str(pid_file)!r}, 'w'); {code}"), cwd=tmp_path, env={}, timeout=1
+        ).result()
+    assert result.timed_out
+    assert time.monotonic() - start < 5
+    pid = pid_file.read_text().strip()
+    for _ in range(50):
+        # Gone, or a zombie waiting on whatever it was reparented to
+        if not Path(f"/proc/{pid}/stat").exists() or Path(f"/proc/{pid}/stat").read_text().split()[2] == "Z":
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail(f"{pid} is still running")
+
+
+def test_submit_missing_command(tmp_path: Path) -> None:
+    with Supervisor(1) as supervisor:
+        with pytest.raises(FileNotFoundError):
+            supervisor.submit(["/nonexistent/command"], cwd=tmp_path, env={}).result()
+
+
+def test_reserve() -> None:
+    with Supervisor(2) as supervisor:
+        assert supervisor.reserve()
+        assert supervisor.reserve()
+        assert not supervisor.reserve()
+        supervisor.release()
+        assert supervisor.reserve()
+
+
+def test_ick_run_processes_outnumber_threads() -> None:
+    step = GenericPreparedStep(
+        prefixed_name="p:r",
+        patterns=["*.py"],
+        project_path="",
+        cmdline=_python("import sys, time; time.sleep(0.5); [open(f, 'a').write('done') for f in sys.argv[1:]]"),
+        extra_env={},
+        append_filenames=True,
+        batch_size=1,
+    )
+    run = IckRun(parallelism=1, supervisor=Supervisor(8))
+    run.add_step(step)
+    run.add_step(Step())
+    start = time.monotonic()
+    result = run.run_to_completion({f"{i}.py": b"" for i in range(8)})
+    # One thread, but the processes all ran at once
+    assert time.monotonic() - start < 3
+    assert {k: v.value for k, v in result.items()} == {f"{i}.py": b"done" for i in range(8)}
+    assert step.batches == 8
+    assert not step.cancelled
+    usage = step.usage[""]
+    assert usage.batches == 8
+    assert usage.execute >= 8 * 0.5
+    assert usage.materialize > 0
+    assert usage.analyze > 0
+
+
+def test_ick_run_supervised_timeout() -> None:
+    step = GenericPreparedStep(
+        prefixed_name="p:r",
+        patterns=["*.py"],
+        project_path="",
+        cmdline=_python("import time; time.sleep(10)"),
+        extra_env={},
+        append_filenames=True,
+        timeout=0.2,
+    )
+    run = IckRun(parallelism=1, supervisor=Supervisor(2))
+    run.add_step(step)
+    run.add_step(Step())
+    run.run_to_completion({"a.py": b"x"})
+    assert step.cancelled
+    assert step.cancel_reason == "Batch of 1 file took longer than the timeout of 0.2s"
+
+
+def test_take_batch_keeps_concurrency_limit() -> None:
+    step = GenericPreparedStep(
+        prefixed_name="p:r",
+        patterns=["*.py"],
+        project_path="",
+        cmdline=_python("pass"),
+        extra_env={},
+        append_filenames=True,
+        batch_size=1,
+    )
+    step.index = 0
+    step.concurrency_limit = 1
+    for name in ("a.py", "b.py"):
+        step.notify(Notification(key=name, state=State(gens=(0,), value=b"")))
+    assert step._take_batch() is not None
+    assert step._take_batch() is None
+    step.outstanding -= 1
+    assert step._take_batch() is not None
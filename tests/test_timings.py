@@ -0,0 +1,40 @@
+import pstats
+import threading
+import time
+from pathlib import Path
+
+from ick.timings import PhaseTimings, profiling
+
+
+def test_phase_timings() -> None:
+    timings = PhaseTimings()
+    with timings.phase("outer"):
+        time.sleep(0.05)
+        with timings.phase("inner"):
+            time.sleep(0.1)
+    with timings.phase("inner"):
+        time.sleep(0.1)
+
+    assert list(timings.seconds) == ["outer", "inner"]
+    # Only its own time
+    assert 0.05 <= timings.seconds["outer"] < 0.1
+    assert timings.seconds["inner"] >= 0.2
+
+    lines = timings.summary().splitlines()
+    assert [line.split()[0] for line in lines] == ["outer", "inner", "other", "total"]
+
+    timings.reset()
+    assert timings.seconds == {}
+
+
+def test_profiling_sees_threads(tmp_path: Path) -> None:
+    def in_thread() -> None:
+        time.sleep(0.01)
+
+    with profiling(str(tmp_path / "prof")):
+        thread = threading.Thread(target=in_thread)
+        thread.start()
+        thread.join()
+
+    stats = pstats.Stats(str(tmp_path / "prof"))
+    assert any(func == "in_thread" for _, _, func in stats.stats)  # type: ignore[attr-defined] # FIX ME
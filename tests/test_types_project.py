@@ -0,0 +1,62 @@
+import subprocess
+from contextlib import ExitStack
+from pathlib import Path
+
+from ick.types_project import RepoPool, rule_test_repo, tree_zfiles
+
+
+def _git_zfiles(path: Path) -> str:
+    subprocess.run(["git", "init", "-q"], cwd=path, check=True)
+    return subprocess.run(
+        ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"], cwd=path, check=True, capture_output=True, encoding="utf-8"
+    ).stdout
+
+
+def test_tree_zfiles_matches_git(tmp_path: Path) -> None:
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "empty").mkdir()
+    (tmp_path / "a" / "b" / "c.py").write_text("")
+    (tmp_path / "a" / "d.txt").write_text("")
+    (tmp_path / ".hidden").write_text("")
+    (tmp_path / "z.txt").write_text("")
+    (tmp_path / "link").symlink_to("a")
+
+    zfiles = tree_zfiles(tmp_path)
+    assert zfiles == ".hidden\0a/b/c.py\0a/d.txt\0link\0z.txt\0"
+    assert zfiles == _git_zfiles(tmp_path)
+
+
+def test_tree_zfiles_gitignore(tmp_path: Path) -> None:
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / ".gitignore").write_text("*.log\n")
+    assert tree_zfiles(tmp_path) is None
+
+
+def test_rule_test_repo(tmp_path: Path) -> None:
+    inp = tmp_path / "input"
+    inp.mkdir()
+    (inp / "a.py").write_text("")
+    (inp / "b.log").write_text("")
+
+    with RepoPool() as pool, ExitStack() as stack:
+        repo = rule_test_repo(inp, stack.enter_context, pool)
+        assert repo.root == inp
+        assert repo.zfiles == "a.py\0b.log\0"
+
+    (inp / ".gitignore").write_text("*.log\n")
+    with RepoPool() as pool:
+        with ExitStack() as stack:
+            repo = rule_test_repo(inp, stack.enter_context, pool)
+            first_root = repo.root
+            assert repo.root != inp
+            assert repo.zfiles == ".gitignore\0a.py\0"
+            assert (repo.root / "b.log").exists()
+
+        # Emptied and reused
+        assert [p.name for p in first_root.iterdir()] == [".git"]
+        (inp / "c.py").write_text("")
+        with ExitStack() as stack:
+            repo = rule_test_repo(inp, stack.enter_context, pool)
+            assert repo.root == first_root
+            assert repo.zfiles == ".gitignore\0a.py\0c.py\0"
+    assert not first_root.exists()
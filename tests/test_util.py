@@ -2,7 +2,7 @@ from pathlib import Path
 
 import pytest
 
-from ick.util import convert_path_to_python_identifiers, merge
+from ick.util import bytes_entry, convert_path_to_python_identifiers, merge, tree_manifest
 
 
 def test_merge() -> None:
@@ -27,3 +27,20 @@ def test_merge() -> None:
 )
 def test_convert_path_to_python_identifiers(path: str, expected: str) -> None:
     assert convert_path_to_python_identifiers(Path(path)) == Path(expected)
+
+
+def test_tree_manifest(tmp_path: Path) -> None:
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "b.txt").write_bytes(b"hello")
+    (tmp_path / ".hidden").write_bytes(b"")
+    (tmp_path / "dangling").symlink_to("nowhere")
+    (tmp_path / "linked").symlink_to("a")
+
+    manifest = tree_manifest(tmp_path)
+    assert manifest == {
+        "a/b.txt": bytes_entry(b"hello"),
+        ".hidden": bytes_entry(b""),
+        "linked/b.txt": bytes_entry(b"hello"),
+    }
+    assert manifest["a/b.txt"][0] == 5
+    assert tree_manifest(tmp_path / "missing") == {}
@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+from typing import Callable
+
+import pytest
+
+from ick.watch import InotifyWatcher, PollingWatcher, Watcher
+
+
+def _polling(roots: list[Path]) -> Watcher:
+    return PollingWatcher(roots, interval=0.01)
+
+
+@pytest.mark.parametrize(
+    "make_watcher",
+    [
+        _polling,
+        pytest.param(InotifyWatcher, marks=pytest.mark.skipif(sys.platform != "linux", reason="inotify is linux-only")),
+    ],
+)
+def test_watcher(tmp_path: Path, make_watcher: Callable[..., Watcher]) -> None:
+    root = tmp_path.resolve()
+    (root / "a.py").write_text("")
+    (root / ".git").mkdir()
+    with make_watcher([root]) as w:
+        assert w.wait(timeout=0.05) == set()
+
+        (root / "a.py").write_text("changed")
+        (root / ".git" / "index").write_text("")
+        assert w.wait(timeout=5) == {root / "a.py"}
+
+        (root / "tests" / "one").mkdir(parents=True)
+        (root / "tests" / "one" / "input.txt").write_text("")
+        assert root / "tests" / "one" / "input.txt" in _wait_for_quiet(w)
+
+        # Dirs created after the watch started are watched too
+        (root / "tests" / "one" / "input.txt").write_text("changed")
+        assert w.wait(timeout=5) == {root / "tests" / "one" / "input.txt"}
+
+
+def _wait_for_quiet(w: Watcher) -> set[Path]:
+    changed = w.wait(timeout=5)
+    while more := w.wait(timeout=0.1):
+        changed |= more
+    return changed